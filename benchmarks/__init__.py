@@ -0,0 +1,11 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmarks of tess, in the layout of airspeed velocity (asv).
+
+Each module holds benchmark classes whose ``time_*`` and ``peakmem_*``
+methods are run for every input size in ``params``, after ``setup`` has
+made synthetic inputs of that size with :mod:`benchmarks.generators`. They
+can be run with ``asv run`` (see ``asv.conf.json``), or without asv by
+``scripts/bench_scaling.py``, which also fits how time and memory scale
+with input size.
+"""
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks of pixel and point accretion.
+"""
+
+from tess.pixel_accretion import IsoIntensityAccretor, EqualSNAccretor
+from tess.point_accretion import EqualMassAccretor
+
+from .generators import SIZES, make_image, make_points
+
+
+class IsoIntensityAccretion(object):
+    """Iso-intensity pixel accretion of a galaxy image."""
+    params = SIZES
+    param_names = ['n_pixels']
+    timeout = 1800
+
+    def setup(self, n_pixels):
+        self.img, self.noise = make_image(n_pixels)
+
+    def time_accrete(self, n_pixels):
+        IsoIntensityAccretor(self.img, 2.)
+
+    def peakmem_accrete(self, n_pixels):
+        IsoIntensityAccretor(self.img, 2.)
+
+
+class EqualSNAccretion(object):
+    """Equal-S/N pixel accretion of a galaxy image, with cleanup."""
+    params = SIZES
+    param_names = ['n_pixels']
+    timeout = 1800
+
+    def setup(self, n_pixels):
+        self.img, self.noise = make_image(n_pixels)
+
+    def _accrete(self):
+        accretor = EqualSNAccretor(self.img, self.noise, 50.)
+        accretor.cleanup()
+
+    def time_accrete(self, n_pixels):
+        self._accrete()
+
+    def peakmem_accrete(self, n_pixels):
+        self._accrete()
+
+
+class EqualMassPointAccretion(object):
+    """Equal-mass accretion of a point cloud into bins of 100 points, with
+    cleanup."""
+    params = SIZES
+    param_names = ['n_points']
+    timeout = 1800
+
+    def setup(self, n_points):
+        self.xy, self.mass, size = make_points(n_points)
+
+    def _accrete(self):
+        accretor = EqualMassAccretor(self.xy, self.mass, 100.)
+        accretor.accrete()
+        accretor.cleanup()
+
+    def time_accrete(self, n_points):
+        self._accrete()
+
+    def peakmem_accrete(self, n_points):
+        self._accrete()
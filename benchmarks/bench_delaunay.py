@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks of Delaunay triangulation and the Delaunay tessellation field
+estimator (DTFE).
+"""
+
+from .generators import SIZES, make_points
+
+
+def _delaunay():
+    """The Delaunay modules, which need the (old) ``matplotlib.delaunay``
+    package; asv skips benchmarks whose setup raises NotImplementedError."""
+    try:
+        from tess.delaunay import DelaunayTessellation
+        from tess.density import DelaunayDensityEstimator
+    except ImportError:
+        raise NotImplementedError("matplotlib.delaunay is not available")
+    return DelaunayTessellation, DelaunayDensityEstimator
+
+
+class DelaunayConstruction(object):
+    """Delaunay triangulation of a point cloud."""
+    params = SIZES
+    param_names = ['n_points']
+    timeout = 1800
+
+    def setup(self, n_points):
+        self.tessellation_class = _delaunay()[0]
+        self.xy, self.mass, size = make_points(n_points)
+
+    def time_triangulate(self, n_points):
+        self.tessellation_class(self.xy[:, 0], self.xy[:, 1])
+
+    def peakmem_triangulate(self, n_points):
+        self.tessellation_class(self.xy[:, 0], self.xy[:, 1])
+
+
+class DTFE(object):
+    """DTFE densities of the nodes of a Delaunay triangulation, including
+    the node-to-triangle membership table but not the triangulation."""
+    params = SIZES
+    param_names = ['n_points']
+    timeout = 1800
+
+    def setup(self, n_points):
+        tessellation_class, self.estimator_class = _delaunay()
+        self.xy, self.mass, self.size = make_points(n_points)
+        self.delaunay = tessellation_class(self.xy[:, 0], self.xy[:, 1])
+
+    def _estimate(self):
+        self.delaunay._mem_table = None  # rebuilt by every run
+        estimator = self.estimator_class(self.delaunay)
+        estimator.estimate_density((0., self.size), (0., self.size),
+                                   self.mass)
+
+    def time_estimate_density(self, n_points):
+        self._estimate()
+
+    def peakmem_estimate_density(self, n_points):
+        self._estimate()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks of Lloyd's algorithm and Voronoi rendering.
+"""
+
+import numpy as np
+
+from tess.lloyd import lloyd, pyramid_lloyd
+from tess.voronoi import VoronoiTessellation
+
+from .generators import SIZES, make_image, make_points, make_nodes
+
+# Lloyd iterations per benchmark, so that runs of any size do the same work
+# per point
+N_ITERS = 10
+
+
+class Lloyd(object):
+    """A fixed number of Lloyd iterations over a point cloud, with a node
+    per 100 points."""
+    params = SIZES
+    param_names = ['n_points']
+    timeout = 1800
+
+    def setup(self, n_points):
+        self.xy, self.mass, size = make_points(n_points)
+        self.nodes = make_nodes(n_points)
+
+    def time_lloyd(self, n_points):
+        lloyd(self.xy, self.mass, self.nodes, N_ITERS)
+
+    def peakmem_lloyd(self, n_points):
+        lloyd(self.xy, self.mass, self.nodes, N_ITERS)
+
+
+class PyramidLloyd(object):
+    """Coarse-to-fine Lloyd iterations over the pixels of a density image,
+    with a node per 100 pixels; its peak memory is the coarse images and
+    the membership, not per-pixel coordinates."""
+    params = SIZES
+    param_names = ['n_pixels']
+    timeout = 1800
+
+    def setup(self, n_pixels):
+        image, noise = make_image(n_pixels)
+        self.density = np.abs(image)
+        # make_nodes spreads nodes over 100 units of area per pixel
+        self.nodes = make_nodes(n_pixels) / 10.
+
+    def time_pyramid_lloyd(self, n_pixels):
+        pyramid_lloyd(self.density, self.nodes, 2, N_ITERS)
+
+    def peakmem_pyramid_lloyd(self, n_pixels):
+        pyramid_lloyd(self.density, self.nodes, 2, N_ITERS)
+
+
+class VoronoiRendering(object):
+    """Rendering the segmentation map of a Voronoi tessellation onto a
+    pixel grid, with a node per 100 pixels."""
+    params = SIZES
+    param_names = ['n_pixels']
+    timeout = 1800
+
+    def setup(self, n_pixels):
+        self.size = int(round(np.sqrt(n_pixels)))
+        # make_nodes spreads nodes over 100 units of area per pixel
+        self.nodes = make_nodes(n_pixels) / 10.
+
+    def _render(self):
+        tessellation = VoronoiTessellation(self.nodes)
+        tessellation.set_pixel_grid((0, self.size), (0, self.size))
+        return tessellation.segmap
+
+    def time_render(self, n_pixels):
+        self._render()
+
+    def peakmem_render(self, n_pixels):
+        self._render()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Synthetic inputs for the benchmarks, after the images and point sets of the
+demonstration scripts.
+"""
+
+import numpy as np
+
+# Input sizes (pixels or points) every benchmark is run for
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+
+def make_image(n_pixels, seed=0):
+    """Square galaxy-like image (a Sersic-ish profile plus noise) of about
+    ``n_pixels`` pixels, and its noise image."""
+    n = int(round(np.sqrt(n_pixels)))
+    rs = np.random.RandomState(seed)
+    y, x = np.mgrid[0:n, 0:n]
+    r = np.hypot(x - 0.5 * n, y - 0.5 * n) / (0.1 * n)
+    model = 1000. * np.exp(-r ** 0.5)
+    noise = np.sqrt(model + 10.)
+    img = model + noise * rs.randn(n, n)
+    return img, noise
+
+
+def make_points(n_points, seed=0):
+    """Correlated Gaussian cloud of ``n_points`` points of unit mass, in a
+    square field whose area grows with ``n_points`` so the mean density stays
+    the same. Returns the ``(n_points, 2)`` coordinates, the masses and the
+    field size."""
+    size = np.sqrt(n_points * 100.)
+    rs = np.random.RandomState(seed)
+    mean = (0.5 * size, 0.5 * size)
+    cov = (0.05 * size ** 2) * np.array(((1., 0.5), (0.5, 1.)))
+    xy = rs.multivariate_normal(mean, cov, n_points)
+    np.clip(xy, 0., size - 1., out=xy)
+    return xy, np.ones(n_points), size
+
+
+def make_nodes(n_points, points_per_node=100, seed=1):
+    """Nodes for a point set of ``make_points(n_points)``, as if accreted to
+    ``points_per_node`` points each."""
+    n_nodes = max(n_points // points_per_node, 4)
+    xy, mass, size = make_points(n_nodes, seed=seed)
+    return xy * np.sqrt(float(points_per_node))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark the compiled pixel accretion engine against the pure-Python
+accretion path on synthetic images of 1 to 16 megapixels.
+
+Usage::
+
+    bench_pixel_accretion.py [--sizes 1 4 16] [--python-max-mpix 0.25]
+
+The pure-Python path is only timed up to ``--python-max-mpix``; beyond that
+its runtime is extrapolated linearly in pixel count from the largest timed
+image (this is optimistic, since the Python path scales super-linearly).
+
+With ``--workers``, tiled accretion (compiled) is instead timed on each image
+for every number of worker processes, and the speedup is reported relative
+to the first worker count given::
+
+    bench_pixel_accretion.py --sizes 16 --workers 1 2 4 8 16 32
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from tess.pixel_accretion import IsoIntensityAccretor, EqualSNAccretor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=[1., 4., 16.],
+                        help='Image sizes to benchmark, in megapixels')
+    parser.add_argument('--python-max-mpix', type=float, default=0.25,
+                        help='Largest image (Mpix) to run the Python path on')
+    parser.add_argument('--target-sn', type=float, default=50.)
+    parser.add_argument('--sigma-limit', type=float, default=2.)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='Time tiled accretion with these worker counts')
+    parser.add_argument('--tile-size', type=int, default=512,
+                        help='Tile side length for tiled accretion')
+    parser.add_argument('--tile-overlap', type=int, default=32)
+    args = parser.parse_args()
+    if args.workers:
+        bench_workers(args)
+        return
+
+    python_rates = {}
+    # Reference run of the slow path on a small image
+    ref_mpix = min(args.python_max_mpix, min(args.sizes))
+    for name in ('iso', 'sn'):
+        img, noise = make_image(ref_mpix)
+        t = time_accretor(name, img, noise, args, compiled=False)
+        python_rates[name] = (ref_mpix, t)
+
+    print "{0:>6s} {1:>5s} {2:>12s} {3:>12s} {4:>9s}".format(
+        "Mpix", "kind", "compiled [s]", "python [s]", "speedup")
+    for mpix in args.sizes:
+        img, noise = make_image(mpix)
+        for name in ('iso', 'sn'):
+            t_compiled = time_accretor(name, img, noise, args, compiled=True)
+            if mpix <= args.python_max_mpix:
+                t_python = time_accretor(name, img, noise, args,
+                                         compiled=False)
+                flag = ' '
+            else:
+                ref_mpix, t_ref = python_rates[name]
+                t_python = t_ref * mpix / ref_mpix
+                flag = '*'
+            print "{0:6.2f} {1:>5s} {2:12.3f} {3:11.1f}{4} {5:9.0f}".format(
+                mpix, name, t_compiled, t_python, flag,
+                t_python / t_compiled)
+    print "* extrapolated from the {0:.2f} Mpix pure-Python run".format(
+        ref_mpix)
+
+
+def bench_workers(args):
+    print "{0:>6s} {1:>5s} {2:>7s} {3:>11s} {4:>8s} {5:>8s}".format(
+        "Mpix", "kind", "workers", "tiled [s]", "speedup", "n_bins")
+    for mpix in args.sizes:
+        img, noise = make_image(mpix)
+        for name in ('iso', 'sn'):
+            t_ref = None
+            for n_workers in args.workers:
+                t0 = time.time()
+                accretor = make_accretor(
+                    name, img, noise, args,
+                    tile_shape=(args.tile_size, args.tile_size),
+                    tile_overlap=args.tile_overlap, n_workers=n_workers)
+                t = time.time() - t0
+                if t_ref is None:
+                    t_ref = t
+                print "{0:6.2f} {1:>5s} {2:7d} {3:11.3f} {4:8.2f} " \
+                    "{5:8d}".format(mpix, name, n_workers, t, t_ref / t,
+                                    accretor.segmap.max() + 1)
+
+
+def make_image(mpix, seed=0):
+    """Synthetic galaxy-like image (a Sersic-ish profile plus noise) with
+    ``mpix`` megapixels."""
+    n = int(np.sqrt(mpix * 1e6))
+    rs = np.random.RandomState(seed)
+    y, x = np.mgrid[0:n, 0:n]
+    r = np.hypot(x - 0.5 * n, y - 0.5 * n) / (0.1 * n)
+    model = 1000. * np.exp(-r ** 0.5)
+    noise = np.sqrt(model + 10.)
+    img = model + noise * rs.randn(n, n)
+    return img, noise
+
+
+def make_accretor(name, img, noise, args, **kwargs):
+    if name == 'iso':
+        return IsoIntensityAccretor(img, args.sigma_limit, **kwargs)
+    else:
+        return EqualSNAccretor(img, noise, args.target_sn, **kwargs)
+
+
+def time_accretor(name, img, noise, args, compiled=True):
+    t0 = time.time()
+    make_accretor(name, img, noise, args, compiled=compiled)
+    return time.time() - t0
+
+
+if __name__ == '__main__':
+    main()
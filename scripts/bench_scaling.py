@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run the benchmark suite without asv and print how the runtime and peak
+memory of each benchmark scale with input size.
+
+Usage::
+
+    bench_scaling.py [--max-size 1e6] [--bench accretion lloyd]
+                     [--save scaling.json] [--compare scaling.json]
+
+Every ``time_*`` and ``peakmem_*`` benchmark in ``benchmarks/`` is run in a
+fresh Python interpreter for each input size up to ``--max-size`` (the suite
+goes up to 10^7 points or pixels). Runtimes are the best of ``--repeat``
+runs. Peak memory is the peak resident size of the interpreter during the
+run, less its resident size after ``setup`` made the synthetic inputs. On
+Linux the peak is reset after ``setup``, so transient memory used by
+``setup`` itself does not hide the benchmark's peak; elsewhere it is the
+growth of ``ru_maxrss``. A run that times out or fails is reported and
+left out of the fit, and the larger sizes of a benchmark that timed out are
+skipped.
+
+A power law ``value ~ size ** exponent`` is fitted to each benchmark, so an
+exponent of 1 is linear scaling. ``--save`` writes the results to a JSON
+file, and ``--compare`` flags benchmarks whose exponent grew by more than
+``--tolerance`` over those of a saved run::
+
+    bench_scaling.py --save before.json
+    (upgrade, rebuild)
+    bench_scaling.py --compare before.json
+"""
+
+import argparse
+import inspect
+import json
+import os
+import pkgutil
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmarks  # NOQA
+from benchmarks.generators import SIZES  # NOQA
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        help='Input sizes to run (default: the suite sizes '
+                        'up to --max-size)')
+    parser.add_argument('--max-size', type=float, default=1e6,
+                        help='Largest suite input size to run')
+    parser.add_argument('--bench', nargs='+',
+                        help='Only run benchmarks whose name contains one '
+                        'of these (case-insensitive) strings')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per size')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='Compare exponents to a JSON file from --save')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Exponent increase reported as a regression')
+    args = parser.parse_args()
+    if args.sizes:
+        sizes = [int(n) for n in args.sizes]
+    else:
+        sizes = [n for n in SIZES if n <= args.max_size]
+
+    results = {}
+    print "{0:<56s} {1:>9s} {2:>11s}".format("benchmark", "size", "value")
+    for name, cls, method in find_benchmarks(args.bench):
+        values = results.setdefault(name, {})
+        timed_out = False
+        for n in sizes:
+            if timed_out:
+                # Larger sizes would only time out as well
+                print "{0:<56s} {1:9d} {2:>11s}".format(name, n, "skipped")
+                continue
+            try:
+                value = run_in_child(cls, method, n, args.repeat)
+            except BenchmarkFailed as e:
+                # Keep the results so far and go on with the next size
+                timed_out = e.timed_out
+                print "{0:<56s} {1:9d} {2:>11s}".format(name, n, e.status)
+                continue
+            if value is None:
+                print "{0:<56s} {1:9d} {2:>11s}".format(name, n, "skipped")
+                continue
+            values[str(n)] = value
+            print "{0:<56s} {1:9d} {2:>11s}".format(
+                name, n, format_value(name, value))
+
+    exponents = dict((name, fit_exponent(values))
+                     for name, values in results.items())
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)['exponents']
+    print
+    print "{0:<56s} {1:>8s} {2:>8s}".format("benchmark", "exponent",
+                                            "previous")
+    n_regressions = 0
+    for name in sorted(exponents):
+        exponent = exponents[name]
+        line = "{0:<56s} {1:>8s}".format(name, format_exponent(exponent))
+        if reference is not None:
+            previous = reference.get(name)
+            line += " {0:>8s}".format(format_exponent(previous))
+            if exponent is not None and previous is not None \
+                    and exponent - previous > args.tolerance:
+                line += "  REGRESSION"
+                n_regressions += 1
+        print line
+    if reference is not None:
+        print "{0:d} regression(s)".format(n_regressions)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'sizes': sizes, 'results': results,
+                       'exponents': exponents}, f, indent=2, sort_keys=True)
+    if n_regressions:
+        sys.exit(1)
+
+
+def find_benchmarks(patterns=None):
+    """Yield ``(name, class, method name)`` for each benchmark of the suite,
+    named like ``module.Class.method`` as in asv."""
+    for _, module_name, _ in pkgutil.iter_modules(benchmarks.__path__):
+        if not module_name.startswith('bench_'):
+            continue
+        module = __import__('benchmarks.' + module_name,
+                            fromlist=[module_name])
+        for cls_name, cls in sorted(inspect.getmembers(module,
+                                                       inspect.isclass)):
+            if cls.__module__ != module.__name__:
+                continue
+            for method in sorted(dir(cls)):
+                if not method.startswith(('time_', 'peakmem_')):
+                    continue
+                name = '.'.join((module_name, cls_name, method))
+                if patterns and not any(p.lower() in name.lower()
+                                        for p in patterns):
+                    continue
+                yield name, cls, method
+
+
+class BenchmarkFailed(Exception):
+    """A benchmark run that timed out or exited with an error."""
+    def __init__(self, status, timed_out=False):
+        super(BenchmarkFailed, self).__init__(status)
+        self.status = status
+        self.timed_out = timed_out
+
+
+def run_in_child(cls, method, n, repeat):
+    """Run one benchmark at size ``n`` in a fresh interpreter, so that peak
+    memory is measured from that interpreter's own baseline (a forked child
+    would inherit this process's peak resident size). Returns the best
+    runtime in seconds or the peak memory growth in bytes, or ``None`` if
+    the benchmark is skipped (its setup raised NotImplementedError).
+    Benchmarks are stopped after their class's ``timeout`` in seconds, as
+    in asv; a timeout or an error raises :class:`BenchmarkFailed`."""
+    command = [sys.executable, os.path.abspath(__file__), '--child',
+               cls.__module__, cls.__name__, method, str(n), str(repeat)]
+    child = subprocess.Popen(command, stdout=subprocess.PIPE)
+    deadline = time.time() + getattr(cls, 'timeout', 60)
+    while child.poll() is None:
+        if time.time() > deadline:
+            child.kill()
+            child.wait()
+            raise BenchmarkFailed("timed out", timed_out=True)
+        time.sleep(0.05)
+    output = child.stdout.read()
+    if child.returncode != 0:
+        raise BenchmarkFailed("failed")
+    return json.loads(output)['value']
+
+
+def child_main(module_name, cls_name, method, n, repeat):
+    """Entry point of the interpreter started by :func:`run_in_child`;
+    writes the result as JSON to stdout."""
+    n, repeat = int(n), int(repeat)
+    module = __import__(module_name, fromlist=[cls_name])
+    bench = getattr(module, cls_name)()
+    try:
+        bench.setup(n)
+    except NotImplementedError:
+        value = None
+    else:
+        func = getattr(bench, method)
+        if method.startswith('time_'):
+            times = []
+            for i in xrange(repeat):
+                t0 = time.time()
+                func(n)
+                times.append(time.time() - t0)
+            value = min(times)
+        else:
+            value = peak_memory_growth(func, n)
+    sys.stdout.write(json.dumps({'value': value}))
+
+
+def peak_memory_growth(func, *args):
+    """Peak resident size of this process while calling ``func(*args)``,
+    less its resident size before the call, in bytes."""
+    try:
+        # Reset the peak resident size (VmHWM) to the current one (Linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return 1024. * (after - before)  # ru_maxrss is in KiB
+    before = _proc_status_kib('VmRSS')
+    func(*args)
+    return 1024. * (_proc_status_kib('VmHWM') - before)
+
+
+def _proc_status_kib(field):
+    """A memory field of ``/proc/self/status``, in KiB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def fit_exponent(values):
+    """Slope of a least-squares line through ``log(value)`` against
+    ``log(size)``, ignoring zero values; ``None`` with fewer than two."""
+    sizes = np.array([int(n) for n in values], dtype=float)
+    y = np.array([values[n] for n in values], dtype=float)
+    good = y > 0.
+    if good.sum() < 2:
+        return None
+    return float(np.polyfit(np.log(sizes[good]), np.log(y[good]), 1)[0])
+
+
+def format_value(name, value):
+    if name.split('.')[-1].startswith('peakmem_'):
+        return "{0:8.1f} MB".format(value / 2. ** 20)
+    return "{0:9.3f} s".format(value)
+
+
+def format_exponent(exponent):
+    if exponent is None:
+        return "-"
+    return "{0:.2f}".format(exponent)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child_main(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Point catalogs that need not fit in memory.
+
+Point accretion (:mod:`tess.point_accretion`) and centroidal Voronoi
+tessellations (:class:`tess.voronoi.CVTessellation`) read point coordinates
+as separate ``x`` and ``y`` columns, in single or double precision. Catalogs
+can therefore be stored column by column on disk and memory-mapped with
+:func:`open_catalog` rather than loaded. The per-point arrays that the
+algorithms make along the way (bin numbers, variances, index buckets) come
+from :func:`scratch_array`, which can back them with temporary files.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+COORD_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+# Number of elements converted at a time when a column must be copied
+BLOCK_SIZE = 2 ** 20
+
+
+def open_catalog(path, columns=('x', 'y'), mmap_mode='r'):
+    """Memory-map the columns of a point catalog.
+
+    Parameters
+    ----------
+    path : str
+        Either a directory holding one ``.npy`` file per column (e.g.
+        ``x.npy``, ``y.npy`` and ``mass.npy``), or a single ``.npy`` file
+        holding a structured array with a named field per column.
+    columns : sequence
+        Names of the columns to open.
+    mmap_mode : str
+        Memory-map mode passed to :func:`numpy.load`, or ``None`` to load
+        the columns into memory.
+
+    Returns
+    -------
+    columns : list
+        The 1D column arrays, in the order of ``columns``. Fields of a
+        structured catalog are strided views into its memory map.
+    """
+    if os.path.isdir(path):
+        return [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                for name in columns]
+    table = np.load(path, mmap_mode=mmap_mode)
+    if table.dtype.names is None:
+        raise ValueError("{0} is not a structured array".format(path))
+    return [table[name] for name in columns]
+
+
+def coordinate_columns(xy, dtype=None, scratch_dir=None):
+    """The ``x`` and ``y`` coordinate columns of a set of points.
+
+    Parameters
+    ----------
+    xy : ndarray or sequence
+        Either an ``(n_points, 2)`` array of coordinates, or a pair of
+        ``(n_points,)`` ``x`` and ``y`` column arrays (such as memory maps
+        from :func:`open_catalog`).
+    dtype : dtype
+        Coordinate type, either ``numpy.float32`` or ``numpy.float64``. By
+        default ``numpy.float32`` if the coordinates already are, and
+        ``numpy.float64`` otherwise.
+    scratch_dir : str
+        Directory for temporary files backing any converted copies of the
+        columns (see :func:`scratch_array`).
+
+    Returns
+    -------
+    x, y : ndarray
+        Coordinate columns of type ``dtype``. Columns that already have this
+        type are returned without copying.
+    """
+    if isinstance(xy, np.ndarray) and xy.ndim == 2:
+        if xy.shape[1] != 2:
+            raise ValueError("xy must have shape (n_points, 2)")
+        x, y = xy[:, 0], xy[:, 1]
+    else:
+        x, y = xy
+        x, y = np.asanyarray(x), np.asanyarray(y)
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError("x and y columns must be 1D, of equal length")
+    if dtype is None:
+        if x.dtype == np.float32 and y.dtype == np.float32:
+            dtype = np.float32
+        else:
+            dtype = np.float64
+    dtype = np.dtype(dtype)
+    if dtype not in COORD_DTYPES:
+        raise ValueError("Coordinates must be float32 or float64")
+    return (as_column(x, dtype, scratch_dir=scratch_dir),
+            as_column(y, dtype, scratch_dir=scratch_dir))
+
+
+def as_column(a, dtype, scratch_dir=None):
+    """``a`` as a 1D array of type ``dtype``.
+
+    Arrays that already have this (native byte order) type are returned
+    as they are; otherwise ``a`` is converted block by block into a new
+    :func:`scratch_array`.
+    """
+    a = np.asanyarray(a)
+    dtype = np.dtype(dtype)
+    if a.ndim != 1:
+        raise ValueError("Columns must be 1D")
+    if a.dtype == dtype:
+        return a
+    column = scratch_array(a.shape[0], dtype, scratch_dir=scratch_dir)
+    for start in xrange(0, a.shape[0], BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, a.shape[0])
+        column[start:stop] = a[start:stop]
+    return column
+
+
+def scratch_array(shape, dtype, scratch_dir=None):
+    """An uninitialized array for intermediate results.
+
+    Parameters
+    ----------
+    shape : int or tuple
+        Shape of the array.
+    dtype : dtype
+        Type of the array.
+    scratch_dir : str
+        If given, the array is a :class:`numpy.memmap` of an anonymous
+        temporary file in this directory, which is removed once the array
+        is no longer used. Otherwise it is an ordinary in-memory array.
+    """
+    if scratch_dir is None:
+        return np.empty(shape, dtype=dtype)
+    if np.prod(shape) == 0:
+        # Empty files cannot be memory-mapped
+        return np.empty(shape, dtype=dtype)
+    with tempfile.TemporaryFile(dir=scratch_dir) as f:
+        # The map keeps the (unlinked) file alive after it is closed here
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
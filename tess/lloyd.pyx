@@ -1,28 +1,109 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
 """
 Lloyd's Algorithm in Cython.
 """
 
 from cython.view cimport array as cvarray
+from cython.parallel cimport prange, parallel, threadid
+import multiprocessing
+import time
+
 import numpy as np
-from scipy.spatial import cKDTree
+
+import logging
+log = logging.getLogger(__name__)
+
+from catalog import coordinate_columns, as_column, scratch_array
+from spatial_index import SpatialIndex, CHUNK_SIZE
+
+cdef extern from "math.h" nogil:
+    double sqrt(double x)
+
+ctypedef fused coord_t:
+    float
+    double
 
 
-cpdef lloyd(double[:, :] xy, double[:] w, double[:, :] node_xy,
-            long max_iters):
+def lloyd(xy, w, node_xy, long max_iters, dtype=None, scratch_dir=None,
+          long chunk_size=CHUNK_SIZE, int n_jobs=1, double atol=0.,
+          double rtol=0., double reassign_tol=0., bint incremental=False,
+          callback=None):
     """
     Lloyd's algorithm shifts the positions of Voronoi nodes so that each
     Voronoi bin contains equal mass.
 
+    Iterations stop once the nodes have (nearly) stopped moving: either the
+    largest node displacement of an iteration is at most
+    ``atol + rtol * first_shift``, where ``first_shift`` is the largest
+    displacement of the first iteration, or at most a fraction
+    ``reassign_tol`` of the points changed cell. With the default zero
+    tolerances, the nodes must stop moving exactly.
+
+    With ``incremental``, points are only re-assigned when the nodes have
+    moved enough that their cell may have changed, after Hamerly (2010,
+    "Making k-means even faster"). Each point keeps an upper bound on the
+    distance to its node and a lower bound on the distance to any other
+    node. After the nodes move, the upper bound grows by the shift of the
+    point's node and the lower bound shrinks by the largest shift of the
+    other nodes. Only points whose upper bound exceeds both the lower bound
+    and half the distance from their node to the nearest other node are
+    checked, first against their own node, and then queried for their two
+    nearest nodes. This gives the same cells as full assignment (up to
+    distance ties) but saves most queries once nodes move little, at the
+    cost of two ``float64`` bounds per point (memory-mapped with
+    ``scratch_dir``).
+
     Parameters
     ----------
-    xy : (n_points, 2) ndarray
-        Coordinates of data points.
+    xy : (n_points, 2) ndarray or sequence
+        Coordinates of data points, or a pair of ``(n_points,)`` x and y
+        coordinate columns (which may be memory maps, see
+        :func:`tess.catalog.open_catalog`).
     w : (n_points,) ndarray
         Weights of data points.
     node_xy : (n_nodes, 2) ndarray
-        Coordinates of (initial) Voronoi nodes.
+        Coordinates of (initial) Voronoi nodes, or a
+        :class:`tess.spatial_index.SpatialIndex` of them.
     max_iters : int
         Maximum number of iterations of Lloyd's algorithm.
+    dtype : dtype
+        Precision of the point coordinates, ``numpy.float32`` or
+        ``numpy.float64``. By default single precision is used only if the
+        coordinates are already ``float32``. Nodes are always computed in
+        double precision.
+    scratch_dir : str
+        If set, the per-point node indices (and any converted copies of the
+        inputs) are memory-mapped temporary files in this directory.
+    chunk_size : int
+        Number of points assigned to nodes per KD-tree query, which bounds
+        the memory used for query coordinates and distances.
+    n_jobs : int
+        Number of threads for the KD-tree queries and the centroid updates
+        (``-1`` uses all processors). The centroid sums of each thread are
+        kept apart and added up at the end of the update, so results depend
+        (to rounding) on the number of threads, but not on thread timing.
+    atol : float
+        Absolute tolerance on the largest node displacement of an
+        iteration, in coordinate units.
+    rtol : float
+        Tolerance on the largest node displacement of an iteration,
+        relative to that of the first iteration.
+    reassign_tol : float
+        Tolerance on the fraction of points that changed cell in an
+        iteration.
+    incremental : bool
+        If ``True``, use distance bounds to skip the nearest-node queries of
+        points whose cell cannot have changed.
+    callback : callable
+        If given, called after every iteration with a dict of statistics:
+        ``iteration`` (from 0), ``delta`` (the summed squared node
+        displacement), ``max_shift`` (the largest node displacement),
+        ``n_reassigned`` (the number of points that changed cell; all of
+        them in the first iteration), ``reassigned_frac``, the
+        ``skipped_frac`` of points whose nearest-node query the distance
+        bounds made unnecessary (always 0 unless ``incremental``), and the
+        ``assign_time`` and ``update_time`` in seconds spent assigning
+        points to nodes and moving the nodes.
 
     Returns
     -------
@@ -33,58 +114,557 @@ cpdef lloyd(double[:, :] xy, double[:] w, double[:, :] node_xy,
     converged : bool
         ``True`` if Lloyd's algorithm converged, ``False`` if not.
     """
-    cdef long i
+    cdef long i, start, stop
     cdef long n_iters = 0
-    cdef double delta, dx, dy
-    cdef double [:, :] orig_node_xy
-    cdef double [:] weight_sum
+    cdef long n_reassigned, n_queried
+    cdef long j_max = -1
+    cdef int n_threads
+    cdef double delta, dx, dy, shift2, max_shift2, next_shift2, first_shift
 
-    cdef long n_nodes = node_xy.shape[0]
-    cdef long n_points = xy.shape[0]
-    cdef long [:] idx = np.zeros(n_points, dtype=int)  # voronoi bin indices
-    cdef long [:] node_population = np.zeros(n_nodes, dtype=int)
+    x, y = coordinate_columns(xy, dtype=dtype, scratch_dir=scratch_dir)
+    w = as_column(w, np.float64, scratch_dir=scratch_dir)
+    cdef double [:, :] nodes = np.array(node_xy, dtype=float)
+    cdef long n_nodes = nodes.shape[0]
+    cdef long n_points = x.shape[0]
+    n_threads = multiprocessing.cpu_count() if n_jobs < 0 else max(n_jobs, 1)
+    # voronoi bin indices
+    idx = scratch_array(n_points, int, scratch_dir)
+    # node indices of a chunk of points, before they replace those in idx
+    chunk_idx = np.empty(min(chunk_size, n_points), dtype=int)
+    # Buffers reused by every iteration: the nodes before the update, and
+    # each thread's sums of weight, weighted x and weighted y for each node
+    cdef double [:, :] orig_node_xy = np.empty((n_nodes, 2), dtype=float)
+    cdef double [:, :, :] partial_sums = np.empty((n_threads, n_nodes, 3),
+                                                  dtype=float)
+    # How far each node moved in the last update
+    cdef double [:] shift = np.zeros(n_nodes, dtype=float)
+    if incremental:
+        # Upper bound on the distance from each point to its node, and
+        # lower bound on the distance to any other node
+        upper = scratch_array(n_points, float, scratch_dir)
+        lower = scratch_array(n_points, float, scratch_dir)
+        stale = np.empty(chunk_idx.shape[0], dtype=np.uint8)
 
     while True:
         # Copy the original nodes
-        orig_node_xy = node_xy.copy()
+        orig_node_xy[:, :] = nodes
 
-        # Assign each point to the closest node
-        # This defines a set of Voronoi bins
+        # Assign each point to the closest node, counting the points that
+        # changed cell. This defines a set of Voronoi bins
         # idx is length of xy, giving indices into node_xy
-        tree = cKDTree(node_xy)
-        idx = tree.query(xy, k=1)[1]
+        t0 = time.time()
+        index = SpatialIndex(np.asarray(nodes))
+        n_reassigned = 0
+        n_queried = n_points
+        if incremental and n_iters > 0:
+            n_queried, n_reassigned = _reassign_bounded(
+                index, x, y, idx, upper, lower, shift, j_max,
+                sqrt(max_shift2), sqrt(next_shift2), stale, chunk_size,
+                n_jobs, n_threads)
+        elif incremental:
+            for start in xrange(0, n_points, chunk_size):
+                stop = min(start + chunk_size, n_points)
+                dist, nearest = index.nearest(
+                    (x[start:stop], y[start:stop]), k=2, n_jobs=n_jobs)
+                idx[start:stop] = nearest[:, 0]
+                upper[start:stop] = dist[:, 0]
+                lower[start:stop] = dist[:, 1]
+        else:
+            for start in xrange(0, n_points, chunk_size):
+                stop = min(start + chunk_size, n_points)
+                new_idx = chunk_idx[:stop - start]
+                index.query((x[start:stop], y[start:stop]), n_jobs=n_jobs,
+                            chunk_size=chunk_size, out=new_idx)
+                if n_iters == 0:
+                    idx[start:stop] = new_idx
+                else:
+                    n_reassigned += _replace(idx[start:stop], new_idx)
+        if n_iters == 0:
+            n_reassigned = n_points
+        t1 = time.time()
 
         # Compute weighted centroid of the Voronoi bins
-        node_population = np.zeros(n_nodes, dtype=int)
-        node_xy = np.zeros((n_nodes, 2), dtype=float)
-        weight_sum = np.zeros(n_nodes, dtype=float)
-        for i in xrange(n_points):
-            node_population[idx[i]] += 1
-            weight_sum[idx[i]] += w[i]
-            for d in (0, 1):
-                node_xy[idx[i], d] += w[i] * xy[i, d]
-        for i in xrange(n_nodes):
-            # print node_population[i]
-            if node_population[i] > 0:
-                node_xy[i, 0] /= weight_sum[i]
-                node_xy[i, 1] /= weight_sum[i]
-            else:
-                # Empty node
-                node_xy[i, 0] = 0.
-                node_xy[i, 1] = 0.
+        _update_nodes(x, y, w, idx, nodes, partial_sums, n_threads)
 
-        # Compute how much each node has moved
+        # Compute how much each node has moved, and the two largest moves
         delta = 0.
-        for i in xrange(n_nodes):
-            dx = orig_node_xy[i, 0] - node_xy[i, 0]
-            dy = orig_node_xy[i, 1] - node_xy[i, 1]
-            delta += dx * dx + dy * dy
-        print "CVT Delta %03d %.2e" % (n_iters, delta)
+        max_shift2 = 0.
+        next_shift2 = 0.
+        for i in range(n_nodes):
+            dx = orig_node_xy[i, 0] - nodes[i, 0]
+            dy = orig_node_xy[i, 1] - nodes[i, 1]
+            shift2 = dx * dx + dy * dy
+            shift[i] = sqrt(shift2)
+            delta += shift2
+            if shift2 > max_shift2:
+                next_shift2 = max_shift2
+                max_shift2 = shift2
+                j_max = i
+            elif shift2 > next_shift2:
+                next_shift2 = shift2
+        if n_iters == 0:
+            first_shift = sqrt(max_shift2)
+        t2 = time.time()
+        n_total = float(max(n_points, 1))
+        log.debug("CVT iteration %03d delta %.2e, %d points reassigned",
+                  n_iters, delta, n_reassigned)
+        if callback is not None:
+            callback({'iteration': n_iters,
+                      'delta': delta,
+                      'max_shift': sqrt(max_shift2),
+                      'n_reassigned': n_reassigned,
+                      'reassigned_frac': n_reassigned / n_total,
+                      'skipped_frac': 1. - n_queried / n_total,
+                      'assign_time': t1 - t0,
+                      'update_time': t2 - t1})
 
         # Judge convergence
-        if delta == 0:
-            return node_xy, idx, True
+        if sqrt(max_shift2) <= atol + rtol * first_shift \
+                or n_reassigned <= reassign_tol * n_points:
+            return np.asarray(nodes), idx, True
         elif n_iters > max_iters:
-            return node_xy, idx, False
+            return np.asarray(nodes), idx, False
         else:
             n_iters += 1
+
+
+def minibatch_lloyd(xy, w, node_xy, long max_iters, long batch_size=10000,
+                    seed=None, dtype=None, scratch_dir=None,
+                    long chunk_size=CHUNK_SIZE, int n_jobs=1, callback=None):
+    """
+    Mini-batch variant of Lloyd's algorithm, after Sculley (2010, "Web-scale
+    k-means clustering"), for point sets too large to touch every point on
+    every iteration.
+
+    Each iteration draws a random subsample of ``batch_size`` points,
+    assigns them to their nearest nodes, and moves every node that received
+    points part of the way towards their weighted centroid. The step is
+    the batch weight of the node over the total weight the node has received
+    so far, so each node's learning rate falls as it settles, and a node is
+    the weighted mean of all the samples it has received. After the last
+    iteration, all points are assigned to the final nodes in one pass.
+
+    Accuracy and speed: an iteration costs ``O(batch_size * log(n_nodes))``
+    rather than ``O(n_points * log(n_nodes))``, plus one full assignment at
+    the end. In exchange, nodes scatter about their Lloyd positions by about
+    a cell size over the square root of the number of samples each node has
+    received, and cell masses scatter accordingly. For approximate
+    equal-mass tessellations, ``batch_size`` of 10 to 100 points per node
+    and a few tens of iterations usually suffice; more samples per node
+    approach the full Lloyd result.
+
+    Parameters
+    ----------
+    xy : (n_points, 2) ndarray or sequence
+        Coordinates of data points, or a pair of ``(n_points,)`` x and y
+        coordinate columns (which may be memory maps).
+    w : (n_points,) ndarray
+        Weights of data points.
+    node_xy : (n_nodes, 2) ndarray
+        Coordinates of (initial) Voronoi nodes, or a
+        :class:`tess.spatial_index.SpatialIndex` of them.
+    max_iters : int
+        Number of mini-batch iterations.
+    batch_size : int
+        Number of points drawn (uniformly, with replacement) per iteration.
+    seed : int
+        Seed of the random subsamples; the same seed gives the same nodes.
+    dtype : dtype
+        Precision of the point coordinates, ``numpy.float32`` or
+        ``numpy.float64``.
+    scratch_dir : str
+        If set, the per-point node indices (and any converted copies of the
+        inputs) are memory-mapped temporary files in this directory.
+    chunk_size : int
+        Number of points per KD-tree query in the final assignment.
+    n_jobs : int
+        Number of threads for the KD-tree queries (``-1`` uses all
+        processors).
+    callback : callable
+        If given, called after every iteration with a dict of statistics:
+        ``iteration`` (from 0), ``delta`` (the summed squared node
+        displacement), ``max_shift`` (the largest node displacement),
+        ``n_updated`` (the number of nodes that received points) and
+        ``update_time`` in seconds.
+
+    Returns
+    -------
+    node_xy : (n_nodes, 2) ndarray
+        Coordinates of the Voronoi nodes.
+    idx : (npoints,) ndarray
+        Index of node (Voronoi cell) that each data point is a member of.
+    """
+    cdef long it
+    cdef double delta
+
+    x, y = coordinate_columns(xy, dtype=dtype, scratch_dir=scratch_dir)
+    w = as_column(w, np.float64, scratch_dir=scratch_dir)
+    nodes = np.array(node_xy, dtype=float)
+    n_nodes = nodes.shape[0]
+    n_points = x.shape[0]
+    rs = np.random.RandomState(seed)
+    # Total weight each node has received
+    node_weight = np.zeros(n_nodes, dtype=float)
+    for it in range(max_iters):
+        t0 = time.time()
+        # Sorted, so memory-mapped columns are read in order
+        batch = np.sort(rs.randint(0, n_points, batch_size))
+        bx, by, bw = x[batch], y[batch], w[batch]
+        nearest = SpatialIndex(nodes).query((bx, by), n_jobs=n_jobs)
+        batch_w = np.bincount(nearest, weights=bw, minlength=n_nodes)
+        batch_wx = np.bincount(nearest, weights=bw * bx, minlength=n_nodes)
+        batch_wy = np.bincount(nearest, weights=bw * by, minlength=n_nodes)
+        updated = np.flatnonzero(batch_w > 0.)
+        node_weight[updated] += batch_w[updated]
+        rate = batch_w[updated] / node_weight[updated]
+        centroids = np.column_stack((batch_wx[updated] / batch_w[updated],
+                                     batch_wy[updated] / batch_w[updated]))
+        step = rate[:, None] * (centroids - nodes[updated])
+        nodes[updated] += step
+        delta = np.sum(step ** 2)
+        log.debug("Mini-batch CVT iteration %03d delta %.2e", it, delta)
+        if callback is not None:
+            callback({'iteration': it,
+                      'delta': delta,
+                      'max_shift': np.sqrt(np.max(np.sum(step ** 2, axis=1)))
+                      if len(updated) else 0.,
+                      'n_updated': len(updated),
+                      'update_time': time.time() - t0})
+    idx = SpatialIndex(nodes).query((x, y), n_jobs=n_jobs,
+                                    chunk_size=chunk_size,
+                                    scratch_dir=scratch_dir)
+    return nodes, idx
+
+
+def pyramid_lloyd(density, node_xy, long levels, long max_iters,
+                  long refine_iters=5, double atol=0., double rtol=0.,
+                  long block_rows=256, int n_jobs=1, scratch_dir=None,
+                  callback=None):
+    """
+    Coarse-to-fine Lloyd's algorithm for the pixels of a density image.
+
+    The image is block-summed by factors of 2 into ``levels`` coarser
+    images. Each coarse pixel is a point at the density-weighted centroid
+    of the fine pixels it covers, weighted by their summed density, so
+    coarse centroids are exact for the pixels they cover. Lloyd's algorithm
+    runs to convergence (or ``max_iters``) on the coarsest image, and the
+    nodes are then refined with at most ``refine_iters`` iterations on each
+    finer image, up to the full-resolution image. A last pass assigns every
+    finite pixel to its node.
+
+    Every level is streamed in strips of rows: pixel coordinates are made
+    strip by strip, and each iteration only keeps the per-node sums, so
+    no full-resolution coordinate array is ever made. Beyond the input
+    image and one strip, memory use is the coarse images while iterating
+    (three float64 images per level, 8 bytes per full-resolution pixel
+    over all levels), and then the membership (a C int per finite pixel,
+    which can be memory-mapped with ``scratch_dir``).
+
+    Parameters
+    ----------
+    density : ndarray
+        2D density image (which may be a memory map). Pixels that are not
+        finite are left out. Pixel ``(i, j)`` is the point ``(j, i)``.
+    node_xy : (n_nodes, 2) ndarray
+        Coordinates of the initial nodes, in full-resolution pixels.
+    levels : int
+        Number of block-summed levels above the full-resolution image.
+    max_iters : int
+        Maximum number of iterations on the coarsest level.
+    refine_iters : int
+        Maximum number of iterations on each finer level.
+    atol, rtol : float
+        A level stops early once the largest node displacement of an
+        iteration is at most ``atol + rtol`` times that of its first
+        iteration.
+    block_rows : int
+        Number of image rows per strip.
+    n_jobs : int
+        Number of threads for the KD-tree queries (``-1`` uses all
+        processors).
+    scratch_dir : str
+        If set, the membership is a memory-mapped temporary file in this
+        directory.
+    callback : callable
+        If given, called after every iteration with a dict of statistics:
+        ``level`` (0 for full resolution), ``iteration`` (from 0 on each
+        level), ``n_points`` (of the level), ``delta`` (the summed squared
+        node displacement), ``max_shift`` (the largest node displacement)
+        and ``time`` in seconds.
+
+    Returns
+    -------
+    node_xy : (n_nodes, 2) ndarray
+        Coordinates of the Voronoi nodes.
+    idx : ndarray
+        Index of the node of each finite pixel, in row-major order, as C
+        ints unless there are too many nodes.
+    node_weights : (n_nodes,) ndarray
+        Summed density of the pixels of each node.
+    converged : bool
+        ``True`` if the full-resolution level converged within its
+        iterations.
+    """
+    cdef long level, it, n_iters, n_points
+    cdef double delta, max_shift, first_shift
+    pyramid = _density_pyramid(density, levels, block_rows)
+    nodes = np.array(node_xy, dtype=float)
+    n_nodes = nodes.shape[0]
+    converged = False
+    for level in range(levels, -1, -1):
+        n_iters = max_iters if level == levels else refine_iters
+        converged = False
+        for it in range(n_iters):
+            t0 = time.time()
+            index = SpatialIndex(nodes)
+            sums = np.zeros((3, n_nodes), dtype=float)
+            n_points = 0
+            for x, y, w in _level_strips(density, pyramid, level,
+                                         block_rows):
+                nearest = index.query((x, y), n_jobs=n_jobs)
+                sums[0] += np.bincount(nearest, weights=w, minlength=n_nodes)
+                sums[1] += np.bincount(nearest, weights=w * x,
+                                       minlength=n_nodes)
+                sums[2] += np.bincount(nearest, weights=w * y,
+                                       minlength=n_nodes)
+                n_points += len(w)
+            # Nodes without weight stay where they are
+            moved = np.flatnonzero(sums[0] != 0.)
+            new_nodes = nodes.copy()
+            new_nodes[moved, 0] = sums[1, moved] / sums[0, moved]
+            new_nodes[moved, 1] = sums[2, moved] / sums[0, moved]
+            shift2 = np.sum((new_nodes - nodes) ** 2, axis=1)
+            nodes = new_nodes
+            delta = np.sum(shift2)
+            max_shift = np.sqrt(np.max(shift2)) if n_nodes else 0.
+            if it == 0:
+                first_shift = max_shift
+            log.debug("Pyramid CVT level %d iteration %03d delta %.2e",
+                      level, it, delta)
+            if callback is not None:
+                callback({'level': level,
+                          'iteration': it,
+                          'n_points': n_points,
+                          'delta': delta,
+                          'max_shift': max_shift,
+                          'time': time.time() - t0})
+            if max_shift <= atol + rtol * first_shift:
+                converged = True
+                break
+        del pyramid[level:]  # coarser images are no longer needed
+    idx, node_weights = _assign_pixels(density, nodes, block_rows, n_jobs,
+                                       scratch_dir)
+    return nodes, idx, node_weights, converged
+
+
+def _density_pyramid(density, long levels, long block_rows):
+    """Block-summed images of the density, and of the density times the
+    x and y pixel coordinates, by factors of 2 up to ``2 ** levels``.
+
+    Returns a list whose item ``k`` is the ``(mass, mx, my)`` images of
+    level ``k`` (item 0 is a placeholder for the full-resolution image,
+    which is streamed from ``density`` itself).
+    """
+    cdef long r0, r1
+    nrows, ncols = density.shape
+    pyramid = [None]
+    if levels < 1:
+        return pyramid
+    # Level 1 is summed strip by strip from the full-resolution image;
+    # strips hold an even number of rows
+    block_rows += block_rows % 2
+    shape = ((nrows + 1) // 2, (ncols + 1) // 2)
+    mass = np.zeros(shape, dtype=float)
+    mx = np.zeros(shape, dtype=float)
+    my = np.zeros(shape, dtype=float)
+    cols = np.arange(ncols, dtype=float)
+    for r0 in xrange(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        d = np.array(density[r0:r1], dtype=float)
+        d[~np.isfinite(d)] = 0.
+        rows = np.arange(r0, r1, dtype=float)[:, None]
+        mass[r0 // 2:(r1 + 1) // 2] = _sum_2x2(d)
+        mx[r0 // 2:(r1 + 1) // 2] = _sum_2x2(d * cols)
+        my[r0 // 2:(r1 + 1) // 2] = _sum_2x2(d * rows)
+    pyramid.append((mass, mx, my))
+    for level in range(2, levels + 1):
+        pyramid.append(tuple(_sum_2x2(a) for a in pyramid[level - 1]))
+    return pyramid
+
+
+def _sum_2x2(a):
+    """Sum of each 2x2 block of ``a``, padding odd edges with zeros."""
+    nrows, ncols = a.shape
+    if nrows % 2 or ncols % 2:
+        a = np.pad(a, ((0, nrows % 2), (0, ncols % 2)), 'constant')
+    return a.reshape(a.shape[0] // 2, 2, a.shape[1] // 2, 2).sum(axis=(1, 3))
+
+
+def _level_strips(density, pyramid, long level, long block_rows):
+    """Yield the ``(x, y, weight)`` of the points of a pyramid level, a
+    strip of rows at a time."""
+    cdef long r0, r1
+    if level == 0:
+        for r0 in xrange(0, density.shape[0], block_rows):
+            r1 = min(r0 + block_rows, density.shape[0])
+            d = np.asarray(density[r0:r1], dtype=float)
+            rows, cols = np.nonzero(np.isfinite(d))
+            yield (cols.astype(float), (rows + r0).astype(float),
+                   d[rows, cols])
+    else:
+        mass, mx, my = pyramid[level]
+        for r0 in xrange(0, mass.shape[0], block_rows):
+            r1 = min(r0 + block_rows, mass.shape[0])
+            m = mass[r0:r1]
+            good = m != 0.
+            w = m[good]
+            yield mx[r0:r1][good] / w, my[r0:r1][good] / w, w
+
+
+def _assign_pixels(density, nodes, long block_rows, int n_jobs, scratch_dir):
+    """Node index of each finite pixel, in row-major order, and the summed
+    density of each node."""
+    cdef long start = 0
+    cdef long r0
+    n_good = 0
+    for r0 in xrange(0, density.shape[0], block_rows):
+        n_good += np.count_nonzero(np.isfinite(density[r0:r0 + block_rows]))
+    if len(nodes) <= np.iinfo(np.intc).max:
+        idx = scratch_array(n_good, np.intc, scratch_dir)
+    else:
+        idx = scratch_array(n_good, int, scratch_dir)
+    node_weights = np.zeros(len(nodes), dtype=float)
+    index = SpatialIndex(nodes)
+    for x, y, w in _level_strips(density, None, 0, block_rows):
+        nearest = idx[start:start + len(w)]
+        index.query((x, y), n_jobs=n_jobs, out=nearest)
+        node_weights += np.bincount(nearest, weights=w,
+                                    minlength=len(nodes))
+        start += len(w)
+    return idx, node_weights
+
+
+def _reassign_bounded(index, x, y, idx, upper, lower, shift, long j_max,
+                      double max_shift, double next_shift, stale,
+                      long chunk_size, int n_jobs, int n_threads):
+    """Update the distance bounds of each point after the nodes moved, and
+    re-assign the points whose bounds no longer rule out a closer node.
+
+    Returns the number of points queried for their nearest nodes and the
+    number that changed cell.
+    """
+    cdef long start, stop, n_stale
+    cdef long n_queried = 0
+    cdef long n_reassigned = 0
+    nodes = index.nodes
+    # Half the distance from each node to its nearest other node: a point
+    # closer than this to its node cannot be closer to any other node
+    half_sep = 0.5 * index.nearest(nodes, k=2)[0][:, 1]
+    for start in xrange(0, x.shape[0], chunk_size):
+        stop = min(start + chunk_size, x.shape[0])
+        chunk_stale = stale[:stop - start]
+        n_stale = _check_bounds(x[start:stop], y[start:stop], idx[start:stop],
+                                upper[start:stop], lower[start:stop], nodes,
+                                shift, half_sep, j_max, max_shift,
+                                next_shift, chunk_stale, n_threads)
+        if n_stale == 0:
+            continue
+        pts = np.flatnonzero(chunk_stale) + start
+        dist, nearest = index.nearest((x[pts], y[pts]), k=2, n_jobs=n_jobs)
+        n_reassigned += np.count_nonzero(nearest[:, 0] != idx[pts])
+        idx[pts] = nearest[:, 0]
+        upper[pts] = dist[:, 0]
+        lower[pts] = dist[:, 1]
+        n_queried += n_stale
+    return n_queried, n_reassigned
+
+
+def _check_bounds(const coord_t [:] x, const coord_t [:] y,
+                  const long [:] idx, double [:] upper, double [:] lower,
+                  const double [:, :] node_xy, const double [:] shift,
+                  const double [:] half_sep, long j_max, double max_shift,
+                  double next_shift, unsigned char [:] stale, int n_threads):
+    """Move the distance bounds of each point by the node shifts, and flag
+    (in ``stale``) the points that may have changed cell, returning their
+    number.
+
+    A point whose upper bound is not below its lower bound, nor below half
+    its node's separation from the others, has the upper bound tightened
+    to the exact distance to its node before it is flagged.
+    """
+    cdef long i, j
+    cdef long n_stale = 0
+    cdef double bound, dx, dy
+    with nogil:
+        for i in prange(x.shape[0], schedule='static',
+                        num_threads=n_threads):
+            j = idx[i]
+            upper[i] = upper[i] + shift[j]
+            if j == j_max:
+                lower[i] = lower[i] - next_shift
+            else:
+                lower[i] = lower[i] - max_shift
+            bound = max(lower[i], half_sep[j])
+            stale[i] = 0
+            if upper[i] > bound:
+                dx = x[i] - node_xy[j, 0]
+                dy = y[i] - node_xy[j, 1]
+                upper[i] = sqrt(dx * dx + dy * dy)
+                if upper[i] > bound:
+                    stale[i] = 1
+                    n_stale += 1
+    return n_stale
+
+
+def _replace(long [:] idx, const long [:] new_idx):
+    """Copy ``new_idx`` into ``idx``, returning the number of entries that
+    changed."""
+    cdef long i
+    cdef long n_changed = 0
+    with nogil:
+        for i in range(idx.shape[0]):
+            if idx[i] != new_idx[i]:
+                n_changed += 1
+                idx[i] = new_idx[i]
+    return n_changed
+
+
+def _update_nodes(const coord_t [:] x, const coord_t [:] y,
+                  const double [:] w, const long [:] idx,
+                  double [:, :] node_xy, double [:, :, :] partial_sums,
+                  int n_threads):
+    """Move each node to the weighted centroid of its points (or to the
+    origin if they have no weight).
+
+    The points are split statically among ``n_threads`` threads, each of
+    which adds the weight and weighted coordinates of its points into its
+    own slice of ``partial_sums``; the slices are then added up per node.
+    """
+    cdef long i, j, t
+    cdef long n_points = x.shape[0]
+    cdef long n_nodes = node_xy.shape[0]
+    cdef double sum_w, sum_wx, sum_wy
+    partial_sums[:, :, :] = 0.
+    with nogil, parallel(num_threads=n_threads):
+        t = threadid()
+        for i in prange(n_points, schedule='static'):
+            j = idx[i]
+            partial_sums[t, j, 0] += w[i]
+            partial_sums[t, j, 1] += w[i] * x[i]
+            partial_sums[t, j, 2] += w[i] * y[i]
+    with nogil:
+        for j in prange(n_nodes, schedule='static', num_threads=n_threads):
+            sum_w = 0.
+            sum_wx = 0.
+            sum_wy = 0.
+            for t in range(n_threads):
+                sum_w = sum_w + partial_sums[t, j, 0]
+                sum_wx = sum_wx + partial_sums[t, j, 1]
+                sum_wy = sum_wy + partial_sums[t, j, 2]
+            if sum_w > 0.:
+                node_xy[j, 0] = sum_wx / sum_w
+                node_xy[j, 1] = sum_wy / sum_w
+            else:
+                # Empty node
+                node_xy[j, 0] = 0.
+                node_xy[j, 1] = 0.
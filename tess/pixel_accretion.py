@@ -4,15 +4,150 @@
 Pixel accretion methods for segmenting images.
 """
 
-# import scipy.spatial.cKDTree as KDTree
-import scipy.spatial.kdtree as kdtree
+from scipy import ndimage
 from heapq import heappop, heapify, heappush
 
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
 import numpy as np
 
+from pixel_core import PixelEngine, IsoIntensityCriterion, EqualSNCriterion
+from pixel_core import BinShape
+from spatial_index import SpatialIndex
+
 import logging
 log = logging.getLogger(__name__)
 
+# Approximate number of pixels per block of rows in whole-image passes
+BLOCK_PIXELS = 2 ** 20
+
+# (row, column) offsets of the neighbours of a pixel, by connectivity
+_NEIGHBOUR_OFFSETS = {
+    4: ((1, 0), (-1, 0), (0, 1), (0, -1)),
+    8: ((1, 0), (-1, 0), (0, 1), (0, -1),
+        (1, 1), (1, -1), (-1, 1), (-1, -1))}
+
+
+class PixelFrontier(object):
+    """Priority queue of the edge pixels of a bin being accreted.
+
+    Entries are versioned ``(quality, idx, version)`` tuples in a heap, and
+    the queue maps each live pixel to its current entry. Rescoring a pixel
+    pushes a new entry; the old one becomes stale and is discarded when it
+    reaches the top of the heap. Pixels are popped in order of quality, then
+    pixel index.
+
+    Parameters
+    ----------
+    max_stale_frac : float
+        The heap is rebuilt from the live entries once stale entries
+        outnumber live entries by this factor.
+    """
+    def __init__(self, max_stale_frac=2.):
+        super(PixelFrontier, self).__init__()
+        self.max_stale_frac = max_stale_frac
+        self._heap = []
+        self._live = {}  # pixel index -> live heap entry
+        self._version = 0
+        self.max_size = 0
+        self.n_pushes = 0
+        self.n_rescores = 0
+        self.n_rebuilds = 0
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, idx):
+        return idx in self._live
+
+    @property
+    def stats(self):
+        """Profiling counters (see :attr:`PixelAccretor.frontier_stats`)."""
+        return {'max_size': self.max_size, 'n_pushes': self.n_pushes,
+                'n_rescores': self.n_rescores, 'n_rebuilds': self.n_rebuilds}
+
+    def clear(self):
+        """Remove all pixels (counters are kept)."""
+        self._heap = []
+        self._live = {}
+
+    def indices(self):
+        """List of pixels in the frontier."""
+        return list(self._live)
+
+    def _push(self, idx, quality):
+        self._version += 1
+        entry = (quality, idx, self._version)
+        self._live[idx] = entry
+        heappush(self._heap, entry)
+
+    def push(self, idx, quality):
+        """Add pixel ``idx`` to the frontier with the given quality, or
+        rescore it if it is already in the frontier."""
+        if idx in self._live:
+            self.rescore(idx, quality)
+            return
+        self._push(idx, quality)
+        self.n_pushes += 1
+        if len(self._live) > self.max_size:
+            self.max_size = len(self._live)
+
+    def rescore(self, idx, quality):
+        """Change the quality of a pixel already in the frontier."""
+        self.n_rescores += 1
+        if self._live[idx][0] != quality:
+            self._push(idx, quality)
+            self._compact()
+
+    def rescore_many(self, indices, qualities):
+        """Rescore many frontier pixels from an array of qualities.
+
+        Only pixels whose quality changed are pushed again; if most pixels
+        changed the heap is rebuilt instead.
+
+        Parameters
+        ----------
+        indices : list
+            Pixels in the frontier.
+        qualities : ndarray
+            New quality of each pixel.
+        """
+        self.n_rescores += len(indices)
+        live = self._live
+        changed = [(q, idx) for idx, q in zip(indices, qualities)
+                   if live[idx][0] != q]
+        if len(changed) < len(live) // 4:
+            for q, idx in changed:
+                self._push(idx, q)
+            self._compact()
+        else:
+            for q, idx in changed:
+                self._version += 1
+                live[idx] = (q, idx, self._version)
+            self._rebuild()
+
+    def _compact(self):
+        """Rebuild the heap if it holds too many stale entries."""
+        if len(self._heap) > (1. + self.max_stale_frac) * len(self._live) \
+                + 64:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Rebuild the heap from the live entries, dropping stale ones."""
+        self._heap = list(self._live.values())
+        heapify(self._heap)
+        self.n_rebuilds += 1
+
+    def pop(self):
+        """Remove and return ``(quality, idx)`` of the best pixel."""
+        while True:
+            entry = heappop(self._heap)
+            idx = entry[1]
+            if self._live.get(idx) is entry:
+                del self._live[idx]
+                return entry[0], idx
+
 
 class PixelAccretor(object):
     """Baseclass for pixel accretion.
@@ -36,144 +171,440 @@ class PixelAccretor(object):
 
     See :class:`tess.pixel_accretion.IsoIntensityAccretor`
     and :class:`tess.pixel_accretion.EqualSNAccretor` for examples.
+
+    Images may be :class:`numpy.memmap` arrays (or other buffer-protocol
+    objects); C-contiguous ``float64`` images are accreted in place, without
+    being copied.
+
+    Parameters
+    ----------
+    image : ndarray
+        The image to be segmented.
+    ij0 : tuple
+        Pixel coordinate to begin accretion from. By default the brightest
+        image pixel is used.
+    seeding : str
+        How islands of pixels (surrounded by NaNs) are seeded, either
+        ``'sorted'`` (the brightest unbinned pixel, found with a cursor over
+        pixels sorted once by intensity) or ``'components'`` (islands are
+        labeled up front, and seeded at their brightest pixel).
+    tile_shape : tuple
+        If set, the image is cut into tiles of this ``(rows, cols)`` shape
+        that are accreted independently (in parallel if ``n_workers > 1``);
+        bins that straddle the tile seams are then re-accreted serially.
+        ``ij0`` is ignored in tiled mode.
+    tile_overlap : int
+        Number of pixels each tile is extended by on every side, so that
+        bins near the seams can be completed within a single tile.
+    n_workers : int
+        Number of worker processes for tiled accretion.
+    segmap : ndarray
+        Optional C-contiguous ``int32`` or ``int64`` array (which may be a
+        :class:`numpy.memmap`) of the image's shape that the segmentation
+        map is written into, instead of allocating a new one.
+    segmap_dtype : dtype
+        Integer type of the segmentation map allocated when ``segmap`` is not
+        given; ``numpy.int32`` halves its memory.
+    connectivity : int
+        Pixels are accreted from their 4 edge-sharing neighbours (``4``), or
+        also from their diagonal neighbours (``8``).
+    max_elongation : float
+        If set, a bin is closed rather than accept a pixel that would make
+        it more elongated than this, in the manner of the roundness limit
+        of Cappellari & Copin (2003). The elongation is the axis ratio of
+        the bin's moment ellipse, with each pixel a unit square: the
+        variance of a unit square, 1/12, is added along both axes (see
+        :class:`tess.pixel_core.BinShape`). The point accretors of
+        :mod:`tess.point_accretion` add the variance of a square cell of an
+        equal share of the bin's area instead, estimated from the spread of
+        its points, so the same limit is close but not identical for
+        points and pixels. The limit only applies to bins of three or more
+        pixels: a bin's second pixel is always accepted, and a two-pixel
+        bin has an elongation of 2 (or 2.6 for a diagonal pair). It is
+        checked in O(1) from running second moments. See also
+        :attr:`bin_elongation`.
     """
-    def __init__(self, image, ij0=None):
+    def __init__(self, image, ij0=None, seeding='sorted', tile_shape=None,
+                 tile_overlap=32, n_workers=1, segmap=None, segmap_dtype=int,
+                 connectivity=4, max_elongation=None):
         super(PixelAccretor, self).__init__()
-        self.image = image
-        self._seg_image = -1 * np.ones(self.image.shape, dtype=int)
-        if ij0 is None:
-            ij0 = self._max_start_point()
+        self.image = np.asanyarray(image)
+        self.seeding = seeding
+        self.tile_shape = tile_shape
+        self.max_elongation = max_elongation
+        if connectivity not in _NEIGHBOUR_OFFSETS:
+            raise ValueError("connectivity must be 4 or 8, not "
+                             "{0!r}".format(connectivity))
+        self.connectivity = connectivity
+        self._neighbour_offsets = _NEIGHBOUR_OFFSETS[connectivity]
+        self._seg_image = self._init_segmap(segmap, segmap_dtype)
+        self._stats_cache = {}  # per-bin statistics of the current segmap
+        # Pixels that can be binned, tested once for the whole image
+        self._valid = self._valid_pixels()
+        self._criterion = self._compiled_criterion()
         n_bins = 0
-        while True:
-            n_bins = self._accrete(ij0, start_index=n_bins)
-            unbinned = np.where(self._seg_image == -1)
-            if len(unbinned[0]) == 0:
-                break
-            else:
-                ij0 = self._max_start_point()
+        if tile_shape is not None:
+            n_bins = self._accrete_tiles(tile_shape, tile_overlap, n_workers)
+            ij0 = None
+        if self._criterion is not None:
+            self._accrete_compiled(ij0, n_bins)
+        else:
+            self._accrete_python(ij0, n_bins)
+        self._accretion_finished()
+
+    def _init_segmap(self, segmap, dtype):
+        """Validate (or allocate) the segmentation map and mark every pixel
+        as unbinned."""
+        if segmap is None:
+            segmap = np.empty(self.image.shape, dtype=dtype)
+        if segmap.shape != self.image.shape:
+            raise ValueError("segmap shape {0} does not match image shape "
+                             "{1}".format(segmap.shape, self.image.shape))
+        if segmap.dtype.kind != 'i' or segmap.dtype.itemsize not in (4, 8):
+            raise ValueError("segmap must be int32 or int64, not "
+                             "{0}".format(segmap.dtype))
+        if not segmap.flags.c_contiguous:
+            raise ValueError("segmap must be C-contiguous")
+        segmap.fill(-1)
+        return segmap
 
-    def _max_start_point(self):
-        """Index of largest pixel to use as a default start point.
+    def _accrete_python(self, ij0, n_bins):
+        """Run the accretion with the pure-Python accretion hooks."""
+        self.frontier = PixelFrontier()
+        self._shape = BinShape()  # moments of the current bin
+        if ij0 is not None:
+            n_bins = self._accrete(tuple(int(i) for i in ij0),
+                                   start_index=n_bins)
+        # Seed the islands of unbinned pixels (surrounded by NaNs)
+        segmap = self._seg_image.ravel()
+        ncols = self.image.shape[1]
+        for seed in self._seed_order():
+            if segmap[seed] == -1:
+                ij0 = (int(seed // ncols), int(seed % ncols))
+                n_bins = self._accrete(ij0, start_index=n_bins)
 
-        Unbinned pixels are ignored, allowing this method ot be used to seed
-        explorations of islands of unbinned pixels (that are surrounded by
-        NaNs).
+    def _accretion_finished(self):
+        """Called once all pixels are binned. Subclasses can override this
+        to collect per-bin results."""
+        pass
+
+    def _compiled_criterion(self):
+        """Build the :class:`tess.pixel_core.PixelCriterion` equivalent to
+        this accretor, or ``None`` to use the pure-Python accretion hooks.
+
+        Subclasses with a compiled criterion should return ``None`` if
+        :meth:`_hooks_overridden` is ``True``, so that further subclasses
+        that customize the hooks fall back to the pure-Python path.
         """
-        x, y = np.meshgrid(np.arange(self.image.shape[1], dtype=float),
-                           np.arange(self.image.shape[0], dtype=float))
-        unbinned = np.where(self._seg_image.flatten() == -1)
-        x = x.flatten()[unbinned]
-        y = y.flatten()[unbinned]
-        imax = np.argmax(self.image.flatten()[unbinned])
-        return y[imax], x[imax]
+        return None
+
+    def _hooks_overridden(self, cls):
+        """``True`` if a subclass of ``cls`` overrides any accretion hook."""
+        hooks = ('bin_started', 'candidate_quality', 'accept_pixel',
+                 'pixel_added', 'close_bin')
+        for klass in type(self).__mro__:
+            if klass is cls:
+                return False
+            for name in hooks:
+                if name in vars(klass):
+                    return True
+        return False
+
+    def _accrete_compiled(self, ij0, n_bins):
+        """Run the accretion with :class:`tess.pixel_core.PixelEngine`."""
+        nrows, ncols = self.image.shape
+        self._engine = engine = PixelEngine(self._criterion,
+                                            self._seg_image.ravel(),
+                                            nrows, ncols,
+                                            self._valid.view(np.uint8).ravel(),
+                                            self._neighbour_offsets,
+                                            self.max_elongation or 0.)
+        if ij0 is not None:
+            n_bins = engine.accrete(int(ij0[0]) * ncols + int(ij0[1]),
+                                    n_bins)
+        engine.accrete_seeds(self._seed_order(), n_bins)
+
+    def _valid_pixels(self):
+        """Boolean image of pixels that can be binned.
+
+        Subclasses whose ``candidate_quality`` rejects other pixels than
+        non-finite ones should override this.
+        """
+        return np.isfinite(self.image)
+
+    def _seed_order(self):
+        """Flat indices of pixels to seed new islands of bins from, in order.
+
+        Accretion continues from each seed until its island (a connected
+        region of valid pixels, surrounded by NaNs) is binned; seeds that
+        were binned meanwhile are skipped. With ``seeding='sorted'`` all valid
+        pixels are sorted by decreasing intensity once, so each island starts
+        at its brightest pixel. With ``seeding='components'`` the islands are
+        labeled up front and only the brightest pixel of each is returned.
+        """
+        valid = self._valid & (self._seg_image == -1)
+        # C int indices where they fit, halving the seed list
+        if self.image.size <= np.iinfo(np.intc).max:
+            index_dtype = np.intc
+        else:
+            index_dtype = np.int_
+        if self.seeding == 'sorted':
+            # Gather the intensities of the valid pixels a block at a time,
+            # back to front: sorting them ascending with a stable sort and
+            # reading the result backwards orders them by decreasing
+            # intensity, with ties starting at the first pixel as with argmax
+            n = np.count_nonzero(valid)
+            values = np.empty(n, dtype=self.image.dtype)
+            blocks = self._row_blocks()
+            end = n
+            for rows in blocks:
+                block = valid[rows].ravel()
+                k = np.count_nonzero(block)
+                values[end - k:end] = self.image[rows].ravel()[block][::-1]
+                end -= k
+            order = np.argsort(values, kind='mergesort')
+            del values
+            # Then their flat indices, also back to front
+            pixels = np.empty(n, dtype=index_dtype)
+            ncols = self.image.shape[1]
+            end = n
+            for rows in blocks:
+                block = valid[rows].ravel()
+                k = np.count_nonzero(block)
+                pixels[end - k:end] = (np.flatnonzero(block)
+                                       + rows.start * ncols)[::-1]
+                end -= k
+            del valid
+            return pixels[order[::-1]]
+        elif self.seeding == 'components':
+            structure = ndimage.generate_binary_structure(
+                2, 1 if self.connectivity == 4 else 2)
+            labels, n_islands = ndimage.label(valid, structure=structure)
+            del valid
+            # Brightest pixel of each island, found a block at a time since
+            # ndimage sorts all the labeled pixels it is given
+            peak_values = np.zeros(n_islands + 1)
+            seeds = np.zeros(n_islands + 1, dtype=index_dtype)
+            found = np.zeros(n_islands + 1, dtype=bool)
+            ncols = self.image.shape[1]
+            for rows in self._row_blocks():
+                block_labels = labels[rows]
+                index = np.unique(block_labels)
+                index = index[index > 0]
+                if len(index) == 0:
+                    continue
+                image = self.image[rows]
+                peaks = np.array(ndimage.maximum_position(
+                    image, block_labels, index)).reshape(-1, 2)
+                values = np.asarray(ndimage.maximum(image, block_labels,
+                                                    index), dtype=float)
+                # earlier blocks win ties, as with argmax
+                brighter = ~found[index] | (values > peak_values[index])
+                index = index[brighter]
+                found[index] = True
+                peak_values[index] = values[brighter]
+                seeds[index] = np.ravel_multi_index(peaks[brighter].T,
+                                                    image.shape) \
+                    + rows.start * ncols
+            order = np.argsort(-peak_values[1:], kind='mergesort')
+            return seeds[1:][order]
+        else:
+            raise ValueError("seeding must be 'sorted' or 'components', "
+                             "not {0!r}".format(self.seeding))
+
+    def _tile_images(self):
+        """Dict of the image-shaped constructor arguments of this accretor,
+        which are cut into tiles for :meth:`_accrete_tiles`."""
+        raise NotImplementedError(
+            "{0} does not support tiled accretion".format(
+                type(self).__name__))
+
+    def _tile_parameters(self):
+        """Dict of the other constructor arguments used to build an accretor
+        of the same class for each tile."""
+        raise NotImplementedError(
+            "{0} does not support tiled accretion".format(
+                type(self).__name__))
+
+    def _accrete_tiles(self, tile_shape, overlap, n_workers):
+        """Accrete overlapping tiles of the image in a process pool and merge
+        their bins into the segmap.
+
+        Each tile is extended by ``overlap`` pixels on every side. A tile's
+        bin is kept if its first pixel lies in the tile's core, it does not
+        touch a side of the extended tile that was cut from the image, and it
+        does not overlap a bin kept from an earlier tile. Pixels of discarded
+        bins along the tile seams are left unbinned, to be re-accreted
+        serially afterwards.
+
+        Returns
+        -------
+        n_bins : int
+            Number of bins kept; these are numbered contiguously from zero.
+        """
+        tiles = _make_tiles(self.image.shape, tile_shape, overlap)
+        images = self._tile_images()
+        names = sorted(images)
+        shared = [_to_shared(images[name]) for name in names]
+        # Shared buffer that receives the segmap of every extended tile
+        sizes = [(y1 - y0) * (x1 - x0)
+                 for (y0, y1, x0, x1), core in tiles]
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        results = RawArray('i', int(offsets[-1]))
+        tasks = [(type(self), self._tile_parameters(), names, extent,
+                  offsets[k]) for k, (extent, core) in enumerate(tiles)]
+        args = (shared, self.image.shape, results)
+        if n_workers == 1:
+            _init_tile_worker(*args)
+            for task in tasks:
+                _accrete_tile(task)
+        else:
+            pool = Pool(n_workers, initializer=_init_tile_worker,
+                        initargs=args)
+            try:
+                pool.map(_accrete_tile, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        results = np.frombuffer(results, dtype=np.intc)
+
+        n_bins = 0
+        nrows, ncols = self.image.shape
+        for k, ((y0, y1, x0, x1), (cy0, cy1, cx0, cx1)) in enumerate(tiles):
+            local = results[offsets[k]:offsets[k + 1]].reshape(
+                (y1 - y0, x1 - x0))
+            n_local = local.max() + 1
+            if n_local == 0:
+                continue
+            keep = np.ones(n_local, dtype=bool)
+            # Bins touching a cut side may be truncated
+            cut_sides = []
+            if y0 > 0:
+                cut_sides.append(local[0, :])
+            if y1 < nrows:
+                cut_sides.append(local[-1, :])
+            if x0 > 0:
+                cut_sides.append(local[:, 0])
+            if x1 < ncols:
+                cut_sides.append(local[:, -1])
+            for side in cut_sides:
+                keep[side[side >= 0]] = False
+            # Bins are owned by the tile whose core holds their first pixel
+            labels = local.ravel()
+            binned = np.flatnonzero(labels >= 0)
+            bin_ids, first = np.unique(labels[binned], return_index=True)
+            i, j = np.unravel_index(binned[first], local.shape)
+            owned = np.zeros(n_local, dtype=bool)
+            owned[bin_ids] = (i + y0 >= cy0) & (i + y0 < cy1) \
+                & (j + x0 >= cx0) & (j + x0 < cx1)
+            keep &= owned
+            # Drop bins overlapping bins kept from earlier tiles
+            segmap = self._seg_image[y0:y1, x0:x1]
+            conflicts = (local >= 0) & (segmap != -1)
+            keep[local[conflicts]] = False
+            # Relabel kept bins contiguously
+            lut = -np.ones(n_local, dtype=segmap.dtype)
+            lut[keep] = np.arange(n_bins, n_bins + keep.sum())
+            write = (local >= 0) & keep[np.maximum(local, 0)]
+            segmap[write] = lut[local[write]]
+            n_bins += keep.sum()
+        log.debug("Kept {0:d} bins from {1:d} tiles".format(n_bins,
+                                                            len(tiles)))
+        return n_bins
 
     def _accrete(self, ij0, start_index=0):
         """Run the pixel accretion algorithm, starting with pixel ij0.
 
         Parameters
         ----------
-        idx : tuple
+        ij0 : tuple
             Index of first pixel.
+        start_index : int
+            Bin number of the first bin.
+
+        Returns
+        -------
+        n_bins : int
+            The next unused bin number.
         """
-        # self.n_unbinned_pixels = self.image.shape[0] * self.image.shape[1]
-        self._global_edge_pixels = set([])
+        self._global_edge_pixels = []
         self._nrows, self._ncols = self.image.shape
         n_bins = start_index
-        while ij0:
+        while ij0 is not None:
             self._make_bin(ij0, n_bins)
             ij0 = self._new_start_point()
             n_bins += 1
-        return n_bins - 1
+        return n_bins
 
     def _make_bin(self, ij0, bin_index):
         """Make a new bin, starting with pixel ij0."""
         self.current_bin_indices = [ij0]
-        self.current_edge_heap = None
-        self.current_edge_dict = {}  # to keep index into heap
+        self.frontier.clear()
         self._seg_image[ij0] = bin_index
-        self._add_edges(ij0)
+        self._shape.start(*ij0)
         self.bin_started()  # call to subclass
-        while self.current_edge_heap:  # while there are edges
+        self._add_edges(ij0)
+        leftovers = []
+        while self.frontier:  # while there are edges
             # Select a new pixel to add
-            quality, ij0 = heappop(self.current_edge_heap)
-            if self.accept_pixel(ij0):
+            quality, ij0 = self.frontier.pop()
+            if self.accept_pixel(ij0) and self._round_enough(ij0):
                 # Add pixel
-                del self.current_edge_dict[ij0]
                 self.current_bin_indices.append(ij0)
                 self._seg_image[ij0] = bin_index
                 self._add_edges(ij0)
+                self._shape.add(*ij0)
                 self.pixel_added()  # call to subclass
             else:
                 # Reject pixel and stop accretion
+                leftovers.append(ij0)
                 log.debug("Finished bin {0:d} with {1:d} pixels".format(
                     bin_index, len(self.current_bin_indices)))
                 break
         self.close_bin()  # call to subclass
-        # Add remaining edges to the global edge list
-        leftovers = set(self.current_edge_dict.keys())
-        # Remove accreted points from global edges
-        self._global_edge_pixels -= set(self.current_bin_indices)
-        self._global_edge_pixels = self._global_edge_pixels.union(leftovers)
+        # Add remaining edges to the global edge list; sorted so that seeds
+        # are picked in the same order as in tess.pixel_core.PixelEngine
+        leftovers.extend(self.frontier.indices())
+        self._global_edge_pixels.extend(sorted(leftovers))
+
+    def _round_enough(self, idx):
+        """``True`` unless adding pixel ``idx`` would make the current bin
+        more elongated than ``max_elongation``."""
+        if not self.max_elongation or self._shape.n < 2:
+            return True
+        return self._shape.trial_elongation(*idx) <= self.max_elongation
 
     def _add_edges(self, ij0):
         """Add edges surrounding ij0 that aren't binned already. As edges are
         added, the super class is asked to make a scalar judgement of the
         desireability of this pixel."""
-        # Top neighbour
-        idx = (ij0[0] + 1, ij0[1])
-        if idx[0] < self._nrows and self._seg_image[idx] == -1:
-            if idx not in self.current_edge_dict:
-                quality = self.candidate_quality(idx)  # call to subclass
-                if quality is not None:
-                    v = (quality, idx)
-                    self.current_edge_dict[idx] = v
-                    if self.current_edge_heap:
-                        heappush(self.current_edge_heap, v)
-                    else:
-                        self.current_edge_heap = [v]
-                        heapify(self.current_edge_heap)
-
-        # Bottom neighbour
-        idx = (ij0[0] - 1, ij0[1])
-        if idx[0] >= 0 and self._seg_image[idx] == -1:
-            if idx not in self.current_edge_dict:
-                quality = self.candidate_quality(idx)  # call to subclass
-                if quality is not None:
-                    v = (quality, idx)
-                    self.current_edge_dict[idx] = v
-                    if self.current_edge_heap:
-                        heappush(self.current_edge_heap, v)
-                    else:
-                        self.current_edge_heap = [v]
-                        heapify(self.current_edge_heap)
-
-        # Right neighbour
-        idx = (ij0[0], ij0[1] + 1)
-        if idx[1] < self._ncols and self._seg_image[idx] == -1:
-            if idx not in self.current_edge_dict:
-                quality = self.candidate_quality(idx)  # call to subclass
-                if quality is not None:
-                    v = (quality, idx)
-                    self.current_edge_dict[idx] = v
-                    if self.current_edge_heap:
-                        heappush(self.current_edge_heap, v)
-                    else:
-                        self.current_edge_heap = [v]
-                        heapify(self.current_edge_heap)
-
-        # Left neighbour
-        idx = (ij0[0], ij0[1] - 1)
-        if idx[1] >= 0 and self._seg_image[idx] == -1:
-            if idx not in self.current_edge_dict:
-                quality = self.candidate_quality(idx)  # call to subclass
-                if quality is not None:
-                    v = (quality, idx)
-                    self.current_edge_dict[idx] = v
-                    if self.current_edge_heap:
-                        heappush(self.current_edge_heap, v)
-                    else:
-                        self.current_edge_heap = [v]
-                        heapify(self.current_edge_heap)
+        for di, dj in self._neighbour_offsets:
+            i = ij0[0] + di
+            j = ij0[1] + dj
+            if i < 0 or j < 0 or i >= self._nrows or j >= self._ncols:
+                continue
+            idx = (i, j)
+            if not self._valid[idx] or self._seg_image[idx] != -1 \
+                    or idx in self.frontier:
+                continue
+            quality = self.candidate_quality(idx)  # call to subclass
+            if quality is not None:
+                self.frontier.push(idx, quality)
+
+    def candidate_qualities(self, indices):
+        """Qualities of several candidate pixels at once, as an array.
+
+        Used by :meth:`update_edge_heap`. The default implementation calls
+        ``candidate_quality`` for each pixel; subclasses can override this
+        with a vectorized computation.
+
+        Parameters
+        ----------
+        indices : list
+            List of ``(i, j)`` pixel index tuples.
+        """
+        return np.array([self.candidate_quality(idx) for idx in indices],
+                        dtype=float)
 
     def update_edge_heap(self):
         """May be called by the subclass whenever the 'quality' values of edge
@@ -184,88 +615,255 @@ class PixelAccretor(object):
         this method infrequently will speed up the pixel accretion, but may
         cause suboptimal choices of pixels being accreted into bins.
         """
-        self.current_edge_heap = []
-        for idx, v in self.current_edge_dict.iteritems():
-            new_q = self.candidate_quality(idx)
-            new_v = (new_q, idx)
-            self.current_edge_dict[idx] = new_v
-            self.current_edge_heap.append(new_v)
-        heapify(self.current_edge_heap)
+        indices = self.frontier.indices()
+        if len(indices) == 0:
+            return
+        self.frontier.rescore_many(indices, self.candidate_qualities(indices))
+
+    @property
+    def frontier_stats(self):
+        """Frontier profiling counters, accumulated over all bins.
+
+        A dict with ``max_size`` (largest frontier of any bin), ``n_pushes``
+        (pixels entering a frontier), ``n_rescores`` (pixels whose quality was
+        recomputed) and ``n_rebuilds`` (full rebuilds of the frontier heap).
+        """
+        if self._criterion is not None:
+            return self._engine.stats
+        return self.frontier.stats
 
     def _new_start_point(self):
         """Suggest a new starting pixel for next bin.
 
-        This pixel comes from the pool of edge pixels.
+        This pixel comes from the pool of edge pixels; pixels that were
+        binned since becoming edge pixels are skipped.
         Returns ``None`` if no edge pixels are available.
         """
-        try:
+        while self._global_edge_pixels:
             ij_next = self._global_edge_pixels.pop()
-        except KeyError:
-            return None
-        return ij_next
+            if self._seg_image[ij_next] == -1:
+                return ij_next
+        return None
 
     @property
     def segmap(self):
         """The segmentation map, where pixels are labeled by bin number."""
         return self._seg_image
 
+    def _segmap_changed(self):
+        """Drop per-bin statistics cached for the current segmap.
+
+        Called by the methods that relabel the segmap; call it yourself after
+        editing :attr:`segmap` in place.
+        """
+        self._stats_cache = {}
+
+    def _cached(self, key, func):
+        """Per-bin statistic ``key``, computed by ``func`` once per
+        segmap."""
+        if key not in self._stats_cache:
+            self._stats_cache[key] = func()
+        return self._stats_cache[key]
+
+    def _row_blocks(self):
+        """Slices of rows of the image, of about ``BLOCK_PIXELS`` pixels
+        each."""
+        nrows, ncols = self.image.shape
+        step = max(1, BLOCK_PIXELS // max(ncols, 1))
+        return [slice(r0, min(r0 + step, nrows))
+                for r0 in xrange(0, nrows, step)]
+
+    def _binned_blocks(self):
+        """Yield the binned pixels of the segmap one block of rows at a time.
+
+        Each item is ``(rows, binned, labels, y, x)``: the slice of rows, a
+        boolean array of the binned pixels of those rows, and the bin
+        numbers and pixel coordinates of the binned pixels (in the order of
+        ``image[rows][binned]``). Per-bin statistics are accumulated over
+        the blocks, so whole-image passes only make block-sized temporaries.
+        """
+        for rows in self._row_blocks():
+            block = self._seg_image[rows]
+            binned = block >= 0
+            y, x = np.nonzero(binned)
+            yield rows, binned, block[binned], y + rows.start, x
+
+    def _bin_counts(self):
+        """Number of pixels in each bin, indexed by bin number."""
+        n = self._seg_image.max() + 1
+        count = np.zeros(n, dtype=int)
+        for rows, binned, labels, y, x in self._binned_blocks():
+            count += np.bincount(labels, minlength=n)
+        return count
+
+    def zonal_stats(self, image, weights=None):
+        """Statistics of an image within each bin, computed with
+        :func:`numpy.bincount` over blocks of rows of the segmap.
+
+        Only pixels that are binned and finite in ``image`` contribute.
+
+        Parameters
+        ----------
+        image : ndarray
+            Image (same shape as the segmap) to compute statistics of.
+        weights : ndarray
+            Optional weights (same shape as the segmap) for the bin centroids;
+            pixels with non-finite weights are ignored. By default pixels have
+            uniform weight.
+
+        Returns
+        -------
+        stats : dict
+            Arrays corresponding to the order of :attr:`bin_nums`: ``count``
+            (number of pixels), ``sum``, ``mean`` and ``var`` (population
+            variance) of the image, and ``x`` and ``y``, the weighted
+            centroid of each bin.
+        """
+        bin_nums = self.bin_nums
+        n = self._seg_image.max() + 1
+        count = np.zeros(n)
+        total = np.zeros(n)
+        for rows, binned, labels, values in self._zonal_blocks(image):
+            count += np.bincount(labels, minlength=n)
+            total += np.bincount(labels, weights=values, minlength=n)
+        # two-pass variance, for precision with large offsets
+        squares = np.zeros(n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            for rows, binned, labels, values in self._zonal_blocks(image):
+                dev = values - mean[labels]
+                squares += np.bincount(labels, weights=dev * dev,
+                                       minlength=n)
+            var = squares / count
+        xc, yc = self._weighted_centroids(weights)
+        return {'count': count[bin_nums].astype(int),
+                'sum': total[bin_nums],
+                'mean': mean[bin_nums],
+                'var': var[bin_nums],
+                'x': xc[bin_nums],
+                'y': yc[bin_nums]}
+
+    def _zonal_blocks(self, image):
+        """Yield ``(rows, binned, labels, values)`` for the pixels of each
+        block of rows that are binned and finite in ``image``."""
+        for rows, binned, labels, y, x in self._binned_blocks():
+            values = np.asarray(image[rows], dtype=float)[binned]
+            finite = np.isfinite(values)
+            yield rows, binned, labels[finite], values[finite]
+
+    def _weighted_centroids(self, weights=None):
+        """Weighted ``(x, y)`` centroid arrays, indexed by bin number; pixels
+        with non-finite weights are ignored.
+
+        ``weights`` is either an image, or a function returning the weights
+        of an array of flat pixel indices (or ``None`` for uniform weights).
+        The sums are accumulated one block of rows at a time.
+        """
+        n = self._seg_image.max() + 1
+        ncols = self._seg_image.shape[1]
+        sums = np.zeros((3, n))
+        for rows, binned, labels, y, x in self._binned_blocks():
+            if callable(weights):
+                w = weights(y * ncols + x)
+            elif weights is not None:
+                w = np.asarray(weights[rows], dtype=float)[binned]
+            if weights is None or w is None:
+                w = np.ones(len(labels))
+            else:
+                finite = np.isfinite(w)
+                labels, y, x, w = labels[finite], y[finite], x[finite], \
+                    w[finite]
+            sums[0] += np.bincount(labels, weights=w, minlength=n)
+            sums[1] += np.bincount(labels, weights=w * x, minlength=n)
+            sums[2] += np.bincount(labels, weights=w * y, minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xc = sums[1] / sums[0]
+            yc = sums[2] / sums[0]
+        return xc, yc
+
     @property
     def centroids(self):
-        """Bin centroids, as ``(x,y)`` pixel coordinates in a ``(2,n)`` array.
+        """Bin centroids, as ``(x,y)`` pixel coordinates in a ``(n,2)`` array.
         """
         # In this baseclass we compute centroids from first principles;
         # subclasses can opt to use their own cache or their own weighting
         # scheme instead.
-        n_bins = self._seg_image.max()
-        if hasattr(self, 'centroid_weightmap'):
-            weights = self.centroid_weightmap
-        else:
-            weights = np.ones(self._seg_image.shape, dtype=np.float)
-        centroids = np.nan * np.empty((n_bins, 2), dtype=np.float)
-        for i, bin_num in enumerate(xrange(n_bins)):
-            pixels = np.where(self._seg_image == bin_num)
-            npix = len(pixels[0])
-            if npix == 0:
-                continue
-            w = weights[pixels].flatten()
-            finite_pix = np.where(np.isfinite(w))[0]
-            for j in (0, 1):
-                centroids[i, j] = np.average(pixels[j][finite_pix],
-                                             weights=w[finite_pix])
-        # Swarp to x, y coordinate order
-        temp = np.copy(centroids[:, 0])
-        centroids[:, 0] = centroids[:, 1]
-        centroids[:, 1] = temp
+        return self._cached('centroids', self._compute_centroids)
+
+    def _centroid_weights(self, pix):
+        """Centroid weights of the flat pixel indices ``pix``, or ``None``
+        for uniform weights. Subclasses can override this to compute weights
+        only for the pixels needed, instead of a full ``centroid_weightmap``.
+        """
+        weightmap = getattr(self, 'centroid_weightmap', None)
+        if weightmap is None:
+            return None
+        return np.asarray(weightmap, dtype=float).ravel()[pix]
+
+    def _compute_centroids(self):
+        xc, yc = self._weighted_centroids(self._centroid_weights)
+        bin_nums = self.bin_nums
+        centroids = np.column_stack((xc[bin_nums], yc[bin_nums]))
         valid_centroids = np.where(np.isfinite(centroids[:, 0]))[0]
         return centroids[valid_centroids, :]
 
+    @property
+    def bin_elongation(self):
+        """Elongation of each bin (the axis ratio of its moment ellipse, as
+        limited by ``max_elongation``), in the order of :attr:`bin_nums`.
+        """
+        return self._cached('elongation', self._compute_elongation)
+
+    def _compute_elongation(self):
+        n = self._seg_image.max() + 1
+        count = self._bin_counts().astype(float)
+        xc, yc = self._weighted_centroids()
+        # two-pass moments about the bin centroids, with each pixel a unit
+        # square
+        moments = np.zeros((3, n))
+        for rows, binned, labels, y, x in self._binned_blocks():
+            dy = y - yc[labels]
+            dx = x - xc[labels]
+            moments[0] += np.bincount(labels, weights=dy * dy, minlength=n)
+            moments[1] += np.bincount(labels, weights=dx * dx, minlength=n)
+            moments[2] += np.bincount(labels, weights=dx * dy, minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cyy = moments[0] / count + 1. / 12.
+            cxx = moments[1] / count + 1. / 12.
+            cxy = moments[2] / count
+        half_trace = 0.5 * (cyy + cxx)
+        root = np.hypot(0.5 * (cyy - cxx), cxy)
+        elongation = np.sqrt((half_trace + root)
+                             / np.maximum(half_trace - root, 1. / 12.))
+        return elongation[self.bin_nums]
+
     @property
     def bin_nums(self):
         """Bin numbers in the segmentation map; corresponds to order of
         the ``centroids`` attribute.
         """
-        if self._bin_nums is None:
-            n_bins = self._seg_image.max()
-            bin_nums = []
-            for i, bin_num in enumerate(xrange(n_bins)):
-                pixels = np.where(self._seg_image == bin_num)
-                npix = len(pixels[0])
-                if npix == 0:
-                    continue
-                else:
-                    bin_nums.append(bin_num)
-            self._bin_nums = np.array(bin_nums)
-        return self._bin_nums
+        return self._cached('bin_nums',
+                            lambda: np.flatnonzero(self._bin_counts()))
 
     def blank_bad_bins(self):
         """Instead of re-assigning pixels from bad bins, just remove them
         from the segmap
         """
         self._valid_bins = np.array(self._valid_bins, dtype=np.bool)
-        failed_bins = np.where(self._valid_bins == False)[0]  # NOQA
-        for bin_index in failed_bins:
-            bad_pix = np.where(self._seg_image == bin_index)
-            self._seg_image[bad_pix] = -1
+        self._seg_image.ravel()[self._failed_pixels()] = -1
+        self._segmap_changed()
+
+    def _failed_pixels(self):
+        """Flat indices of the pixels in bins that are not ``_valid_bins``,
+        found in one pass over the segmap with a lookup table of bin
+        numbers."""
+        labels = self._seg_image.ravel()
+        failed = np.zeros(max(labels.max() + 2, len(self._valid_bins) + 1),
+                          dtype=bool)
+        failed[:len(self._valid_bins)] = ~np.asarray(self._valid_bins,
+                                                     dtype=bool)
+        # label -1 (unbinned pixels) looks up the last, False, entry
+        return np.flatnonzero(failed[labels])
 
 
 class IsoIntensityAccretor(PixelAccretor):
@@ -293,27 +891,130 @@ class IsoIntensityAccretor(PixelAccretor):
     start : tuple
         Pixel coordinate to begin accretion from. By default the brightnest
         image pixel is used.
+    seeding : str
+        How islands of pixels (surrounded by NaNs) are seeded, either
+        ``'sorted'`` (the brightest unbinned pixel, found with a cursor over
+        pixels sorted once by intensity) or ``'components'`` (islands are
+        labeled up front, and seeded at their brightest pixel).
+    tile_shape : tuple
+        If set, the image is cut into tiles of this ``(rows, cols)`` shape
+        that are accreted independently (in parallel if ``n_workers > 1``);
+        bins that straddle the tile seams are then re-accreted serially.
+        ``start`` is ignored in tiled mode.
+    tile_overlap : int
+        Number of pixels each tile is extended by on every side, so that
+        bins near the seams can be completed within a single tile.
+    n_workers : int
+        Number of worker processes for tiled accretion.
+    segmap : ndarray
+        Optional C-contiguous ``int32`` or ``int64`` array (which may be a
+        :class:`numpy.memmap`) of the image's shape that the segmentation
+        map is written into, instead of allocating a new one.
+    segmap_dtype : dtype
+        Integer type of the segmentation map allocated when ``segmap`` is not
+        given; ``numpy.int32`` halves its memory.
+    connectivity : int
+        Pixels are accreted from their 4 edge-sharing neighbours (``4``), or
+        also from their diagonal neighbours (``8``).
+    max_elongation : float
+        If set, bins of three or more pixels are closed before they become
+        more elongated than this axis ratio, with each pixel a unit square;
+        see :class:`PixelAccretor`.
+    stable : bool
+        If ``True``, track the bin mean and variance with Welford's online
+        algorithm. This is slightly slower than the default running sums of
+        intensity and squared intensity, but does not lose precision on
+        images with a large DC offset relative to the intensity scatter.
+    compiled : bool
+        If ``True``, run the accretion with the compiled
+        :class:`tess.pixel_core.IsoIntensityCriterion`. Subclasses that
+        override the accretion hooks always use the pure-Python path.
     """
     def __init__(self, image, intensity_sigma_limit,
                  min_pixels=1, max_pixels=None, max_shift_frac=0.05,
-                 start=None):
+                 start=None, seeding='sorted', stable=False, compiled=True,
+                 tile_shape=None, tile_overlap=32, n_workers=1, segmap=None,
+                 segmap_dtype=int, connectivity=4, max_elongation=None):
         self.intensity_sigma_limit = intensity_sigma_limit
         self.min_pixels = min_pixels
         self.max_pixels = max_pixels
         self._bin_mean_intensity = None
         self._max_shift_frac = max_shift_frac
-        super(IsoIntensityAccretor, self).__init__(image, ij0=start)
+        self.stable = stable
+        # Running statistics of the current bin; _bin_m2 is either the sum
+        # of squared intensities, or (if stable) the Welford M2 statistic.
+        self._bin_count = 0
+        self._bin_sum = 0.
+        self._bin_m2 = 0.
+        self.compiled = compiled
+        super(IsoIntensityAccretor, self).__init__(
+            image, ij0=start, seeding=seeding, tile_shape=tile_shape,
+            tile_overlap=tile_overlap, n_workers=n_workers, segmap=segmap,
+            segmap_dtype=segmap_dtype, connectivity=connectivity,
+            max_elongation=max_elongation)
+
+    def _tile_images(self):
+        return {'image': self.image}
 
-    def _update_bin_mean_intensity(self):
-        """Compute self._bin_mean_intensity."""
-        mu = sum([self.image[idx] for idx in self.current_bin_indices]) \
-            / float(len(self.current_bin_indices))
-        self._bin_mean_intensity = mu
+    def _tile_parameters(self):
+        return {'intensity_sigma_limit': self.intensity_sigma_limit,
+                'min_pixels': self.min_pixels,
+                'max_pixels': self.max_pixels,
+                'max_shift_frac': self._max_shift_frac,
+                'seeding': self.seeding,
+                'stable': self.stable,
+                'compiled': self.compiled,
+                'connectivity': self.connectivity,
+                'max_elongation': self.max_elongation}
+
+    def _compiled_criterion(self):
+        """Compiled criterion for this accretor (or ``None``)."""
+        if not self.compiled or self._hooks_overridden(IsoIntensityAccretor):
+            return None
+        image = np.ascontiguousarray(self.image, dtype=float).ravel()
+        return IsoIntensityCriterion(image, self.image.shape[1],
+                                     self.intensity_sigma_limit,
+                                     min_pixels=self.min_pixels,
+                                     max_pixels=self.max_pixels or 0,
+                                     max_shift_frac=self._max_shift_frac,
+                                     stable=self.stable)
+
+    def _update_bin_mean_intensity(self, idx):
+        """Add pixel ``idx`` to the running statistics of the bin and
+        update self._bin_mean_intensity."""
+        v = float(self.image[idx])
+        self._bin_count += 1
+        if self.stable:
+            delta = v - self._bin_mean_intensity
+            self._bin_mean_intensity += delta / self._bin_count
+            self._bin_m2 += delta * (v - self._bin_mean_intensity)
+        else:
+            self._bin_sum += v
+            self._bin_m2 += v * v
+            self._bin_mean_intensity = self._bin_sum / self._bin_count
+
+    def _trial_std(self, idx):
+        """Standard deviation of bin intensities if pixel ``idx`` were
+        added, computed in O(1) from the running statistics."""
+        v = float(self.image[idx])
+        n = self._bin_count + 1
+        if self.stable:
+            delta = v - self._bin_mean_intensity
+            mean = self._bin_mean_intensity + delta / n
+            var = (self._bin_m2 + delta * (v - mean)) / n
+        else:
+            mean = (self._bin_sum + v) / n
+            var = (self._bin_m2 + v * v) / n - mean * mean
+        return np.sqrt(max(var, 0.))
 
     def bin_started(self):
         """Called by :class`PixelAccretor` baseclass when a new bin has been
         started (and a seed pixel has been added)."""
-        self._update_bin_mean_intensity()
+        self._bin_count = 0
+        self._bin_sum = 0.
+        self._bin_m2 = 0.
+        self._bin_mean_intensity = 0.
+        self._update_bin_mean_intensity(self.current_bin_indices[0])
         # Since this is the first time mean_shift_intensity is added,
         # hold onto the original value
         self._original_bin_mean_intensity = self._bin_mean_intensity
@@ -331,12 +1032,18 @@ class IsoIntensityAccretor(PixelAccretor):
         """
         if self._bin_mean_intensity is None:
             return 0.
-        elif not np.isfinite(self.image[idx[0], idx[1]]):
+        elif not self._valid[idx]:
             # this pixel is likely not finite, so ignore it
             return None
         else:
             return float(np.abs(self.image[idx] - self._bin_mean_intensity))
 
+    def candidate_qualities(self, indices):
+        """Vectorized :meth:`candidate_quality` for a list of finite
+        pixels."""
+        ii, jj = np.array(indices).T
+        return np.abs(self.image[ii, jj] - self._bin_mean_intensity)
+
     def accept_pixel(self, idx):
         """Test a pixel, return ``True`` if it should be added to the bin.
 
@@ -350,20 +1057,19 @@ class IsoIntensityAccretor(PixelAccretor):
             return True
         if self.max_pixels and npix >= self.max_pixels:
             return False
-        intensities = np.array([self.image[k] for k in
-                                self.current_bin_indices + [idx]])
-        if intensities.std() > self.intensity_sigma_limit:
+        if self._trial_std(idx) > self.intensity_sigma_limit:
             return False
         else:
             return True
 
     def pixel_added(self):
         """Called once a pixel has been added."""
-        self._update_bin_mean_intensity()
-        frac_diff = (self._original_bin_mean_intensity
-                     - self._bin_mean_intensity) \
-            / self._original_bin_mean_intensity
-        if np.abs(frac_diff) > self._max_shift_frac:
+        self._update_bin_mean_intensity(self.current_bin_indices[-1])
+        shift = self._original_bin_mean_intensity - self._bin_mean_intensity
+        # Any shift away from a zero mean counts as a large one
+        if shift != 0. and (self._original_bin_mean_intensity == 0.
+                            or abs(shift / self._original_bin_mean_intensity)
+                            > self._max_shift_frac):
             # Update the edge heap if the mean has shifted by more than 5%.
             self.update_edge_heap()
             # Update definition of original bin intensity
@@ -399,37 +1105,156 @@ class EqualSNAccretor(PixelAccretor):
     start : tuple
         Pixel coordinate to begin accretion from. By default the brightest
         image pixel is used.
+    seeding : str
+        How islands of pixels (surrounded by NaNs) are seeded, either
+        ``'sorted'`` (the brightest unbinned pixel, found with a cursor over
+        pixels sorted once by intensity) or ``'components'`` (islands are
+        labeled up front, and seeded at their brightest pixel).
+    max_centroid_shift : float
+        The edge pixels are only rescored once the bin centroid has moved
+        by more than this many pixels since they were last scored. The
+        default, ``0``, rescores whenever the centroid moves. Values of a
+        fraction of a pixel make the cost of building a bin roughly linear
+        in its size, at the cost of slightly less compact bins.
+    tile_shape : tuple
+        If set, the image is cut into tiles of this ``(rows, cols)`` shape
+        that are accreted independently (in parallel if ``n_workers > 1``);
+        bins that straddle the tile seams are then re-accreted serially.
+        ``start`` is ignored in tiled mode.
+    tile_overlap : int
+        Number of pixels each tile is extended by on every side, so that
+        bins near the seams can be completed within a single tile.
+    n_workers : int
+        Number of worker processes for tiled accretion.
+    segmap : ndarray
+        Optional C-contiguous ``int32`` or ``int64`` array (which may be a
+        :class:`numpy.memmap`) of the image's shape that the segmentation
+        map is written into, instead of allocating a new one.
+    segmap_dtype : dtype
+        Integer type of the segmentation map allocated when ``segmap`` is not
+        given; ``numpy.int32`` halves its memory.
+    connectivity : int
+        Pixels are accreted from their 4 edge-sharing neighbours (``4``), or
+        also from their diagonal neighbours (``8``).
+    max_elongation : float
+        If set, bins of three or more pixels are closed before they become
+        more elongated than this axis ratio, with each pixel a unit square;
+        see :class:`PixelAccretor`.
+    compiled : bool
+        If ``True``, run the accretion with the compiled
+        :class:`tess.pixel_core.EqualSNCriterion`. Subclasses that
+        override the accretion hooks always use the pure-Python path.
     """
     def __init__(self, image, noise_image, target_sn,
-                 min_pixels=1, max_pixels=None, start=None):
-        self.noise = noise_image
-        self.centroid_weightmap = (image / self.noise) ** 2.
+                 min_pixels=1, max_pixels=None, start=None, seeding='sorted',
+                 max_centroid_shift=0., compiled=True, tile_shape=None,
+                 tile_overlap=32, n_workers=1, segmap=None, segmap_dtype=int,
+                 connectivity=4, max_elongation=None):
+        self.noise = np.asanyarray(noise_image)
         assert image.shape[0] == self.noise.shape[0]
         assert image.shape[1] == self.noise.shape[1]
         self.target_sn = target_sn
         self.min_pixels = min_pixels
         self.max_pixels = max_pixels
+        self.max_centroid_shift = max_centroid_shift
         self._current_bin_sn = None
         self._current_bin_centroid = None
+        self._scored_bin_centroid = None  # centroid when edges were scored
         self._current_bin_centroids = []
         self._valid_bins = []  # array for each bin; True if S/N is met.
-        self._bin_sn = None
-        super(EqualSNAccretor, self).__init__(image, ij0=start)
-
-    def _update_bin(self):
-        """Compute the current S/N of the bin."""
-        signal = sum([self.image[idx] for idx in self.current_bin_indices])
-        var = sum([self.noise[idx] ** 2.
-                   for idx in self.current_bin_indices])
-        self._current_bin_sn = signal / np.sqrt(var)
-        x0 = np.mean([idx[1] for idx in self.current_bin_indices])
-        y0 = np.mean([idx[0] for idx in self.current_bin_indices])
-        self._current_bin_centroid = np.array([y0, x0])
+        self.compiled = compiled
+        super(EqualSNAccretor, self).__init__(
+            image, ij0=start, seeding=seeding, tile_shape=tile_shape,
+            tile_overlap=tile_overlap, n_workers=n_workers, segmap=segmap,
+            segmap_dtype=segmap_dtype, connectivity=connectivity,
+            max_elongation=max_elongation)
+
+    def _tile_images(self):
+        return {'image': self.image, 'noise_image': self.noise}
+
+    def _tile_parameters(self):
+        return {'target_sn': self.target_sn,
+                'min_pixels': self.min_pixels,
+                'max_pixels': self.max_pixels,
+                'seeding': self.seeding,
+                'max_centroid_shift': self.max_centroid_shift,
+                'compiled': self.compiled,
+                'connectivity': self.connectivity,
+                'max_elongation': self.max_elongation}
+
+    def _accretion_finished(self):
+        """Collect the S/N flag and centroid of each bin."""
+        if self.tile_shape is not None:
+            # Bins kept from the tiles were never closed by this accretor
+            self._valid_bins = list(self.bin_sn >= self.target_sn)
+            xc, yc = self._weighted_centroids()
+            self._current_bin_centroids = [np.array(c) for c in
+                                           zip(yc[self.bin_nums],
+                                               xc[self.bin_nums])]
+        elif self._criterion is not None:
+            self._valid_bins = list(self._criterion.valid_bins)
+            self._current_bin_centroids = [np.array(c) for c in
+                                           self._criterion.centroids]
+
+    def _compiled_criterion(self):
+        """Compiled criterion for this accretor (or ``None``)."""
+        if not self.compiled or self._hooks_overridden(EqualSNAccretor):
+            return None
+        image = np.ascontiguousarray(self.image, dtype=float).ravel()
+        noise = np.ascontiguousarray(self.noise, dtype=float).ravel()
+        return EqualSNCriterion(image, noise, self.image.shape[1],
+                                self.target_sn,
+                                min_pixels=self.min_pixels,
+                                max_pixels=self.max_pixels or 0,
+                                max_centroid_shift=self.max_centroid_shift)
+
+    @property
+    def centroid_weightmap(self):
+        """Weight of each pixel for bin centroids, ``(image / noise) ** 2``.
+
+        This is computed whenever it is accessed; the accretor itself only
+        computes the weights of the pixels it needs.
+        """
+        return (self.image / self.noise) ** 2.
+
+    def _centroid_weights(self, pix):
+        image = self.image.ravel()[pix]
+        noise = self.noise.ravel()[pix]
+        return (image / noise) ** 2.
+
+    def _valid_pixels(self):
+        """Boolean image of pixels with a finite S/N, which can be binned.
+
+        Computed in blocks of rows, so no full-size float temporary is made.
+        """
+        valid = np.empty(self.image.shape, dtype=bool)
+        for rows in self._row_blocks():
+            valid[rows] = np.isfinite(
+                (self.image[rows] / self.noise[rows]) ** 2.)
+        return valid
+
+    def _update_bin(self, idx):
+        """Add pixel ``idx`` to the running signal, variance and centroid
+        sums, and compute the current S/N and centroid of the bin."""
+        noise = float(self.noise[idx])
+        self._bin_signal += float(self.image[idx])
+        self._bin_variance += noise * noise
+        self._bin_sum_y += idx[0]
+        self._bin_sum_x += idx[1]
+        npix = len(self.current_bin_indices)
+        self._current_bin_sn = self._bin_signal / np.sqrt(self._bin_variance)
+        self._current_bin_centroid = np.array([self._bin_sum_y / npix,
+                                               self._bin_sum_x / npix])
 
     def bin_started(self):
         """Called by :class`PixelAccretor` baseclass when a new bin has been
         started (and a seed pixel has been added)."""
-        self._update_bin()
+        self._bin_signal = 0.
+        self._bin_variance = 0.
+        self._bin_sum_y = 0.
+        self._bin_sum_x = 0.
+        self._update_bin(self.current_bin_indices[0])
+        self._scored_bin_centroid = self._current_bin_centroid
         self._valid_bins.append(False)  # start off False
 
     def candidate_quality(self, idx):
@@ -445,12 +1270,19 @@ class EqualSNAccretor(PixelAccretor):
         """
         if self._current_bin_centroid is None:
             return 0.
-        elif not np.isfinite(self.centroid_weightmap[idx[0], idx[1]]):
+        elif not self._valid[idx]:
             # this pixel is likely not finite, so ignore it
             return None
         else:
             return float(np.sum((idx - self._current_bin_centroid) ** 2.))
 
+    def candidate_qualities(self, indices):
+        """Vectorized :meth:`candidate_quality` for a list of finite
+        pixels."""
+        ii, jj = np.array(indices).T
+        y0, x0 = self._current_bin_centroid
+        return (ii - y0) ** 2. + (jj - x0) ** 2.
+
     def accept_pixel(self, idx):
         """Test a pixel, return ``True`` if it should be added to the bin.
 
@@ -471,8 +1303,11 @@ class EqualSNAccretor(PixelAccretor):
 
     def pixel_added(self):
         """Called once a pixel has been added."""
-        self._update_bin()
-        self.update_edge_heap()
+        self._update_bin(self.current_bin_indices[-1])
+        dy, dx = self._current_bin_centroid - self._scored_bin_centroid
+        if dy * dy + dx * dx > self.max_centroid_shift ** 2.:
+            self.update_edge_heap()
+            self._scored_bin_centroid = self._current_bin_centroid
 
     def close_bin(self):
         """Called when the current bin is completed."""
@@ -482,36 +1317,147 @@ class EqualSNAccretor(PixelAccretor):
         self._current_bin_centroid = None
         self._current_bin_sn = None
 
-    def cleanup(self):
-        """Call after accretion; merges failed bins into neighbours"""
+    def cleanup(self, merge='nearest', n_jobs=1):
+        """Call after accretion; merges failed bins into neighbours
+
+        Parameters
+        ----------
+        merge : str
+            With ``'nearest'``, each pixel of a failed bin joins the good bin
+            with the nearest centroid. With ``'adjacent'``, each failed bin
+            is merged whole into the good bin it shares the longest boundary
+            with; failed bins that touch no good bin fall back to
+            ``'nearest'``.
+        n_jobs : int
+            Number of threads for the
+            :class:`tess.spatial_index.SpatialIndex` query (``-1`` uses all
+            processors).
+        """
+        if merge not in ('nearest', 'adjacent'):
+            raise ValueError("merge must be 'nearest' or 'adjacent', "
+                             "not {0!r}".format(merge))
         self._valid_bins = np.array(self._valid_bins, dtype=np.bool)
         self._current_bin_centroids = np.array(self._current_bin_centroids)
         good_bins = np.where(self._valid_bins == True)[0]  # NOQA
-        failed_bins = np.where(self._valid_bins == False)[0]  # NOQA
-        # build a kdtree of good bins
-        tree = kdtree.KDTree(self._current_bin_centroids[good_bins, :])
-        for i, failed_idx in enumerate(failed_bins):
-            # update the segmentation image
-            pix_idx = np.where(self._seg_image == failed_idx)
-            # self._seg_image[pix_idx] = -1
-            coords = np.vstack(pix_idx).T
-            dists, reassignment_indices = tree.query(coords)
-            self._seg_image[pix_idx] = good_bins[reassignment_indices]
+        labels = self._seg_image.ravel()
+        pix = self._failed_pixels()
+        if len(pix) == 0 or len(good_bins) == 0:
+            return
+        if merge == 'adjacent':
+            lut = self._adjacent_good_bins()
+            new_labels = lut[labels[pix]]
+            merged = new_labels >= 0
+            labels[pix[merged]] = new_labels[merged]
+            pix = pix[~merged]
+        if len(pix) > 0:
+            # one bulk query of the good bin centroids for all pixels
+            index = SpatialIndex(self._current_bin_centroids[good_bins, :])
+            coords = np.unravel_index(pix, self._seg_image.shape)
+            reassignment_indices = index.query(coords, n_jobs=n_jobs)
+            labels[pix] = good_bins[reassignment_indices]
+        self._segmap_changed()
+
+    def _adjacent_good_bins(self):
+        """Lookup table from bin number to the good bin sharing the longest
+        boundary (in 4-connected pixel pairs) with it, or ``-1``."""
+        segmap = self._seg_image
+        valid = self._valid_bins
+        pairs = [(segmap[1:, :], segmap[:-1, :]),
+                 (segmap[:, 1:], segmap[:, :-1])]
+        failed_side = []
+        good_side = []
+        for a, b in pairs + [(b, a) for a, b in pairs]:
+            a = a.ravel()
+            b = b.ravel()
+            touch = (a >= 0) & (b >= 0)
+            a = a[touch]
+            b = b[touch]
+            touch = ~valid[a] & valid[b]
+            failed_side.append(a[touch])
+            good_side.append(b[touch])
+        failed_side = np.concatenate(failed_side).astype(np.int64)
+        good_side = np.concatenate(good_side).astype(np.int64)
+        lut = -np.ones(len(valid), dtype=np.int64)
+        if len(failed_side) == 0:
+            return lut
+        # boundary length of each (failed, good) pair of bins
+        keys, lengths = np.unique(failed_side * len(valid) + good_side,
+                                  return_counts=True)
+        failed, good = keys // len(valid), keys % len(valid)
+        # for each failed bin, the longest boundary (lowest bin on ties)
+        order = np.lexsort((good, -lengths, failed))
+        failed, good = failed[order], good[order]
+        first = np.concatenate(([True], failed[1:] != failed[:-1]))
+        lut[failed[first]] = good[first]
+        return lut
 
     @property
     def bin_sn(self):
-        """S/N of each bin."""
-        if self._bin_sn is None:
-            self._bin_sn = []
-            max_bin = self._seg_image.max()
-            for bin_num in xrange(max_bin):
-                pixels = np.where(self._seg_image == bin_num)
-                npix = len(pixels[0])
-                if npix == 0:
-                    continue
-                # compute S/N of pixels
-                sn = np.sum(self.image[pixels].flatten()) \
-                    / np.sqrt(np.sum(self.noise[pixels] ** 2.))
-                self._bin_sn.append(sn)
-            self._bin_sn = np.array(self._bin_sn)
-        return self._bin_sn
+        """S/N of each bin; corresponds to order of the ``bin_nums``
+        attribute."""
+        return self._cached('bin_sn', self._compute_bin_sn)
+
+    def _compute_bin_sn(self):
+        n = self._seg_image.max() + 1
+        signal = np.zeros(n)
+        variance = np.zeros(n)
+        for rows, binned, labels, y, x in self._binned_blocks():
+            image = np.asarray(self.image[rows], dtype=float)[binned]
+            noise = np.asarray(self.noise[rows], dtype=float)[binned]
+            signal += np.bincount(labels, weights=image, minlength=n)
+            variance += np.bincount(labels, weights=noise ** 2., minlength=n)
+        bin_nums = self.bin_nums
+        return signal[bin_nums] / np.sqrt(variance[bin_nums])
+
+
+def _make_tiles(shape, tile_shape, overlap):
+    """List of ``(extent, core)`` tiles covering an image, where ``core`` is
+    the ``(y0, y1, x0, x1)`` range of a tile and ``extent`` is the same range
+    grown by ``overlap`` pixels on each side (within the image)."""
+    nrows, ncols = shape
+    tiles = []
+    for cy0 in xrange(0, nrows, tile_shape[0]):
+        cy1 = min(cy0 + tile_shape[0], nrows)
+        for cx0 in xrange(0, ncols, tile_shape[1]):
+            cx1 = min(cx0 + tile_shape[1], ncols)
+            extent = (max(cy0 - overlap, 0), min(cy1 + overlap, nrows),
+                      max(cx0 - overlap, 0), min(cx1 + overlap, ncols))
+            tiles.append((extent, (cy0, cy1, cx0, cx1)))
+    return tiles
+
+
+def _to_shared(image):
+    """Copy an image into a shared-memory ``float64`` buffer.
+
+    Memory-mapped images are returned as they are: forked workers share
+    their pages without a copy.
+    """
+    if isinstance(image, np.memmap):
+        return image
+    buf = RawArray('d', image.size)
+    np.frombuffer(buf, dtype=float)[:] = np.asarray(image, dtype=float).ravel()
+    return buf
+
+
+_tile_globals = {}
+
+
+def _init_tile_worker(shared, shape, results):
+    """Attach a tile worker to the shared input images and result buffer."""
+    _tile_globals['images'] = [
+        buf if isinstance(buf, np.ndarray)
+        else np.frombuffer(buf, dtype=float).reshape(shape)
+        for buf in shared]
+    _tile_globals['results'] = np.frombuffer(results, dtype=np.intc)
+
+
+def _accrete_tile(task):
+    """Accrete one extended tile and store its segmap in the shared result
+    buffer."""
+    cls, params, names, (y0, y1, x0, x1), offset = task
+    kwargs = dict(params, segmap_dtype=np.intc)
+    for name, image in zip(names, _tile_globals['images']):
+        kwargs[name] = image[y0:y1, x0:x1]
+    accretor = cls(**kwargs)
+    size = (y1 - y0) * (x1 - x0)
+    _tile_globals['results'][offset:offset + size] = accretor.segmap.ravel()
@@ -0,0 +1,686 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+Cython pixel accretion core.
+
+:class:`PixelEngine` runs the same frontier walk as
+:class:`tess.pixel_accretion.PixelAccretor`, but works on flat pixel indices
+with a native binary heap instead of index tuples, a dict and :mod:`heapq`.
+Accretion criteria are compiled subclasses of :class:`PixelCriterion`; the
+built-in :class:`IsoIntensityCriterion` and :class:`EqualSNCriterion` mirror
+:class:`tess.pixel_accretion.IsoIntensityAccretor` and
+:class:`tess.pixel_accretion.EqualSNAccretor`.
+
+Pixels are visited in the same order as the pure-Python accretor: frontier
+pixels are ordered by quality and then by flat index (the same ordering
+as ``(quality, (i, j))`` tuples), so both paths build identical segmaps.
+"""
+
+from libc.stdlib cimport malloc, realloc, free, qsort
+import numpy as np
+
+cdef extern from "math.h":
+    double sqrt(double x)
+    double fabs(double x)
+
+
+ctypedef fused index_t:
+    int
+    long
+
+
+cdef int _compare_long(const void *a, const void *b) nogil:
+    cdef long va = (<long *>a)[0]
+    cdef long vb = (<long *>b)[0]
+    return (va > vb) - (va < vb)
+
+
+cdef class BinShape:
+    """Running second moments of the pixels of a bin, giving its elongation
+    in O(1) as pixels are added.
+
+    The elongation is the axis ratio (major over minor) of the bin's moment
+    ellipse, taking each pixel as a unit square: a single pixel or a square
+    block of pixels has an elongation of 1, a domino of 2. Pixel positions
+    are summed relative to the bin's first pixel, for precision.
+    """
+    cdef readonly long n
+    cdef double y0, x0
+    cdef double sy, sx, syy, sxx, sxy
+
+    cpdef start(self, double y, double x):
+        """Start a new bin with the pixel at row ``y``, column ``x``."""
+        self.n = 1
+        self.y0 = y
+        self.x0 = x
+        self.sy = self.sx = self.syy = self.sxx = self.sxy = 0.
+
+    cpdef add(self, double y, double x):
+        """Add the pixel at row ``y``, column ``x`` to the bin."""
+        y -= self.y0
+        x -= self.x0
+        self.n += 1
+        self.sy += y
+        self.sx += x
+        self.syy += y * y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    cpdef double elongation(self):
+        """Elongation of the bin."""
+        return _elongation(self.n, self.sy, self.sx, self.syy, self.sxx,
+                           self.sxy)
+
+    cpdef double trial_elongation(self, double y, double x):
+        """Elongation the bin would have if the pixel at row ``y``, column
+        ``x`` were added."""
+        y -= self.y0
+        x -= self.x0
+        return _elongation(self.n + 1, self.sy + y, self.sx + x,
+                           self.syy + y * y, self.sxx + x * x,
+                           self.sxy + x * y)
+
+
+cdef inline double _elongation(long n, double sy, double sx, double syy,
+                               double sxx, double sxy):
+    """Axis ratio of the moment ellipse of ``n`` unit pixels from the sums
+    of their (relative) coordinates and squared coordinates."""
+    cdef double my = sy / n
+    cdef double mx = sx / n
+    cdef double cyy = syy / n - my * my + 1. / 12.
+    cdef double cxx = sxx / n - mx * mx + 1. / 12.
+    cdef double cxy = sxy / n - mx * my
+    cdef double half_trace = 0.5 * (cyy + cxx)
+    cdef double half_diff = 0.5 * (cyy - cxx)
+    cdef double root = sqrt(half_diff * half_diff + cxy * cxy)
+    return sqrt((half_trace + root) / max(half_trace - root, 1. / 12.))
+
+
+cdef class PixelHeap:
+    """Binary min-heap of ``(quality, pixel)`` pairs.
+
+    Entries are ordered by quality, with ties broken by the flat pixel index.
+    """
+    cdef double *quality
+    cdef long *index
+    cdef long size
+    cdef long capacity
+
+    def __cinit__(self, long capacity=64):
+        if capacity < 1:
+            capacity = 1
+        self.quality = <double *>malloc(capacity * sizeof(double))
+        self.index = <long *>malloc(capacity * sizeof(long))
+        if self.quality == NULL or self.index == NULL:
+            raise MemoryError()
+        self.size = 0
+        self.capacity = capacity
+
+    def __dealloc__(self):
+        free(self.quality)
+        free(self.index)
+
+    def __len__(self):
+        return self.size
+
+    cdef inline bint _less(self, long a, long b):
+        if self.quality[a] < self.quality[b]:
+            return True
+        elif self.quality[a] == self.quality[b]:
+            return self.index[a] < self.index[b]
+        return False
+
+    cdef inline void _swap(self, long a, long b):
+        cdef double q = self.quality[a]
+        cdef long i = self.index[a]
+        self.quality[a] = self.quality[b]
+        self.index[a] = self.index[b]
+        self.quality[b] = q
+        self.index[b] = i
+
+    cdef void _sift_up(self, long k):
+        cdef long parent
+        while k > 0:
+            parent = (k - 1) >> 1
+            if self._less(k, parent):
+                self._swap(k, parent)
+                k = parent
+            else:
+                break
+
+    cdef void _sift_down(self, long k):
+        cdef long child
+        while True:
+            child = 2 * k + 1
+            if child >= self.size:
+                break
+            if child + 1 < self.size and self._less(child + 1, child):
+                child += 1
+            if self._less(child, k):
+                self._swap(k, child)
+                k = child
+            else:
+                break
+
+    cdef int push(self, double q, long i) except -1:
+        """Add pixel ``i`` with quality ``q`` to the heap."""
+        cdef long capacity
+        cdef double *new_quality
+        cdef long *new_index
+        if self.size == self.capacity:
+            capacity = 2 * self.capacity
+            new_quality = <double *>realloc(self.quality,
+                                            capacity * sizeof(double))
+            if new_quality == NULL:
+                raise MemoryError()
+            self.quality = new_quality
+            new_index = <long *>realloc(self.index, capacity * sizeof(long))
+            if new_index == NULL:
+                raise MemoryError()
+            self.index = new_index
+            self.capacity = capacity
+        self.quality[self.size] = q
+        self.index[self.size] = i
+        self.size += 1
+        self._sift_up(self.size - 1)
+        return 0
+
+    cdef long pop(self):
+        """Remove and return the pixel with the smallest quality."""
+        cdef long i = self.index[0]
+        self.size -= 1
+        if self.size > 0:
+            self.quality[0] = self.quality[self.size]
+            self.index[0] = self.index[self.size]
+            self._sift_down(0)
+        return i
+
+    cdef void heapify(self):
+        """Restore the heap ordering after qualities were changed in place."""
+        cdef long k
+        for k in range(self.size // 2 - 1, -1, -1):
+            self._sift_down(k)
+
+    cdef void clear(self):
+        self.size = 0
+
+
+cdef class PixelCriterion:
+    """Baseclass for compiled accretion criteria.
+
+    These are the compiled counterparts of the ``bin_started``,
+    ``candidate_quality``, ``accept_pixel``, ``pixel_added`` and
+    ``close_bin`` hooks of :class:`tess.pixel_accretion.PixelAccretor`.
+    Pixels are referred to by their index into the flattened image.
+
+    Parameters
+    ----------
+    image : ndarray
+        Flattened, C-ordered ``float64`` image.
+    ncols : int
+        Number of columns in the (unflattened) image.
+    """
+    cdef const double [:] image
+    cdef long ncols
+    cdef long n_pixels  # number of pixels in current bin
+
+    def __init__(self, const double [:] image, long ncols):
+        self.image = image
+        self.ncols = ncols
+        self.n_pixels = 0
+
+    cdef void start(self, long i):
+        """Seed a new bin with pixel ``i``."""
+        self.n_pixels = 1
+
+    cdef double quality(self, long i):
+        """Quality of pixel ``i``; pixels with smallest quality are added
+        first."""
+        return 0.
+
+    cdef bint accept(self, long i):
+        """``True`` if pixel ``i`` should be added to the current bin."""
+        return True
+
+    cdef bint add(self, long i):
+        """Add pixel ``i`` to the bin; return ``True`` if the frontier needs
+        to be rescored."""
+        self.n_pixels += 1
+        return False
+
+    cdef void close(self):
+        """Called when the current bin is completed."""
+        pass
+
+
+cdef class IsoIntensityCriterion(PixelCriterion):
+    """Compiled criterion of
+    :class:`tess.pixel_accretion.IsoIntensityAccretor`.
+
+    The bin mean and the trial standard deviation are computed from running
+    sums (or with Welford's algorithm if ``stable`` is ``True``), so testing
+    a candidate pixel is O(1).
+    """
+    cdef double sigma_limit
+    cdef long min_pixels
+    cdef long max_pixels
+    cdef double max_shift_frac
+    cdef bint stable
+    cdef double bin_sum
+    cdef double bin_m2  # sum of squares, or Welford M2 if stable
+    cdef double bin_mean
+    cdef double original_bin_mean
+
+    def __init__(self, const double [:] image, long ncols, double sigma_limit,
+                 long min_pixels=1, long max_pixels=0,
+                 double max_shift_frac=0.05, bint stable=False):
+        super(IsoIntensityCriterion, self).__init__(image, ncols)
+        self.sigma_limit = sigma_limit
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.max_shift_frac = max_shift_frac
+        self.stable = stable
+
+    cdef void _update(self, double v):
+        cdef double delta
+        self.n_pixels += 1
+        if self.stable:
+            delta = v - self.bin_mean
+            self.bin_mean += delta / self.n_pixels
+            self.bin_m2 += delta * (v - self.bin_mean)
+        else:
+            self.bin_sum += v
+            self.bin_m2 += v * v
+            self.bin_mean = self.bin_sum / self.n_pixels
+
+    cdef void start(self, long i):
+        self.n_pixels = 0
+        self.bin_sum = 0.
+        self.bin_m2 = 0.
+        self.bin_mean = 0.
+        self._update(self.image[i])
+        self.original_bin_mean = self.bin_mean
+
+    cdef double quality(self, long i):
+        return fabs(self.image[i] - self.bin_mean)
+
+    cdef bint accept(self, long i):
+        cdef double v = self.image[i]
+        cdef long n = self.n_pixels + 1
+        cdef double delta, mean, var
+        if self.n_pixels < self.min_pixels:
+            return True
+        if self.max_pixels > 0 and self.n_pixels >= self.max_pixels:
+            return False
+        if self.stable:
+            delta = v - self.bin_mean
+            mean = self.bin_mean + delta / n
+            var = (self.bin_m2 + delta * (v - mean)) / n
+        else:
+            mean = (self.bin_sum + v) / n
+            var = (self.bin_m2 + v * v) / n - mean * mean
+        if var < 0.:
+            var = 0.
+        return sqrt(var) <= self.sigma_limit
+
+    cdef bint add(self, long i):
+        cdef double shift
+        self._update(self.image[i])
+        shift = self.original_bin_mean - self.bin_mean
+        # Any shift away from a zero mean counts as a large one
+        if shift != 0. and (self.original_bin_mean == 0.
+                            or fabs(shift / self.original_bin_mean)
+                            > self.max_shift_frac):
+            self.original_bin_mean = self.bin_mean
+            return True
+        return False
+
+
+cdef class EqualSNCriterion(PixelCriterion):
+    """Compiled criterion of :class:`tess.pixel_accretion.EqualSNAccretor`.
+
+    Signal, variance and the bin centroid are tracked with running sums. The
+    frontier is only rescored once the centroid has moved by more than
+    ``max_centroid_shift`` pixels since it was last scored.
+    After the bins are built, :attr:`valid_bins` and :attr:`centroids` hold
+    the same per-bin values as the pure-Python accretor.
+    """
+    cdef const double [:] noise
+    cdef double target_sn
+    cdef long min_pixels
+    cdef long max_pixels
+    cdef double max_centroid_shift
+    cdef double signal
+    cdef double variance
+    cdef double sum_y
+    cdef double sum_x
+    cdef double yc
+    cdef double xc
+    cdef double scored_yc  # centroid when the frontier was last scored
+    cdef double scored_xc
+    cdef double sn
+    cdef readonly list valid_bins
+    cdef readonly list centroids
+
+    def __init__(self, const double [:] image, const double [:] noise,
+                 long ncols, double target_sn, long min_pixels=1,
+                 long max_pixels=0, double max_centroid_shift=0.):
+        super(EqualSNCriterion, self).__init__(image, ncols)
+        self.noise = noise
+        self.target_sn = target_sn
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.max_centroid_shift = max_centroid_shift
+        self.valid_bins = []
+        self.centroids = []
+
+    cdef void _update(self, long i):
+        cdef double n = self.noise[i]
+        self.signal += self.image[i]
+        self.variance += n * n
+        self.sum_y += i // self.ncols
+        self.sum_x += i % self.ncols
+        self.sn = self.signal / sqrt(self.variance)
+        self.yc = self.sum_y / self.n_pixels
+        self.xc = self.sum_x / self.n_pixels
+
+    cdef void start(self, long i):
+        self.n_pixels = 1
+        self.signal = 0.
+        self.variance = 0.
+        self.sum_y = 0.
+        self.sum_x = 0.
+        self._update(i)
+        self.scored_yc = self.yc
+        self.scored_xc = self.xc
+
+    cdef double quality(self, long i):
+        cdef double dy = i // self.ncols - self.yc
+        cdef double dx = i % self.ncols - self.xc
+        return dy * dy + dx * dx
+
+    cdef bint accept(self, long i):
+        if self.n_pixels < self.min_pixels:
+            return True
+        if self.sn > self.target_sn:
+            return False
+        if self.max_pixels > 0 and self.n_pixels >= self.max_pixels:
+            return False
+        return True
+
+    cdef bint add(self, long i):
+        cdef double dy, dx
+        self.n_pixels += 1
+        self._update(i)
+        dy = self.yc - self.scored_yc
+        dx = self.xc - self.scored_xc
+        if dy * dy + dx * dx > self.max_centroid_shift \
+                * self.max_centroid_shift:
+            self.scored_yc = self.yc
+            self.scored_xc = self.xc
+            return True
+        return False
+
+    cdef void close(self):
+        self.valid_bins.append(self.sn >= self.target_sn)
+        self.centroids.append((self.yc, self.xc))
+
+
+cdef class _IndexStack:
+    """Growable LIFO stack of flat pixel indices."""
+    cdef long *data
+    cdef long size
+    cdef long capacity
+
+    def __cinit__(self, long capacity=64):
+        self.data = <long *>malloc(capacity * sizeof(long))
+        if self.data == NULL:
+            raise MemoryError()
+        self.size = 0
+        self.capacity = capacity
+
+    def __dealloc__(self):
+        free(self.data)
+
+    cdef int push(self, long i) except -1:
+        cdef long *new_data
+        if self.size == self.capacity:
+            new_data = <long *>realloc(self.data,
+                                       2 * self.capacity * sizeof(long))
+            if new_data == NULL:
+                raise MemoryError()
+            self.data = new_data
+            self.capacity *= 2
+        self.data[self.size] = i
+        self.size += 1
+        return 0
+
+
+cdef class PixelEngine:
+    """Runs pixel accretion over a flattened segmentation map.
+
+    Parameters
+    ----------
+    criterion : :class:`PixelCriterion`
+        Compiled accretion criterion.
+    segmap : ndarray
+        Flattened, C-ordered segmentation map of ``int32`` or ``int64``
+        labels (it may be a memory-mapped file). Pixels with a value of
+        ``-1`` are unbinned; the map is filled in place.
+    nrows : int
+        Number of rows in the image.
+    ncols : int
+        Number of columns in the image.
+    valid : ndarray
+        Flattened ``uint8`` mask of pixels that can be binned, computed once
+        for the whole image.
+    offsets : ndarray
+        ``(n, 2)`` array of the ``(row, column)`` offsets of the neighbours
+        of a pixel, e.g. 4 for 4-connectivity or 8 for 8-connectivity.
+    max_elongation : float
+        If positive, a bin is closed rather than accept a pixel that would
+        make its :class:`BinShape` elongation exceed this limit. The limit
+        only applies to bins of three or more pixels, as two-pixel bins
+        always have an elongation of 2 (or 2.6 for a diagonal pair).
+    """
+    cdef PixelCriterion criterion
+    cdef BinShape shape
+    cdef double max_elongation
+    cdef int [:] segmap32  # the segmap is held by one of these views
+    cdef long [:] segmap64
+    cdef bint wide
+    cdef long nrows
+    cdef long ncols
+    cdef unsigned char [:] valid
+    cdef long [:] offset_rows  # neighbour offset table
+    cdef long [:] offset_cols
+    cdef long [:] offset_flat
+    cdef PixelHeap heap
+    cdef _IndexStack edges  # global edge pixels, seeds for new bins
+    cdef int [:] frontier_stamp  # bin index + 1 of frontier holding pixel
+    cdef long max_size  # profiling counters
+    cdef long n_pushes
+    cdef long n_rescores
+    cdef long n_rebuilds
+
+    def __init__(self, PixelCriterion criterion, segmap,
+                 long nrows, long ncols, unsigned char [:] valid, offsets,
+                 double max_elongation=0.):
+        self.criterion = criterion
+        self.shape = BinShape()
+        self.max_elongation = max_elongation
+        self.wide = segmap.dtype.itemsize == sizeof(long)
+        if self.wide:
+            self.segmap64 = segmap
+        else:
+            self.segmap32 = segmap
+        self.nrows = nrows
+        self.ncols = ncols
+        self.valid = valid
+        offsets = np.asarray(offsets, dtype=np.int_).reshape(-1, 2)
+        self.offset_rows = offsets[:, 0].copy()
+        self.offset_cols = offsets[:, 1].copy()
+        self.offset_flat = offsets[:, 0] * ncols + offsets[:, 1]
+        self.heap = PixelHeap()
+        self.edges = _IndexStack()
+        self.frontier_stamp = np.zeros(segmap.shape[0], dtype=np.intc)
+        self.max_size = 0
+        self.n_pushes = 0
+        self.n_rescores = 0
+        self.n_rebuilds = 0
+
+    cdef inline long _label(self, long i):
+        if self.wide:
+            return self.segmap64[i]
+        return self.segmap32[i]
+
+    cdef inline void _set_label(self, long i, long bin_index):
+        if self.wide:
+            self.segmap64[i] = bin_index
+        else:
+            self.segmap32[i] = <int>bin_index
+
+    property stats:
+        """Frontier profiling counters, as in
+        :attr:`tess.pixel_accretion.PixelAccretor.frontier_stats`."""
+        def __get__(self):
+            return {'max_size': self.max_size, 'n_pushes': self.n_pushes,
+                    'n_rescores': self.n_rescores,
+                    'n_rebuilds': self.n_rebuilds}
+
+    def accrete_seeds(self, const index_t [:] seeds, long start_index=0):
+        """Accrete every island of unbinned pixels, seeding them in order
+        from ``seeds``; seeds that are already binned are skipped.
+
+        Parameters
+        ----------
+        seeds : ndarray
+            Flat indices of seed pixels, as C int or long.
+        start_index : int
+            Bin number of the first bin.
+
+        Returns
+        -------
+        n_bins : int
+            The next unused bin number.
+        """
+        cdef long k
+        cdef long bin_index = start_index
+        for k in range(seeds.shape[0]):
+            if self._label(seeds[k]) == -1:
+                bin_index = self.accrete(seeds[k], bin_index)
+        return bin_index
+
+    cpdef long accrete(self, long seed, long start_index=0):
+        """Build bins starting from pixel ``seed`` until the connected region
+        of accretable pixels is exhausted.
+
+        Parameters
+        ----------
+        seed : int
+            Flat index of the first pixel.
+        start_index : int
+            Bin number of the first bin.
+
+        Returns
+        -------
+        n_bins : int
+            The next unused bin number.
+        """
+        cdef long bin_index = start_index
+        while seed >= 0:
+            self._make_bin(seed, bin_index)
+            seed = self._new_start_point()
+            bin_index += 1
+        return bin_index
+
+    cdef long _new_start_point(self):
+        cdef long i
+        while self.edges.size > 0:
+            self.edges.size -= 1
+            i = self.edges.data[self.edges.size]
+            if self._label(i) == -1:
+                return i
+        return -1
+
+    cdef int _make_bin(self, long seed, long bin_index) except -1:
+        cdef long i, k
+        cdef long rejected = -1
+        cdef long n_leftover
+        cdef long *leftovers
+        cdef PixelCriterion criterion = self.criterion
+        self.heap.clear()
+        self._set_label(seed, bin_index)
+        criterion.start(seed)
+        self.shape.start(seed // self.ncols, seed % self.ncols)
+        self._add_edges(seed, bin_index)
+        while self.heap.size > 0:
+            i = self.heap.pop()
+            if criterion.accept(i) and self._round_enough(i):
+                self._set_label(i, bin_index)
+                self._add_edges(i, bin_index)
+                self.shape.add(i // self.ncols, i % self.ncols)
+                if criterion.add(i):
+                    self._rescore()
+            else:
+                rejected = i
+                break
+        criterion.close()
+
+        # Remaining frontier pixels seed later bins
+        n_leftover = self.heap.size + (rejected >= 0)
+        if n_leftover == 0:
+            return 0
+        leftovers = <long *>malloc(n_leftover * sizeof(long))
+        if leftovers == NULL:
+            raise MemoryError()
+        for k in range(self.heap.size):
+            leftovers[k] = self.heap.index[k]
+        if rejected >= 0:
+            leftovers[n_leftover - 1] = rejected
+        qsort(leftovers, n_leftover, sizeof(long), _compare_long)
+        try:
+            for k in range(n_leftover):
+                self.edges.push(leftovers[k])
+        finally:
+            free(leftovers)
+        return 0
+
+    cdef inline bint _round_enough(self, long i):
+        """``True`` unless adding pixel ``i`` would make the bin too
+        elongated."""
+        if self.max_elongation <= 0 or self.shape.n < 2:
+            return True
+        return self.shape.trial_elongation(i // self.ncols, i % self.ncols) \
+            <= self.max_elongation
+
+    cdef int _add_edges(self, long i, long bin_index) except -1:
+        cdef long row = i // self.ncols
+        cdef long col = i % self.ncols
+        cdef long k, r, c
+        for k in range(self.offset_rows.shape[0]):
+            r = row + self.offset_rows[k]
+            c = col + self.offset_cols[k]
+            if r >= 0 and r < self.nrows and c >= 0 and c < self.ncols:
+                self._add_edge(i + self.offset_flat[k], bin_index)
+        return 0
+
+    cdef inline int _add_edge(self, long i, long bin_index) except -1:
+        if not self.valid[i] or self._label(i) != -1 \
+                or self.frontier_stamp[i] == bin_index + 1:
+            return 0
+        self.frontier_stamp[i] = bin_index + 1
+        self.heap.push(self.criterion.quality(i), i)
+        self.n_pushes += 1
+        if self.heap.size > self.max_size:
+            self.max_size = self.heap.size
+        return 0
+
+    cdef void _rescore(self):
+        cdef long k
+        if self.heap.size == 0:
+            return
+        for k in range(self.heap.size):
+            self.heap.quality[k] = self.criterion.quality(self.heap.index[k])
+        self.heap.heapify()
+        self.n_rescores += self.heap.size
+        self.n_rebuilds += 1
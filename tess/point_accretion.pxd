@@ -0,0 +1,129 @@
+"""
+Declarations of the point accretion module, so that criteria compiled in
+other Cython modules can subclass :class:`PointAccretor` (or its accretors)
+and override its ``nogil`` hooks::
+
+    from tess.point_accretion cimport PointAccretor, BinState
+
+    cdef class EqualCountAccretor(PointAccretor):
+        cdef long target_count
+
+        cdef bint bin_full(self, BinState *state) nogil:
+            return state.count >= self.target_count
+"""
+cimport cython
+
+
+cdef struct BinState:
+    # Running statistics of the bin being accreted
+    long start  # position of the bin's first point in the point order
+    long count  # number of points in the bin
+    double sum_w  # running weighted sums
+    double sum_wx
+    double sum_wy
+    double sum_aux  # running sum kept by the criterion, e.g. variance
+    double x0  # position of the bin's first point
+    double y0
+    double sum_dx  # unweighted sums of offsets from (x0, y0) and their
+    double sum_dy  # squares, for the bin's second moments
+    double sum_dxx
+    double sum_dyy
+    double sum_dxy
+
+
+cdef struct _BinList:
+    # Growable list of the bins made in one domain
+    long *offsets  # position of each bin's first point in the point order
+    unsigned char *good  # 1 if a well-made bin
+    long n
+    long size
+
+
+cdef class _Coordinates:
+    cdef const float [:] x32
+    cdef const float [:] y32
+    cdef const double [:] x64
+    cdef const double [:] y64
+    cdef readonly bint single  # True for float32 coordinates
+    cdef readonly long n
+
+    @cython.final
+    cdef inline double x(self, long i) nogil
+
+    @cython.final
+    cdef inline double y(self, long i) nogil
+
+
+cdef class UnbinnedGrid:
+    cdef _Coordinates xy
+    cdef double points_per_cell
+    cdef readonly long n_domains
+    # Each domain has a grid of dom_nx by dom_ny cells of size dom_h from
+    # (dom_x0, dom_y0), using cells dom_cell0 to dom_cell0 + dom_ncells;
+    # its points are in cell_points[dom_point0:dom_point0 + dom_n_live]
+    cdef double [:] dom_x0
+    cdef double [:] dom_y0
+    cdef double [:] dom_h
+    cdef long [:] dom_nx
+    cdef long [:] dom_ny
+    cdef long [:] dom_cell0
+    cdef long [:] dom_ncells
+    cdef long [:] dom_point0
+    cdef long [:] dom_n_live
+    cdef long [:] dom_n_built  # live points when the grid was last built
+    cdef long [:] cell_start  # start of each cell's bucket in cell_points
+    cdef long [:] cell_live  # number of live points in each cell
+    cdef long [:] cell_points  # point indices, bucketed by domain and cell
+    cdef long [:] point_pos  # position of each point in cell_points
+    cdef long [:] point_cell  # cell of each point (-1 once removed)
+    cdef long [:] point_domain
+    cdef long [:] sort_buffer  # cell_points copy for rebuilding grids
+
+    cdef void _build(self, long d) nogil
+    cdef void _rebuild(self, long d) nogil
+    cpdef remove(self, long i)
+    cdef void _remove(self, long i) nogil
+    cpdef long nearest(self, double x, double y, long domain=*)
+    cdef long _nearest(self, long d, double x, double y) nogil
+    cdef inline void _search_cell(self, long d, long i, long j, double x,
+                                  double y, long *best,
+                                  double *best_d) nogil
+
+
+cdef class PointAccretor:
+    cdef _Coordinates xy
+    cdef const double [:] w
+    cdef object scratch_dir  # directory for temporary per-point arrays
+    cdef long [:] bin_nums  # bin ID of each point
+    cdef long [:] good_bin  # 1 if a well-made bin
+    cdef long n_bins  # number of bins
+    cdef long [:] _point_order  # points in the order they were binned
+    cdef long [:] _bin_offsets  # start of each bin in _point_order
+    cdef bint _membership_stale  # bins changed since _point_order was made
+    cdef object _result  # cached PointBins
+    cdef double max_elongation  # 0 for no limit
+
+    cpdef accrete(self, long n_domains=*, long n_threads=*)
+    cdef int _accrete_domain(self, UnbinnedGrid grid, long d, long pos,
+                             double xc, double yc, _BinList *bins) nogil
+    cpdef membership(self)
+    # Criterion hooks, see PointAccretor
+    cdef void start_bin(self, BinState *state, long i) nogil
+    cdef void add_point(self, BinState *state, long i) nogil
+    cdef bint bin_full(self, BinState *state) nogil
+    cpdef nodes(self)
+    cpdef result(self)
+    cpdef cleanup(self, int n_jobs=*)
+
+
+cdef class EqualMassAccretor(PointAccretor):
+    cdef double target_mass
+
+    cpdef is_bin_full(self, long [:] current_bin, long n)
+
+
+cdef class EqualSNAccretor(PointAccretor):
+    cdef double target_sn
+    cdef double [:] variance
+
+    cpdef is_bin_full(self, long [:] current_bin, long n)
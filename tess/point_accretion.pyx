@@ -1,197 +1,966 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
 """
 Cython point accretion module -- for binning points until a threshold mass or
 S/N is met.
 """
+cimport cython
 from cython.view cimport array as cvarray
+from cython.parallel cimport prange
+from libc.stdlib cimport malloc, realloc, free
+import multiprocessing
+
 import numpy as np
-from scipy.spatial import cKDTree
 
-cdef extern from "math.h":
+import logging
+log = logging.getLogger(__name__)
+
+from catalog import coordinate_columns, as_column, scratch_array
+from spatial_index import SpatialIndex
+
+cdef extern from "math.h" nogil:
     double sqrt(double x)
+    double floor(double x)
+
+
+cdef class _Coordinates:
+    """Coordinate columns of a set of points, in single or double precision.
+
+    Parameters
+    ----------
+    xy : ndarray or sequence
+        ``(n_points, 2)`` array of point coordinates, or a pair of ``x`` and
+        ``y`` column arrays, which may be read-only memory maps.
+    dtype : dtype
+        ``numpy.float32`` or ``numpy.float64``; see
+        :func:`tess.catalog.coordinate_columns`.
+    scratch_dir : str
+        Directory for temporary files backing converted columns.
+    """
+    def __init__(self, xy, dtype=None, scratch_dir=None):
+        x, y = coordinate_columns(xy, dtype=dtype, scratch_dir=scratch_dir)
+        self.single = x.dtype == np.float32
+        if self.single:
+            self.x32 = x
+            self.y32 = y
+        else:
+            self.x64 = x
+            self.y64 = y
+        self.n = x.shape[0]
+
+    @cython.final
+    cdef inline double x(self, long i) nogil:
+        if self.single:
+            return self.x32[i]
+        return self.x64[i]
+
+    @cython.final
+    cdef inline double y(self, long i) nogil:
+        if self.single:
+            return self.y32[i]
+        return self.y64[i]
+
+    def columns(self):
+        """The ``x`` and ``y`` coordinate arrays."""
+        if self.single:
+            return np.asarray(self.x32), np.asarray(self.y32)
+        return np.asarray(self.x64), np.asarray(self.y64)
+
+
+cdef class UnbinnedGrid:
+    """Uniform grids of the points that are not yet binned, answering
+    nearest-unbinned-point queries as points are removed.
+
+    Points can be split into spatial domains, each with its own grid, so
+    that domains are accreted independently (and concurrently). Points are
+    bucketed by grid cell, with the live (unbinned) points of each cell kept
+    at the front of the cell's bucket so that removals are O(1). Queries
+    search rings of cells outwards from the query cell until no closer point
+    can remain. Once most of a domain's points are removed its grid is
+    rebuilt from the live points, so that cells stay populated. Queries and
+    removals run without the GIL.
+
+    Parameters
+    ----------
+    xy : ndarray or sequence
+        ``(n_points, 2)`` array of point coordinates, or a pair of ``x`` and
+        ``y`` coordinate columns.
+    domains : ndarray
+        Optional ``(n_points,)`` array of the domain number of each point,
+        from zero. Points in domain ``-1`` are left out of the grid. By
+        default all points are in domain zero.
+    points_per_cell : float
+        Mean number of points per grid cell.
+    scratch_dir : str
+        Directory for temporary files backing the per-point index arrays
+        (see :func:`tess.catalog.scratch_array`). By default they are held
+        in memory.
+    """
+
+    def __init__(self, xy, domains=None, double points_per_cell=4.,
+                 scratch_dir=None):
+        cdef long d, i, n_points
+        if not isinstance(xy, _Coordinates):
+            xy = _Coordinates(xy, scratch_dir=scratch_dir)
+        self.xy = xy
+        n_points = self.xy.n
+        self.points_per_cell = points_per_cell
+        self.cell_points = scratch_array(n_points, int, scratch_dir)
+        self.point_pos = scratch_array(n_points, int, scratch_dir)
+        self.point_cell = scratch_array(n_points, int, scratch_dir)
+        self.point_domain = scratch_array(n_points, int, scratch_dir)
+        self.sort_buffer = scratch_array(n_points, int, scratch_dir)
+        x, y = self.xy.columns()
+        if domains is None:
+            # Every point is in domain zero
+            self.n_domains = 1
+            counts = np.array([n_points])
+            for i in range(n_points):
+                self.cell_points[i] = i
+                self.point_domain[i] = 0
+            extents = [(x, y)]
+        else:
+            domains = np.asarray(domains, dtype=int)
+            self.n_domains = domains.max() + 1 if n_points else 1
+            self.n_domains = max(self.n_domains, 1)
+            included = np.flatnonzero(domains >= 0)
+            order = included[np.argsort(domains[included], kind='mergesort')]
+            counts = np.bincount(domains[included], minlength=self.n_domains)
+            np.asarray(self.cell_points)[:len(order)] = order
+            np.asarray(self.point_domain)[:] = domains
+            point0 = np.cumsum(counts) - counts
+            extents = []
+            for d in range(self.n_domains):
+                members = order[point0[d]:point0[d] + counts[d]]
+                extents.append((x[members], y[members]))
+        self.dom_point0 = np.cumsum(counts) - counts
+        self.dom_n_live = counts.copy()
+        self.dom_n_built = counts.copy()
+        # Reserve enough cells for each domain's initial grid
+        ncells = np.ones(self.n_domains, dtype=int)
+        for d in range(self.n_domains):
+            dx, dy = extents[d]
+            if len(dx):
+                h, nx, ny = _grid_shape(dx.max() - dx.min(),
+                                        dy.max() - dy.min(), len(dx),
+                                        points_per_cell)
+                ncells[d] = nx * ny
+        self.dom_ncells = ncells
+        self.dom_cell0 = np.cumsum(ncells) - ncells
+        self.dom_x0 = np.zeros(self.n_domains)
+        self.dom_y0 = np.zeros(self.n_domains)
+        self.dom_h = np.ones(self.n_domains)
+        self.dom_nx = np.ones(self.n_domains, dtype=int)
+        self.dom_ny = np.ones(self.n_domains, dtype=int)
+        self.cell_start = np.zeros(ncells.sum() + 1, dtype=int)
+        self.cell_live = np.zeros(ncells.sum(), dtype=int)
+        np.asarray(self.point_cell)[:] = -1
+        for d in range(self.n_domains):
+            self._build(d)
+
+    def __len__(self):
+        return np.sum(self.dom_n_live)
+
+    cdef void _build(self, long d) nogil:
+        """Bucket the live points of domain ``d``, which must be listed in
+        ``cell_points[dom_point0[d]:dom_point0[d] + dom_n_live[d]]``, into a
+        new grid."""
+        cdef long n = self.dom_n_live[d]
+        cdef long p0 = self.dom_point0[d]
+        cdef long c0 = self.dom_cell0[d]
+        cdef long k, p, c, cx, cy, nx, ny
+        cdef double xmin, xmax, ymin, ymax, h, n_cells
+        self.dom_n_built[d] = n
+        if n == 0:
+            self.dom_nx[d] = 1
+            self.dom_ny[d] = 1
+            self.cell_start[c0] = p0
+            self.cell_live[c0] = 0
+            return
+        xmin = xmax = self.xy.x(self.cell_points[p0])
+        ymin = ymax = self.xy.y(self.cell_points[p0])
+        for k in range(p0, p0 + n):
+            p = self.cell_points[k]
+            xmin = min(xmin, self.xy.x(p))
+            xmax = max(xmax, self.xy.x(p))
+            ymin = min(ymin, self.xy.y(p))
+            ymax = max(ymax, self.xy.y(p))
+        # Cell size for about points_per_cell points per cell
+        n_cells = max(1., n / self.points_per_cell)
+        if xmax > xmin and ymax > ymin:
+            h = sqrt((xmax - xmin) * (ymax - ymin) / n_cells)
+        elif xmax > xmin or ymax > ymin:
+            h = max(xmax - xmin, ymax - ymin) / n_cells
+        else:
+            h = 1.
+        while True:
+            nx = min(<long>((xmax - xmin) / h) + 1, n + 1)
+            ny = min(<long>((ymax - ymin) / h) + 1, n + 1)
+            if nx * ny <= self.dom_ncells[d]:
+                break
+            h *= 1.25
+        h = max(h, max((xmax - xmin) / nx, (ymax - ymin) / ny))
+        self.dom_x0[d] = xmin
+        self.dom_y0[d] = ymin
+        self.dom_h[d] = h
+        self.dom_nx[d] = nx
+        self.dom_ny[d] = ny
+
+        # Counting sort of the points by cell
+        for c in range(c0, c0 + nx * ny):
+            self.cell_live[c] = 0
+        for k in range(p0, p0 + n):
+            p = self.cell_points[k]
+            cx = min(<long>((self.xy.x(p) - xmin) / h), nx - 1)
+            cy = min(<long>((self.xy.y(p) - ymin) / h), ny - 1)
+            c = c0 + cy * nx + cx
+            self.point_cell[p] = c
+            self.cell_live[c] += 1
+        k = p0
+        for c in range(c0, c0 + nx * ny):
+            self.cell_start[c] = k
+            k += self.cell_live[c]
+            self.cell_live[c] = 0
+        for k in range(p0, p0 + n):
+            self.sort_buffer[k] = self.cell_points[k]
+        for k in range(p0, p0 + n):
+            p = self.sort_buffer[k]
+            c = self.point_cell[p]
+            self.point_pos[p] = self.cell_start[c] + self.cell_live[c]
+            self.cell_points[self.point_pos[p]] = p
+            self.cell_live[c] += 1
+
+    cdef void _rebuild(self, long d) nogil:
+        """Gather the live points of domain ``d`` and rebuild its grid."""
+        cdef long c, k, pos = self.dom_point0[d]
+        cdef long c0 = self.dom_cell0[d]
+        for c in range(c0, c0 + self.dom_nx[d] * self.dom_ny[d]):
+            for k in range(self.cell_start[c],
+                           self.cell_start[c] + self.cell_live[c]):
+                # live points only move towards the front of the range
+                self.cell_points[pos] = self.cell_points[k]
+                pos += 1
+        self._build(d)
+
+    cpdef remove(self, long i):
+        """Remove point ``i`` (it has been binned)."""
+        self._remove(i)
+
+    cdef void _remove(self, long i) nogil:
+        cdef long cell = self.point_cell[i]
+        cdef long d = self.point_domain[i]
+        cdef long pos, last, j
+        if cell < 0:
+            return
+        # Swap the point with the cell's last live point
+        pos = self.point_pos[i]
+        last = self.cell_start[cell] + self.cell_live[cell] - 1
+        j = self.cell_points[last]
+        self.cell_points[last] = i
+        self.cell_points[pos] = j
+        self.point_pos[j] = pos
+        self.point_pos[i] = last
+        self.cell_live[cell] -= 1
+        self.point_cell[i] = -1
+        self.dom_n_live[d] -= 1
+        if self.dom_n_live[d] < self.dom_n_built[d] // 4 \
+                and self.dom_n_built[d] > 64:
+            self._rebuild(d)
+
+    cpdef long nearest(self, double x, double y, long domain=0):
+        """Index of the live point of ``domain`` nearest to ``(x, y)``, or
+        ``-1`` if all its points were removed. Ties go to the lowest point
+        index."""
+        return self._nearest(domain, x, y)
+
+    cdef long _nearest(self, long d, double x, double y) nogil:
+        cdef long cx, cy, r, i, j, best = -1
+        cdef double best_d = 0., reach
+        cdef double h = self.dom_h[d]
+        cdef double x0 = self.dom_x0[d]
+        cdef double y0 = self.dom_y0[d]
+        cdef long nx = self.dom_nx[d]
+        cdef long ny = self.dom_ny[d]
+        if self.dom_n_live[d] == 0:
+            return -1
+        cx = <long>floor((x - x0) / h)
+        cy = <long>floor((y - y0) / h)
+        cx = min(max(cx, 0), nx - 1)
+        cy = min(max(cy, 0), ny - 1)
+        r = 0
+        while True:
+            # Search the ring of cells at Chebyshev distance r
+            for j in range(cy - r, cy + r + 1):
+                if j < 0 or j >= ny:
+                    continue
+                if j == cy - r or j == cy + r:
+                    for i in range(cx - r, cx + r + 1):
+                        self._search_cell(d, i, j, x, y, &best, &best_d)
+                else:
+                    self._search_cell(d, cx - r, j, x, y, &best, &best_d)
+                    self._search_cell(d, cx + r, j, x, y, &best, &best_d)
+            if r >= nx and r >= ny:
+                break
+            if best >= 0:
+                # Distance to the nearest cell outside the searched block
+                reach = min(min(x - (x0 + (cx - r) * h),
+                                x0 + (cx + r + 1) * h - x),
+                            min(y - (y0 + (cy - r) * h),
+                                y0 + (cy + r + 1) * h - y))
+                if reach > 0 and best_d < reach * reach:
+                    break
+            r += 1
+        return best
+
+    cdef inline void _search_cell(self, long d, long i, long j, double x,
+                                  double y, long *best,
+                                  double *best_d) nogil:
+        cdef long cell, k, p
+        cdef double dx, dy, dist
+        if i < 0 or i >= self.dom_nx[d]:
+            return
+        cell = self.dom_cell0[d] + j * self.dom_nx[d] + i
+        # The precision test is kept out of the loop
+        if self.xy.single:
+            for k in range(self.cell_start[cell],
+                           self.cell_start[cell] + self.cell_live[cell]):
+                p = self.cell_points[k]
+                dx = self.xy.x32[p] - x
+                dy = self.xy.y32[p] - y
+                _closer(p, dx * dx + dy * dy, best, best_d)
+        else:
+            for k in range(self.cell_start[cell],
+                           self.cell_start[cell] + self.cell_live[cell]):
+                p = self.cell_points[k]
+                dx = self.xy.x64[p] - x
+                dy = self.xy.y64[p] - y
+                _closer(p, dx * dx + dy * dy, best, best_d)
+
+
+cdef inline void _closer(long p, double dist, long *best,
+                         double *best_d) nogil:
+    """Make point ``p`` the best match if it is closer (ties go to the
+    lowest point index)."""
+    if best[0] < 0 or dist < best_d[0] \
+            or (dist == best_d[0] and p < best[0]):
+        best[0] = p
+        best_d[0] = dist
+
+
+def _grid_shape(width, height, n, points_per_cell):
+    """Cell size and ``(nx, ny)`` shape of a grid over ``n`` points in a
+    ``width`` by ``height`` box, as in :meth:`UnbinnedGrid._build`."""
+    n_cells = max(1., n / points_per_cell)
+    if width > 0 and height > 0:
+        h = np.sqrt(width * height / n_cells)
+    elif width > 0 or height > 0:
+        h = max(width, height) / n_cells
+    else:
+        h = 1.
+    nx = min(int(width / h) + 1, n + 1)
+    ny = min(int(height / h) + 1, n + 1)
+    return h, nx, ny
+
+
+cdef inline double _elongation(long n, double sx, double sy, double sxx,
+                               double syy, double sxy) nogil:
+    """Axis ratio of the moment ellipse of ``n`` points from the sums of
+    their (relative) coordinates and squared coordinates.
+
+    Each point is taken to cover an equal share of the bin's area, which
+    adds ``pi * (cxx + cyy) / (6 n)`` to the variance along both axes (the
+    variance of a square cell of area ``2 pi (cxx + cyy) / n``), so that
+    bins of a few points have a finite elongation. A single point has an
+    elongation of 1.
+    """
+    cdef double mx, my, cxx, cyy, cxy, cell, half_trace, half_diff, root
+    if n < 2:
+        return 1.
+    mx = sx / n
+    my = sy / n
+    cxx = max(sxx / n - mx * mx, 0.)
+    cyy = max(syy / n - my * my, 0.)
+    cxy = sxy / n - mx * my
+    if cxx + cyy <= 0.:
+        return 1.  # coincident points
+    cell = 3.141592653589793 * (cxx + cyy) / (6. * n)
+    half_trace = 0.5 * (cxx + cyy) + cell
+    half_diff = 0.5 * (cxx - cyy)
+    root = sqrt(half_diff * half_diff + cxy * cxy)
+    return sqrt((half_trace + root) / max(half_trace - root, cell))
+
+
+cdef inline void _add_moments(BinState *state, double x, double y) nogil:
+    x -= state.x0
+    y -= state.y0
+    state.sum_dx += x
+    state.sum_dy += y
+    state.sum_dxx += x * x
+    state.sum_dyy += y * y
+    state.sum_dxy += x * y
+
+
+cdef inline double _trial_elongation(BinState *state, double x,
+                                     double y) nogil:
+    """Elongation of the bin if the point at ``(x, y)`` were added."""
+    x -= state.x0
+    y -= state.y0
+    return _elongation(state.count + 1, state.sum_dx + x, state.sum_dy + y,
+                       state.sum_dxx + x * x, state.sum_dyy + y * y,
+                       state.sum_dxy + x * y)
+
+
+cdef int _bins_append(_BinList *bins, long offset,
+                      unsigned char good) nogil:
+    cdef long *offsets
+    cdef unsigned char *flags
+    if bins.n == bins.size:
+        bins.size = 2 * bins.size + 64
+        offsets = <long *>realloc(bins.offsets, bins.size * sizeof(long))
+        if offsets == NULL:
+            return -1
+        bins.offsets = offsets
+        flags = <unsigned char *>realloc(bins.good, bins.size)
+        if flags == NULL:
+            return -1
+        bins.good = flags
+    bins.offsets[bins.n] = offset
+    bins.good[bins.n] = good
+    bins.n += 1
+    return 0
+
+
+class PointBins(object):
+    """Bins made by a :class:`PointAccretor`.
+
+    Attributes
+    ----------
+    nodes : ndarray
+        ``(n_bins, 2)`` array of the weighted centroid of each bin.
+    node_mass : ndarray
+        ``(n_bins,)`` array of the total weight of each bin (the mass, or
+        the signal for :class:`EqualSNAccretor`).
+    bin_ids : ndarray
+        ``(n_points,)`` array of the bin of each point, numbered from zero
+        in the order bins were made.
+    good : ndarray
+        ``(n_bins,)`` boolean array, ``True`` for bins that meet the
+        accretion criterion.
+    elongation : ndarray
+        ``(n_bins,)`` array of the axis ratio of each bin's moment ellipse
+        (1 for round bins).
+    bin_offsets : ndarray
+        ``(n_bins + 1,)`` array of the offset of each bin in
+        ``point_order``.
+    point_order : ndarray
+        ``(n_points,)`` array of point indices grouped by bin; the points
+        of bin ``k`` are ``point_order[bin_offsets[k]:bin_offsets[k + 1]]``.
+    """
+    def __init__(self, nodes, node_mass, bin_ids, good, elongation,
+                 bin_offsets, point_order):
+        self.nodes = nodes
+        self.node_mass = node_mass
+        self.bin_ids = bin_ids
+        self.good = good
+        self.elongation = elongation
+        self.bin_offsets = bin_offsets
+        self.point_order = point_order
+        self._index = None
+
+    @property
+    def n_bins(self):
+        """Number of bins."""
+        return len(self.nodes)
+
+    @property
+    def index(self):
+        """A :class:`tess.spatial_index.SpatialIndex` of the nodes, made on
+        first use. It can seed a :class:`tess.voronoi.CVTessellation` in
+        place of the nodes."""
+        if self._index is None:
+            self._index = SpatialIndex(self.nodes)
+        return self._index
 
 
 cdef class PointAccretor:
     """Baseclass for binning points by accreting points closest to bin
     centroids.
+
+    Criteria are written as subclasses that keep running statistics of the
+    current bin in a ``BinState`` struct, so that adding a point and testing
+    the bin are O(1). They override these ``cdef`` hooks, which run without
+    the GIL:
+
+    - ``start_bin(state, i)``, called when a bin is seeded with point ``i``.
+    - ``add_point(state, i)``, called when point ``i`` is added to the bin.
+    - ``bin_full(state)``, ``True`` once the bin meets the criterion.
+
+    Subclasses overriding ``start_bin`` and ``add_point`` must call the
+    baseclass method, which keeps the running weighted centroid of the bin.
+    The accretors, ``BinState`` and the hooks are declared in
+    ``point_accretion.pxd``, so criteria can also be compiled in other
+    Cython modules (``from tess.point_accretion cimport PointAccretor,
+    BinState``).
+    Criteria that only implement the older ``is_bin_full(current_bin, n)``
+    method still work, at the cost of re-testing the whole bin (with the
+    GIL).
+
+    Coordinates are held as ``x`` and ``y`` columns, in single or double
+    precision, and may be (read-only) memory maps of an on-disk catalog
+    (see :mod:`tess.catalog`). Subclasses set them up by calling
+    ``_init_points`` from their constructor.
+
+    Bins can also be kept round, like the roundness limit of Cappellari &
+    Copin (2003), with a ``max_elongation``: a bin is closed rather than
+    accept a point that would make the axis ratio of its moment ellipse
+    exceed this limit. Each point is taken to cover a square cell of an
+    equal share of the bin's area, estimated from the spread of its points
+    as ``2 pi (cxx + cyy) / n``, so the variance of that cell,
+    ``pi (cxx + cyy) / (6 n)``, is added along both axes. This is the
+    unit-square term of the pixel accretors
+    (:class:`tess.pixel_core.BinShape`) with an estimated rather than a
+    known cell area, so the same limit is close but not identical for
+    points and pixels. The limit only applies to bins of three or more
+    points: a bin's second point is always accepted, and a two-point bin
+    has an elongation of about 2.2. The check is O(1), from second moments
+    kept up to date in the ``BinState``, and the elongation of every final
+    bin is reported by :meth:`result`.
     """
-    cdef double [:, :] xy
-    cdef double [:] w
-    cdef long [:] bin_nums  # bin ID of each point
-    cdef long [:] good_bin  # 1 if a well-made bin
-    cdef long _n_unbinned  # count unbinned points
-    cdef long n_bins  # number of bins
-    cdef object tree  # KD Tree of points
-
-    cpdef accrete(self):
+
+    cpdef accrete(self, long n_domains=1, long n_threads=0):
         """Run the point accretion algorithm to build bins of points of a
         certain mass or quality.
+
+        Parameters
+        ----------
+        n_domains : int
+            Number of spatial domains to split the points into. Domains are
+            made by recursively bisecting the points along their longest
+            axis, into halves of about equal total weight, and are accreted
+            independently in parallel threads. Bins left under-filled where
+            a domain ran out of points (along the domain boundaries) are
+            then re-accreted together in a serial pass.
+        n_threads : int
+            Number of threads to accrete domains with. By default, one per
+            domain up to the number of processors.
         """
-        cdef long [:] current_bin  # indices of items in current bin
-        cdef double [:] current_bin_xy  # centroid of current bin
-        cdef long current_bin_count = 0  # number of items in current bin
-        self.n_bins = 0
-        self._n_unbinned = self.xy.shape[0]  # count unbinned points
-        self.bin_nums = np.zeros(self.xy.shape[0], dtype=int)
-        self.good_bin = np.zeros(self.xy.shape[0], dtype=int)
+        cdef long d, k, p, n_points = self.xy.n
+        cdef long failed = 0
+        cdef UnbinnedGrid grid
+        cdef _BinList *bins
+        cdef double [:] seed_x, seed_y
+        self.bin_nums = scratch_array(n_points, int, self.scratch_dir)
+        # Bins are stored in CSR form: the points of bin k are
+        # _point_order[_bin_offsets[k]:_bin_offsets[k + 1]].
+        self._point_order = scratch_array(n_points, int, self.scratch_dir)
+        self._membership_stale = False
+        self._result = None
+        if n_domains > 1:
+            domains = self._split_domains(n_domains)
+        else:
+            n_domains = 1
+            domains = None
+        if n_threads <= 0:
+            n_threads = min(n_domains, multiprocessing.cpu_count())
+
+        # Index of the points that are not binned yet; each domain's points
+        # fill its own range of the point order
+        grid = UnbinnedGrid(self.xy, domains, scratch_dir=self.scratch_dir)
+        # Each domain is seeded at its centroid
+        seed_x, seed_y = self._domain_centroids(domains, n_domains)
+        bins = <_BinList *>malloc(n_domains * sizeof(_BinList))
+        if bins == NULL:
+            raise MemoryError()
+        for d in range(n_domains):
+            bins[d].offsets = NULL
+            bins[d].good = NULL
+            bins[d].n = 0
+            bins[d].size = 0
+        try:
+            with nogil:
+                for d in prange(n_domains, schedule='dynamic',
+                                num_threads=n_threads):
+                    if self._accrete_domain(grid, d, grid.dom_point0[d],
+                                            seed_x[d], seed_y[d],
+                                            &bins[d]) < 0:
+                        failed += 1
+            if failed:
+                raise MemoryError()
+            offsets = np.concatenate(
+                [np.asarray(<long[:bins[d].n]>bins[d].offsets)
+                 if bins[d].n else np.zeros(0, dtype=int)
+                 for d in range(n_domains)] + [[n_points]])
+            good = np.concatenate(
+                [np.asarray(<unsigned char[:bins[d].n]>bins[d].good)
+                 if bins[d].n else np.zeros(0, dtype=np.uint8)
+                 for d in range(n_domains)]).astype(int)
+        finally:
+            for d in range(n_domains):
+                free(bins[d].offsets)
+                free(bins[d].good)
+            free(bins)
+        self._bin_offsets = offsets
+        self.good_bin = good
+        if n_domains > 1 and not good.all():
+            self._reaccrete_failed_bins()
+        self.n_bins = self.good_bin.shape[0]
+        # Number the bins (from 1) in the order they were made
+        for k in range(self.n_bins):
+            for p in range(self._bin_offsets[k], self._bin_offsets[k + 1]):
+                self.bin_nums[self._point_order[p]] = k + 1
+        log.debug("Accreted {0:d} bins ({1:d} failed) from {2:d} "
+                  "points".format(self.n_bins,
+                                  self.n_bins - np.sum(self.good_bin),
+                                  n_points))
+
+    def _init_points(self, xy, w, dtype, scratch_dir, max_elongation=None):
+        """Set up the point coordinates and weights, the directory for
+        temporary arrays and the elongation limit."""
+        self.scratch_dir = scratch_dir
+        self.max_elongation = max_elongation or 0.
+        self.xy = _Coordinates(xy, dtype=dtype, scratch_dir=scratch_dir)
+        self.w = as_column(w, np.float64, scratch_dir=scratch_dir)
+        if self.w.shape[0] != self.xy.n:
+            raise ValueError("Need one weight per point")
 
-        # Seed position is centroid of distribution
-        xyc = self.centroid(np.arange(0, self._n_unbinned), self._n_unbinned)
+    def _split_domains(self, n_domains):
+        """Domain number of each point, from recursively bisecting the
+        points along their longest axis into parts of equal total weight.
+        """
+        columns = self.xy.columns()
+        w = np.abs(np.asarray(self.w))
+        if not np.sum(w) > 0:
+            w = np.ones(len(w))
+        domains = np.zeros(len(w), dtype=int)
+        parts = [(np.arange(len(w)), 0, n_domains)]
+        while parts:
+            members, first, k = parts.pop()
+            if k == 1 or len(members) == 0:
+                domains[members] = first
+                continue
+            coords = [c[members] for c in columns]
+            axis = np.argmax([np.ptp(c) for c in coords])
+            members = members[np.argsort(coords[axis])]
+            k_low = k // 2
+            cumulative = np.cumsum(w[members])
+            cut = np.searchsorted(cumulative,
+                                  np.sum(w[members]) * k_low / float(k))
+            parts.append((members[:cut], first, k_low))
+            parts.append((members[cut:], first + k_low, k - k_low))
+        return domains
+
+    def _domain_centroids(self, domains, n_domains):
+        """Weighted centroid of the points of each domain (all points are in
+        domain zero if ``domains`` is ``None``)."""
+        cdef long i
+        cdef double sum_w = 0., sum_wx = 0., sum_wy = 0.
+        if domains is None:
+            # Single pass over the (possibly memory-mapped) columns
+            with nogil:
+                for i in range(self.xy.n):
+                    sum_w += self.w[i]
+                    sum_wx += self.w[i] * self.xy.x(i)
+                    sum_wy += self.w[i] * self.xy.y(i)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return (np.array([sum_wx]) / sum_w,
+                        np.array([sum_wy]) / sum_w)
+        x, y = self.xy.columns()
+        w = np.asarray(self.w)
+        included = domains >= 0
+        domains = domains[included]
+        w = w[included]
+        mass = np.bincount(domains, weights=w, minlength=n_domains)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xc = np.bincount(domains, weights=w * x[included],
+                             minlength=n_domains) / mass
+            yc = np.bincount(domains, weights=w * y[included],
+                             minlength=n_domains) / mass
+        return xc, yc
 
-        # Build a KDTree of all points
-        self.tree = cKDTree(self.xy)
+    def _reaccrete_failed_bins(self):
+        """Re-accrete the points of failed bins in one serial pass, after
+        the bins that are good.
 
-        while self._n_unbinned > 0:
+        The new point order, bin offsets and flags are written into scratch
+        arrays, so no per-point temporaries are held in memory."""
+        cdef _BinList bins
+        cdef UnbinnedGrid grid
+        cdef double [:] seed_x, seed_y
+        cdef long [:] offsets = self._bin_offsets
+        cdef long [:] order = self._point_order
+        cdef long [:] good = self.good_bin
+        cdef long [:] new_order, dom, new_offsets, new_good
+        cdef long i, j, k, n_good = 0, start = 0, left
+        cdef long n_old = good.shape[0]
+        for j in range(n_old):
+            if good[j]:
+                n_good += 1
+                start += offsets[j + 1] - offsets[j]
+        # Points of good bins keep their order at the front; the points of
+        # failed bins are the only ones in the grid's domain
+        new_order = scratch_array(self.xy.n, int, self.scratch_dir)
+        domains = scratch_array(self.xy.n, int, self.scratch_dir)
+        domains.fill(-1)
+        dom = domains
+        with nogil:
+            k = 0
+            left = start
+            for j in range(n_old):
+                for i in range(offsets[j], offsets[j + 1]):
+                    if good[j]:
+                        new_order[k] = order[i]
+                        k += 1
+                    else:
+                        new_order[left] = order[i]
+                        dom[order[i]] = 0
+                        left += 1
+        self._point_order = new_order
+        grid = UnbinnedGrid(self.xy, domains, scratch_dir=self.scratch_dir)
+        seed_x, seed_y = self._domain_centroids(domains, 1)
+        bins.offsets = NULL
+        bins.good = NULL
+        bins.n = 0
+        bins.size = 0
+        try:
+            # The grid's point range starts at 0; shift it after the kept
+            # points by accreting into the tail of the point order
+            if self._accrete_domain(grid, 0, start, seed_x[0], seed_y[0],
+                                    &bins) < 0:
+                raise MemoryError()
+            new_offsets = scratch_array(n_good + bins.n + 1, int,
+                                        self.scratch_dir)
+            new_good = scratch_array(n_good + bins.n, int, self.scratch_dir)
+            with nogil:
+                new_offsets[0] = 0
+                k = 0
+                for j in range(n_old):
+                    if good[j]:
+                        new_offsets[k + 1] = new_offsets[k] \
+                            + offsets[j + 1] - offsets[j]
+                        new_good[k] = 1
+                        k += 1
+                for j in range(bins.n):
+                    if j > 0:
+                        new_offsets[n_good + j] = bins.offsets[j]
+                    new_good[n_good + j] = bins.good[j]
+                new_offsets[n_good + bins.n] = self.xy.n
+        finally:
+            free(bins.offsets)
+            free(bins.good)
+        self._bin_offsets = new_offsets
+        self.good_bin = new_good
+
+    cdef int _accrete_domain(self, UnbinnedGrid grid, long d, long pos,
+                             double xc, double yc, _BinList *bins) nogil:
+        """Accrete all the points of domain ``d`` of ``grid``, starting from
+        the point nearest ``(xc, yc)``. Points are written to the point order
+        from position ``pos``, and the bins are appended to ``bins``.
+        Returns ``-1`` if memory runs out."""
+        cdef BinState state
+        cdef long idx
+        while grid.dom_n_live[d] > 0:
             # Initialize bin
-            self.n_bins += 1
-            idx = self.tree.query(xyc, k=1)[1]
-            current_bin = np.zeros(self._n_unbinned, dtype=int)
-            current_bin[0] = idx
-            self.bin_nums[<long>idx] = self.n_bins  # use n_bins as a bin ID
-            current_bin_count = 1
-            self._n_unbinned -= 1
-            xyc[0] = self.xy[idx, 0]
-            xyc[1] = self.xy[idx, 1]
-            
+            idx = grid._nearest(d, xc, yc)
+            if _bins_append(bins, pos, 0) < 0:
+                return -1
+            state.start = pos
+            state.count = 1
+            self._point_order[pos] = idx
+            pos += 1
+            grid._remove(idx)
+            state.x0 = self.xy.x(idx)
+            state.y0 = self.xy.y(idx)
+            state.sum_dx = state.sum_dy = 0.
+            state.sum_dxx = state.sum_dyy = state.sum_dxy = 0.
+            self.start_bin(&state, idx)
+            xc = self.xy.x(idx)
+            yc = self.xy.y(idx)
+
             # Accrete points
-            while not self.is_bin_full(current_bin, current_bin_count) \
-                    and self._n_unbinned > 0:
-                idx = self.find_closest_unbinned(xyc, current_bin_count)
+            while not self.bin_full(&state) and grid.dom_n_live[d] > 0:
+                idx = grid._nearest(d, xc, yc)
+                if self.max_elongation > 0 and state.count >= 2 \
+                        and _trial_elongation(&state, self.xy.x(idx),
+                                              self.xy.y(idx)) \
+                        > self.max_elongation:
+                    # Close the bin rather than make it too elongated
+                    break
                 # Add this point to the bin
-                current_bin_count += 1
-                self._n_unbinned -= 1
-                current_bin[current_bin_count - 1] = idx
-                self.bin_nums[idx] = self.n_bins
-                xyc = self.centroid(current_bin, current_bin_count)
+                self._point_order[pos] = idx
+                pos += 1
+                state.count += 1
+                grid._remove(idx)
+                _add_moments(&state, self.xy.x(idx), self.xy.y(idx))
+                self.add_point(&state, idx)
+                xc = state.sum_wx / state.sum_w
+                yc = state.sum_wy / state.sum_w
 
             # Check if the bin is complete
-            if self.is_bin_full(current_bin, current_bin_count):
-                self.good_bin[self.n_bins - 1] = 1
+            if self.bin_full(&state):
+                bins.good[bins.n - 1] = 1
+        return 0
+
+    cpdef membership(self):
+        """Points of each bin, in compressed sparse row form.
+
+        The points of bin ``k`` (numbered from zero, in the order bins were
+        made) are ``point_order[bin_offsets[k]:bin_offsets[k + 1]]``.
+
+        Returns
+        -------
+        bin_offsets : ndarray
+            ``(n_bins + 1,)`` array of offsets of each bin in
+            ``point_order``.
+        point_order : ndarray
+            ``(n_points,)`` array of point indices, grouped by bin.
+        """
+        if self._membership_stale:
+            self._rebuild_membership()
+        return np.asarray(self._bin_offsets), np.asarray(self._point_order)
+
+    def _rebuild_membership(self):
+        """Rebuild the point order and bin offsets from the bin numbers
+        after bins were reassigned, with a counting sort over the bin
+        numbers (stable, so each bin's points stay in index order) into
+        scratch arrays."""
+        cdef long i, j, n_points = self.xy.n
+        cdef long [:] offsets = scratch_array(self.n_bins + 1, int,
+                                              self.scratch_dir)
+        cdef long [:] order = scratch_array(n_points, int, self.scratch_dir)
+        cdef long [:] cursor = np.zeros(self.n_bins, dtype=int)
+        with nogil:
+            for i in range(n_points):
+                cursor[self.bin_nums[i] - 1] += 1
+            offsets[0] = 0
+            for j in range(self.n_bins):
+                offsets[j + 1] = offsets[j] + cursor[j]
+                cursor[j] = offsets[j]
+            for i in range(n_points):
+                j = self.bin_nums[i] - 1
+                order[cursor[j]] = i
+                cursor[j] += 1
+        self._bin_offsets = offsets
+        self._point_order = order
+        self._membership_stale = False
+
+    cdef void start_bin(self, BinState *state, long i) nogil:
+        """Reset the running statistics for a bin seeded with point ``i``.
+        """
+        state.sum_w = self.w[i]
+        state.sum_wx = self.xy.x(i) * self.w[i]
+        state.sum_wy = self.xy.y(i) * self.w[i]
+
+    cdef void add_point(self, BinState *state, long i) nogil:
+        """Add point ``i`` to the running statistics of the bin."""
+        state.sum_w += self.w[i]
+        state.sum_wx += self.xy.x(i) * self.w[i]
+        state.sum_wy += self.xy.y(i) * self.w[i]
+
+    cdef bint bin_full(self, BinState *state) nogil:
+        """``True`` if the current bin meets the criterion."""
+        with gil:
+            return self.is_bin_full(
+                self._point_order[state.start:state.start + state.count],
+                state.count)
 
     cpdef nodes(self):
         """Return the x,y coordinates of the node centroids."""
-        cdef long i, j
-        cdef double [:, :] node_xy = np.zeros((self.n_bins, 2), dtype=float)
-        cdef double [:] node_m = np.zeros(self.n_bins, dtype=float)
-        print self.n_bins
-        for i in xrange(self.xy.shape[0]):
-            j = self.bin_nums[i] - 1  # for zero-based index
-            node_xy[j, 0] += self.xy[i, 0] * self.w[i]
-            node_xy[j, 1] += self.xy[i, 1] * self.w[i]
-            node_m[j] += self.w[i]
-        for j in xrange(self.n_bins):
-            node_xy[j, 0] /= node_m[j]
-            node_xy[j, 1] /= node_m[j]
-        return node_xy
-
-    cdef centroid(self, long [:] inds, long n_points):
-        """Compute centroid of points given by the index array ``inds``.
-        
-        Parameters
-        ----------
-        inds : ndarray
-            Array of indices of points in the ``self.xy`` array that are
-            in the current bin.
-        n_points : int
-            Number of points in the current bin.
-        """
-        cdef double [:] xyc = np.zeros(2, dtype=float)
-        cdef double mass_sum = 0
-        for i in xrange(n_points):
-            xyc[0] += self.xy[inds[i], 0] * self.w[inds[i]]
-            xyc[1] += self.xy[inds[i], 1] * self.w[inds[i]]
-            mass_sum += self.w[inds[i]]
-        xyc[0] /= mass_sum
-        xyc[1] /= mass_sum
-        return xyc
-
-    cdef long find_closest_unbinned(self, double [:] xyc, long n_binned):
-        """Returns the index of the unbinned point closest to the given
-        coordinate ``xyc``.
+        return self.result().nodes
 
-        Parameters
-        ----------
-        xyc : ndarray
-            ``(x, y)`` coordinate of the point to query.
-        n_binned : int
-            Number of points that have been binned. Used to guess how many
-            points to query for.
+    cpdef result(self):
+        """The bins made by the last accretion (or cleanup), as a
+        :class:`PointBins`.
+
+        Node centroids, masses and bin IDs are computed together in one
+        pass over the points, and the bin elongations in a pass over the
+        bin membership; they are cached until the bins change.
         """
-        cdef int keep_going
-        cdef long idx, i, j
-        # n is number of points find around node; hopefully enough so find
-        # unbinned points
-        cdef long n = 10 + n_binned
-        if n > self.xy.shape[0]:
-            n = self.xy.shape[0]
-        keep_going = 1
-        while keep_going:
-            if n == self.xy.shape[0]:
-                keep_going = 0
-            indices = self.tree.query(xyc, k=n)[1]
-            # Find first index not binned already
-            # implicity assumes indices is sorted by distance for xyc
-            for i in xrange(n):
-                idx = indices[i]
-                if self.bin_nums[idx] > 0:
+        cdef long i, j, k
+        cdef double [:, :] node_xy
+        cdef double [:] node_m
+        cdef double [:] elongation
+        cdef long [:] bin_ids
+        cdef long [:] offsets, order
+        cdef BinState state
+        if self._result is not None:
+            return self._result
+        node_xy = np.zeros((self.n_bins, 2), dtype=float)
+        node_m = np.zeros(self.n_bins, dtype=float)
+        bin_ids = scratch_array(self.xy.n, int, self.scratch_dir)
+        with nogil:
+            for i in range(self.xy.n):
+                j = self.bin_nums[i] - 1  # for zero-based index
+                bin_ids[i] = j
+                node_xy[j, 0] += self.xy.x(i) * self.w[i]
+                node_xy[j, 1] += self.xy.y(i) * self.w[i]
+                node_m[j] += self.w[i]
+            for j in range(self.n_bins):
+                node_xy[j, 0] /= node_m[j]
+                node_xy[j, 1] /= node_m[j]
+        bin_offsets, point_order = self.membership()
+        offsets = bin_offsets
+        order = point_order
+        elongation = np.ones(self.n_bins, dtype=float)
+        with nogil:
+            for j in range(self.n_bins):
+                if offsets[j + 1] - offsets[j] < 2:
                     continue
-                else:
-                    return idx
-            # If here, no matches; expand number of points to return
-            n = 10 + n
-            if n > self.xy.shape[0]:
-                n = self.xy.shape[0]
+                i = order[offsets[j]]
+                state.x0 = self.xy.x(i)
+                state.y0 = self.xy.y(i)
+                state.sum_dx = state.sum_dy = 0.
+                state.sum_dxx = state.sum_dyy = state.sum_dxy = 0.
+                for k in range(offsets[j] + 1, offsets[j + 1]):
+                    i = order[k]
+                    _add_moments(&state, self.xy.x(i), self.xy.y(i))
+                elongation[j] = _elongation(
+                    offsets[j + 1] - offsets[j], state.sum_dx, state.sum_dy,
+                    state.sum_dxx, state.sum_dyy, state.sum_dxy)
+        self._result = PointBins(np.asarray(node_xy), np.asarray(node_m),
+                                 np.asarray(bin_ids),
+                                 np.asarray(self.good_bin).astype(bool),
+                                 np.asarray(elongation),
+                                 bin_offsets, point_order)
+        return self._result
 
-    cpdef cleanup(self):
+    cpdef cleanup(self, int n_jobs=1):
         """Clean up bins that failed to meet quality requirements by
         re-allocating their points to other bins.
+
+        Each point of a failed bin joins the good bin with the nearest node
+        centroid. The node centroids are computed once, all points are
+        reassigned with a single bulk query of a
+        :class:`tess.spatial_index.SpatialIndex` of the good nodes, and the
+        remaining bins are renumbered in order through a lookup table.
+
+        Parameters
+        ----------
+        n_jobs : int
+            Number of threads for the tree query (``-1`` uses all
+            processors).
         """
-        cdef long i, j, current_bin_count, n_good_bins, current_bin_num
-        cdef long [:] current_bin  # indices of items in current bin
-        i = 0
-        n_good_bins = 0
-        while i < self.n_bins:
-            if self.good_bin[i]:
-                n_good_bins += 1
-            else:
-                # Need to re-allocate this bin.
-                # List all points in this bin
-                current_bin_count = 0
-                current_bin = np.zeros(self.xy.shape[0], dtype=int)
-                current_bin_num = i + 1
-                for j in xrange(self.xy.shape[0]):
-                    if self.bin_nums[j] == current_bin_num:
-                        current_bin[current_bin_count] = j
-                        current_bin_count += 1
-                # Redistribute the points
-                self._redistribute_points(i, current_bin, current_bin_count)
-                i -= 1  # since we removed a bin
-            i += 1
-
-    cpdef _redistribute_points(self, long bin_index, long [:] current_bin,
-            long current_bin_count):
-        cdef long j, k, old_bin_num
-        cdef double [:, :] node_xy = self.nodes()  # node centroids
-        cdef double [:] xyc = np.empty(2, dtype=float)
-        node_tree = cKDTree(node_xy)
-        for j in xrange(current_bin_count):
-            k = current_bin[j]
-            # re-allocate point
-            xyc[0] = self.xy[k, 0]
-            xyc[1] = self.xy[k, 1]
-            indices = node_tree.query(xyc, k=2)[1]
-            if indices[0] == bin_index:
-                # Use the other index instead; don't allocate back to itself
-                self.bin_nums[j] = indices[1] + 1  # since bin_nums is 1-based
-            else:
-                # First index is different+okay
-                self.bin_nums[j] = indices[0] + 1  # since bin_nums is 1-based
-
-        # Re-number all bins that come after bin_index
-        old_bin_num = bin_index + 1
-        for j in xrange(self.xy.shape[0]):
-            if self.bin_nums[j] >= old_bin_num:
-                self.bin_nums[j] -= 1
-        self.n_bins -= 1
+        good = np.asarray(self.good_bin).astype(bool)
+        if good.all() or not good.any():
+            return
+        bin_nums = np.asarray(self.bin_nums)
+        good_bins = np.flatnonzero(good)
+        node_index = SpatialIndex(np.asarray(self.nodes())[good_bins])
+        # Lookup table from old to new (1-based) bin numbers
+        lut = np.zeros(self.n_bins + 1, dtype=int)
+        lut[good_bins + 1] = np.arange(1, len(good_bins) + 1)
+        # Renumber in place (unbuffered), as bin_nums may be a memory map
+        np.take(lut, bin_nums, out=bin_nums, mode='clip')
+        failed = np.flatnonzero(bin_nums == 0)
+        x, y = self.xy.columns()
+        indices = node_index.query((x[failed], y[failed]), n_jobs=n_jobs)
+        bin_nums[failed] = indices + 1  # since bin_nums is 1-based
+        log.debug("Moved {0:d} points of {1:d} failed bins".format(
+            len(failed), self.n_bins - len(good_bins)))
+        self.n_bins = len(good_bins)
+        good_bin = scratch_array(self.n_bins, int, self.scratch_dir)
+        good_bin.fill(1)
+        self.good_bin = good_bin
+        self._membership_stale = True
+        self._result = None
 
 
 cdef class EqualMassAccretor(PointAccretor):
@@ -199,19 +968,34 @@ cdef class EqualMassAccretor(PointAccretor):
     
     Parameters
     ----------
-    xy : ndarray
-        ``(n_points, 2)`` array giving the (x,y) coordinates of all points.
+    xy : ndarray or sequence
+        ``(n_points, 2)`` array giving the (x,y) coordinates of all points,
+        or a pair of ``(n_points,)`` x and y coordinate columns (for
+        example, memory maps from :func:`tess.catalog.open_catalog`).
     mass : ndarray
         ``(n_points,)`` array giving the mass of each point.
     target_mass : float
         Minimum mass of each bin.
+    dtype : dtype
+        Coordinate precision, ``numpy.float32`` or ``numpy.float64``. By
+        default single precision is used only if the coordinates are
+        already ``float32``.
+    scratch_dir : str
+        If set, per-point arrays made during accretion (bin numbers, point
+        order and the index of unbinned points) are memory-mapped
+        temporary files in this directory rather than held in memory.
+    max_elongation : float
+        If set, bins of three or more points are closed before they become
+        more elongated than this axis ratio, with each point an equal share
+        of the bin's area; see :class:`PointAccretor`.
     """
-    cdef double target_mass
-
-    def __init__(self, double [:, :] xy, double [:] mass, double target_mass):
+    def __init__(self, xy, mass, double target_mass, dtype=None,
+                 scratch_dir=None, max_elongation=None):
         self.target_mass = target_mass
-        self.xy = xy
-        self.w = mass
+        self._init_points(xy, mass, dtype, scratch_dir, max_elongation)
+
+    cdef bint bin_full(self, BinState *state) nogil:
+        return state.sum_w >= self.target_mass
 
     cpdef is_bin_full(self, long [:] current_bin, long n):
         cdef double total_mass = 0.
@@ -230,8 +1014,10 @@ cdef class EqualSNAccretor(PointAccretor):
 
     Parameters
     ----------
-    xy : ndarray
-        ``(n_points, 2)`` array giving the (x,y) coordinates of all points.
+    xy : ndarray or sequence
+        ``(n_points, 2)`` array giving the (x,y) coordinates of all points,
+        or a pair of ``(n_points,)`` x and y coordinate columns (for
+        example, memory maps from :func:`tess.catalog.open_catalog`).
     signal : ndarray
         ``(n_points,)`` array giving the signal of each point.
     noise : ndarray
@@ -239,19 +1025,38 @@ cdef class EqualSNAccretor(PointAccretor):
         deviation) of each point.
     target_sn : float
         Minimum signal-to-noise ratio of each bin.
+    dtype : dtype
+        Coordinate precision, ``numpy.float32`` or ``numpy.float64``. By
+        default single precision is used only if the coordinates are
+        already ``float32``.
+    scratch_dir : str
+        If set, per-point arrays made during accretion (the variances, bin
+        numbers, point order and the index of unbinned points) are
+        memory-mapped temporary files in this directory rather than held in
+        memory.
+    max_elongation : float
+        If set, bins of three or more points are closed before they become
+        more elongated than this axis ratio, with each point an equal share
+        of the bin's area; see :class:`PointAccretor`.
     """
-    cdef double target_sn
-    cdef double [:] variance
-
-    def __init__(self, double [:, :] xy, double [:] signal, double [:] noise,
-            double target_sn):
-        cdef long i
+    def __init__(self, xy, signal, noise, double target_sn, dtype=None,
+                 scratch_dir=None, max_elongation=None):
         self.target_sn = target_sn
-        self.xy = xy
-        self.w = signal
-        self.variance = np.empty(signal.shape[0], dtype=float)
-        for i in xrange(signal.shape[0]):
-            self.variance[i] = noise[i] * noise[i]
+        self._init_points(xy, signal, dtype, scratch_dir, max_elongation)
+        variance = scratch_array(self.xy.n, float, scratch_dir)
+        np.square(np.asanyarray(noise), out=variance)
+        self.variance = variance
+
+    cdef void start_bin(self, BinState *state, long i) nogil:
+        PointAccretor.start_bin(self, state, i)
+        state.sum_aux = self.variance[i]  # running variance
+
+    cdef void add_point(self, BinState *state, long i) nogil:
+        PointAccretor.add_point(self, state, i)
+        state.sum_aux += self.variance[i]
+
+    cdef bint bin_full(self, BinState *state) nogil:
+        return state.sum_w / sqrt(state.sum_aux) >= self.target_sn
 
     cpdef is_bin_full(self, long [:] current_bin, long n):
         cdef double total_variance = 0.
@@ -0,0 +1,60 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Build configuration for the tess Cython extensions.
+
+``pixel_core`` is the pixel accretion engine. ``point_accretion`` runs its
+spatial domains, and ``lloyd`` its centroid updates, in parallel with OpenMP
+when the compiler supports it; otherwise they are built without OpenMP and run
+in a single thread. All extensions share the same compile settings.
+"""
+
+import os
+import shutil
+import tempfile
+from distutils import ccompiler, sysconfig
+from distutils.extension import Extension
+from distutils.errors import CompileError, LinkError
+
+ROOT = os.path.relpath(os.path.dirname(__file__))
+
+OPENMP_FLAGS = ['-fopenmp']
+
+OPENMP_TEST = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }
+"""
+
+
+def get_extensions():
+    flags = OPENMP_FLAGS if openmp_available() else []
+    return [Extension('tess.' + name,
+                      [os.path.join(ROOT, name + '.pyx')],
+                      include_dirs=['numpy'],
+                      extra_compile_args=flags,
+                      extra_link_args=flags)
+            for name in ('pixel_core', 'point_accretion', 'lloyd')]
+
+
+def get_package_data():
+    # point_accretion.pxd lets criteria in other Cython modules cimport the
+    # point accretors
+    return {'tess': ['*.pxd']}
+
+
+def openmp_available():
+    """True if the C compiler can build and link a small OpenMP program."""
+    compiler = ccompiler.new_compiler()
+    sysconfig.customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'test_openmp.c')
+        with open(source, 'w') as f:
+            f.write(OPENMP_TEST)
+        objects = compiler.compile([source], output_dir=tmpdir,
+                                   extra_postargs=OPENMP_FLAGS)
+        compiler.link_executable(objects, 'test_openmp', output_dir=tmpdir,
+                                 extra_postargs=OPENMP_FLAGS)
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+    return True
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Nearest-node queries shared along the binning pipeline.
+
+Point accretion, Lloyd's algorithm, Voronoi partitioning and the cleanup of
+failed bins all assign points to their nearest node. A :class:`SpatialIndex`
+holds the KD-tree of a set of nodes, built once when it is first queried,
+and answers bulk queries in chunks (optionally with several threads), so
+that point catalogs never need to be copied whole into query arrays.
+
+An index can be passed wherever an ``(n_nodes, 2)`` array of nodes is
+expected: :attr:`tess.point_accretion.PointBins.index` can seed a
+:class:`tess.voronoi.CVTessellation`, and a
+:class:`tess.voronoi.VoronoiTessellation` made from an index reuses its
+tree for :meth:`~tess.voronoi.VoronoiTessellation.partition_points`,
+rendering and density estimates.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from catalog import coordinate_columns, scratch_array
+
+# Number of points assigned to nodes per KD-tree query
+CHUNK_SIZE = 2 ** 20
+
+
+class SpatialIndex(object):
+    """Nearest-neighbour index of a fixed set of 2D nodes.
+
+    Parameters
+    ----------
+    xy : ndarray or sequence
+        ``(n_nodes, 2)`` array of node coordinates, or a pair of
+        ``(n_nodes,)`` x and y columns.
+    leafsize : int
+        Leaf size of the :class:`scipy.spatial.cKDTree`.
+    """
+    def __init__(self, xy, leafsize=16):
+        super(SpatialIndex, self).__init__()
+        self._xy = np.column_stack(coordinate_columns(xy, dtype=np.float64))
+        self._xy.setflags(write=False)
+        self.leafsize = leafsize
+        self._tree = None
+
+    def __len__(self):
+        return self._xy.shape[0]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self._xy
+        return self._xy.astype(dtype)
+
+    @property
+    def nodes(self):
+        """Read-only ``(n_nodes, 2)`` array of the indexed nodes."""
+        return self._xy
+
+    @property
+    def tree(self):
+        """The :class:`scipy.spatial.cKDTree` of the nodes, built on first
+        use."""
+        if self._tree is None:
+            self._tree = cKDTree(self._xy, leafsize=self.leafsize)
+        return self._tree
+
+    def query(self, xy, n_jobs=1, chunk_size=CHUNK_SIZE, out=None,
+              scratch_dir=None):
+        """Index of the nearest node to each of a set of points.
+
+        Parameters
+        ----------
+        xy : ndarray or sequence
+            ``(n_points, 2)`` array of point coordinates, or a pair of
+            ``(n_points,)`` x and y columns (which may be memory maps, see
+            :func:`tess.catalog.open_catalog`).
+        n_jobs : int
+            Number of threads for each tree query (``-1`` uses all
+            processors).
+        chunk_size : int
+            Number of points per tree query, which bounds the memory used
+            for query coordinates and distances.
+        out : ndarray
+            Optional ``(n_points,)`` integer array for the result.
+        scratch_dir : str
+            If set and ``out`` is not given, the result is a memory-mapped
+            temporary file in this directory (see
+            :func:`tess.catalog.scratch_array`).
+
+        Returns
+        -------
+        indices : ndarray
+            ``(n_points,)`` array of node indices.
+        """
+        x, y = coordinate_columns(xy)
+        n_points = x.shape[0]
+        if out is None:
+            out = scratch_array(n_points, int, scratch_dir)
+        for start in xrange(0, n_points, chunk_size):
+            stop = min(start + chunk_size, n_points)
+            out[start:stop] = self.tree.query(
+                np.column_stack((x[start:stop], y[start:stop])), k=1,
+                n_jobs=n_jobs)[1]
+        return out
+
+    def nearest(self, xy, k=1, n_jobs=1):
+        """Distances to and indices of the ``k`` nearest nodes to each of a
+        set of points, in a single tree query.
+
+        Parameters
+        ----------
+        xy : ndarray or sequence
+            ``(n_points, 2)`` array of point coordinates, or a pair of
+            ``(n_points,)`` x and y columns.
+        k : int
+            Number of nearest nodes to find. Missing neighbours (if there
+            are fewer than ``k`` nodes) have infinite distance.
+        n_jobs : int
+            Number of threads for the tree query (``-1`` uses all
+            processors).
+
+        Returns
+        -------
+        distances, indices : ndarray
+            ``(n_points,)`` arrays for ``k=1``, else ``(n_points, k)`` arrays
+            sorted by distance.
+        """
+        x, y = coordinate_columns(xy)
+        return self.tree.query(np.column_stack((x, y)), k=k, n_jobs=n_jobs)
+
+
+def as_index(xy):
+    """``xy`` if it is already a :class:`SpatialIndex`, otherwise a new
+    index of the nodes ``xy``."""
+    if isinstance(xy, SpatialIndex):
+        return xy
+    return SpatialIndex(xy)
+
@@ -4,10 +4,12 @@
 Tests for the pixel_accretion module
 """
 import numpy as np
+from scipy import ndimage
 from astropy.io import fits
 
 from tess.pixel_accretion import IsoIntensityAccretor
 from tess.pixel_accretion import EqualSNAccretor
+from tess.pixel_accretion import PixelFrontier
 
 
 def test_isointensity_blockimage():
@@ -35,3 +37,356 @@ def test_iso_sn_image():
     fits.writeto("iso_sn.fits", accretor._seg_image, clobber=True)
     # Should be about 1024 groups.
     assert accretor._seg_image.max() <= 1050.
+
+
+def _random_image(shape=(40, 50), seed=1):
+    """Noisy gradient image with scattered NaN pixels and a NaN row that
+    splits it into two islands."""
+    rs = np.random.RandomState(seed)
+    img = rs.rand(*shape) * 10. + np.linspace(0., 50., shape[1])[None, :]
+    img[rs.rand(*shape) < 0.1] = np.nan
+    img[shape[0] // 4, :] = np.nan
+    return img
+
+
+def test_isointensity_compiled_matches_python():
+    """Compiled and pure-Python iso-intensity accretion give the same
+    segmap."""
+    img = _random_image()
+    for stable in (False, True):
+        compiled = IsoIntensityAccretor(img, 3., stable=stable,
+                                        compiled=True)
+        python = IsoIntensityAccretor(img, 3., stable=stable, compiled=False)
+        assert np.all(compiled.segmap == python.segmap)
+    # NaN pixels are never binned
+    assert np.all(compiled.segmap[~np.isfinite(img)] == -1)
+    assert np.all(compiled.segmap[np.isfinite(img)] >= 0)
+
+
+def test_isointensity_zero_mean():
+    """Bins seeded in a zero-intensity region don't divide by their zero
+    mean, and both paths agree."""
+    img = np.zeros((8, 8))
+    img[:, 4:] = 1.
+    for stable in (False, True):
+        compiled = IsoIntensityAccretor(img, 0.1, stable=stable,
+                                        compiled=True)
+        python = IsoIntensityAccretor(img, 0.1, stable=stable,
+                                      compiled=False)
+        assert np.all(compiled.segmap == python.segmap)
+        assert np.all(python.segmap[:, :4] != python.segmap[:, 4:])
+
+
+def test_isointensity_stable_dc_offset():
+    """With a large DC offset the Welford statistics still keep every bin
+    within the intensity sigma limit."""
+    rs = np.random.RandomState(2)
+    img = 1e9 + rs.rand(24, 24) + np.linspace(0., 4., 24)[None, :]
+    for compiled in (True, False):
+        accretor = IsoIntensityAccretor(img, 0.5, stable=True,
+                                        compiled=compiled)
+        segmap = accretor.segmap
+        for bin_num in np.unique(segmap):
+            pixels = img[segmap == bin_num] - 1e9
+            assert pixels.std() <= 0.5 + 1e-6
+
+
+def test_iso_sn_compiled_matches_python():
+    """Compiled and pure-Python equal S/N accretion give the same bins."""
+    img = _random_image()
+    noise = np.sqrt(np.abs(img)) + 1.
+    compiled = EqualSNAccretor(img, noise, 10., compiled=True)
+    python = EqualSNAccretor(img, noise, 10., compiled=False)
+    assert np.all(compiled.segmap == python.segmap)
+    assert compiled._valid_bins == python._valid_bins
+    assert np.allclose(np.array(compiled._current_bin_centroids),
+                       np.array(python._current_bin_centroids))
+
+
+def test_subclass_hooks_use_python_path():
+    """Subclasses that override a hook fall back to the Python path."""
+    class CappedAccretor(IsoIntensityAccretor):
+        def accept_pixel(self, idx):
+            if len(self.current_bin_indices) >= 4:
+                return False
+            return super(CappedAccretor, self).accept_pixel(idx)
+
+    img = np.ones((8, 8), dtype=float)
+    accretor = CappedAccretor(img, 0.1)
+    assert accretor._criterion is None
+    assert np.bincount(accretor.segmap.ravel()).max() == 4
+
+
+def test_iso_sn_lazy_rescoring():
+    """Lazy frontier rescoring gives the same bins on both paths, and about
+    the same number of bins as rescoring after every pixel."""
+    img = _random_image(shape=(60, 60), seed=3)
+    noise = np.sqrt(np.abs(img)) + 1.
+    exact = EqualSNAccretor(img, noise, 10.)
+    compiled = EqualSNAccretor(img, noise, 10., max_centroid_shift=0.5)
+    python = EqualSNAccretor(img, noise, 10., max_centroid_shift=0.5,
+                             compiled=False)
+    assert np.all(compiled.segmap == python.segmap)
+    assert abs(compiled.segmap.max() - exact.segmap.max()) \
+        < 0.05 * exact.segmap.max()
+
+
+def test_pixel_frontier_lazy_rescoring():
+    """Rescored pixels pop in their new order; stale entries are skipped."""
+    frontier = PixelFrontier()
+    for k, idx in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        frontier.push(idx, float(k))
+    frontier.rescore((1, 1), -1.)
+    frontier.rescore_many([(0, 0), (0, 1)], np.array([5., 0.5]))
+    assert len(frontier) == 4
+    popped = [frontier.pop() for i in range(4)]
+    assert popped == [(-1., (1, 1)), (0.5, (0, 1)), (2., (1, 0)),
+                      (5., (0, 0))]
+    assert len(frontier) == 0
+    assert frontier.stats['n_rescores'] == 3
+    assert frontier.stats['max_size'] == 4
+
+
+def test_seeding_modes_agree():
+    """Seeding from sorted intensities or from labeled islands gives the
+    same bins when every island has a unique brightest pixel."""
+    img = _random_image(shape=(50, 50), seed=4)
+    # Grid of NaN rows and columns cuts the image into many islands
+    img[::7, :] = np.nan
+    img[:, ::9] = np.nan
+    noise = np.sqrt(np.abs(img)) + 1.
+    for compiled in (True, False):
+        sorted_seeds = EqualSNAccretor(img, noise, 8., seeding='sorted',
+                                       compiled=compiled)
+        islands = EqualSNAccretor(img, noise, 8., seeding='components',
+                                  compiled=compiled)
+        assert np.all(sorted_seeds.segmap == islands.segmap)
+        assert np.all(islands.segmap[np.isfinite(img)] >= 0)
+
+
+def test_bin_statistics():
+    """Vectorized per-bin statistics match a bin-by-bin computation."""
+    img = _random_image(seed=5)
+    noise = np.sqrt(np.abs(img)) + 1.
+    accretor = EqualSNAccretor(img, noise, 10.)
+    segmap = accretor.segmap
+    bin_nums = np.unique(segmap[segmap >= 0])
+    assert np.all(accretor.bin_nums == bin_nums)
+    stats = accretor.zonal_stats(img, weights=accretor.centroid_weightmap)
+    for k, bin_num in enumerate(bin_nums):
+        y, x = np.where(segmap == bin_num)
+        values = img[y, x]
+        w = accretor.centroid_weightmap[y, x]
+        assert stats['count'][k] == len(values)
+        assert np.allclose(stats['mean'][k], values.mean())
+        assert np.allclose(stats['var'][k], values.var())
+        assert np.allclose(accretor.centroids[k],
+                           (np.average(x, weights=w),
+                            np.average(y, weights=w)))
+        assert np.allclose(accretor.bin_sn[k],
+                           values.sum() / np.sqrt(np.sum(noise[y, x] ** 2.)))
+
+    # Cached statistics are recomputed once the segmap changes
+    n_bins = len(accretor.bin_nums)
+    accretor.blank_bad_bins()
+    assert len(accretor.bin_nums) == n_bins - np.sum(
+        ~np.array(accretor._valid_bins))
+    assert np.all(accretor.bin_sn >= 10.)
+
+
+def test_block_statistics(monkeypatch):
+    """Per-bin statistics accumulated over many blocks of rows match those
+    of a single block."""
+    import tess.pixel_accretion
+    img = _random_image(seed=5)
+    noise = np.sqrt(np.abs(img)) + 1.
+    accretor = EqualSNAccretor(img, noise, 10.)
+    expected = accretor.zonal_stats(img, weights=accretor.centroid_weightmap)
+    expected_sn = accretor.bin_sn
+    expected_elongation = accretor.bin_elongation
+    expected_centroids = accretor.centroids
+    monkeypatch.setattr(tess.pixel_accretion, 'BLOCK_PIXELS',
+                        3 * img.shape[1] + 5)
+    accretor._segmap_changed()
+    assert len(accretor._row_blocks()) > 10
+    stats = accretor.zonal_stats(img, weights=accretor.centroid_weightmap)
+    for key in expected:
+        assert np.allclose(stats[key], expected[key])
+    assert np.allclose(accretor.bin_sn, expected_sn)
+    assert np.allclose(accretor.bin_elongation, expected_elongation)
+    assert np.allclose(accretor.centroids, expected_centroids)
+
+
+def test_seed_order_blocks(monkeypatch):
+    """Seeds gathered over many blocks of rows are C ints in the same order
+    as sorting the whole image at once, with ties kept in pixel order."""
+    import tess.pixel_accretion
+    img = np.floor(_random_image(shape=(40, 30), seed=6))
+    img[::7, :] = np.nan
+    img[:, ::9] = np.nan
+    valid = np.isfinite(img).ravel()
+    pixels = np.flatnonzero(valid)
+    expected = pixels[np.argsort(-img.ravel()[pixels], kind='mergesort')]
+    # Without ties, the brightest pixel of each island is its first pixel
+    # in the sorted order
+    smooth = _random_image(shape=(40, 30), seed=6)
+    smooth[~np.isfinite(img)] = np.nan
+    smooth_order = pixels[np.argsort(-smooth.ravel()[pixels])]
+    labels = ndimage.label(np.isfinite(img))[0].ravel()
+    first = np.unique(labels[smooth_order], return_index=True)[1]
+    islands = smooth_order[np.sort(first)]
+    for block_pixels in (2 ** 20, 2 * img.shape[1] + 5):
+        monkeypatch.setattr(tess.pixel_accretion, 'BLOCK_PIXELS',
+                            block_pixels)
+        accretor = IsoIntensityAccretor(img, 3.)
+        accretor._seg_image[:] = -1
+        seeds = accretor._seed_order()
+        assert seeds.dtype == np.intc
+        assert np.all(seeds == expected)
+        accretor = IsoIntensityAccretor(smooth, 3., seeding='components')
+        accretor._seg_image[:] = -1
+        seeds = accretor._seed_order()
+        assert seeds.dtype == np.intc
+        assert np.all(seeds == islands)
+
+
+def test_tiled_accretion():
+    """Tiled accretion bins every valid pixel into contiguous bins, agrees
+    between worker counts, and makes about as many bins as a serial run."""
+    img = _random_image(shape=(80, 90), seed=6)
+    noise = np.sqrt(np.abs(img)) + 1.
+    serial = EqualSNAccretor(img, noise, 10.)
+    tiled = EqualSNAccretor(img, noise, 10., tile_shape=(32, 32),
+                            tile_overlap=8)
+    parallel = EqualSNAccretor(img, noise, 10., tile_shape=(32, 32),
+                               tile_overlap=8, n_workers=2)
+    segmap = tiled.segmap
+    assert np.all(parallel.segmap == segmap)
+    assert np.all(segmap[np.isfinite(img)] >= 0)
+    assert np.all(segmap[~np.isfinite(img)] == -1)
+    assert np.all(tiled.bin_nums == np.arange(segmap.max() + 1))
+    assert len(tiled._valid_bins) == segmap.max() + 1
+    assert abs(segmap.max() - serial.segmap.max()) \
+        < 0.1 * serial.segmap.max()
+    python = EqualSNAccretor(img, noise, 10., tile_shape=(32, 32),
+                             tile_overlap=8, compiled=False)
+    assert np.all(python.segmap == segmap)
+
+
+def test_memmap_segmap(tmpdir):
+    """Memory-mapped images are binned into a caller-supplied int32
+    memory-mapped segmap, giving the same bins as in-memory arrays."""
+    img = _random_image(seed=7)
+    noise = np.sqrt(np.abs(img)) + 1.
+    expected = EqualSNAccretor(img, noise, 10.)
+    maps = {}
+    for name, data in (('image', img), ('noise', noise)):
+        maps[name] = np.memmap(str(tmpdir.join(name + '.dat')),
+                               dtype=float, mode='w+', shape=img.shape)
+        maps[name][:] = data
+    for compiled in (True, False):
+        segmap = np.memmap(str(tmpdir.join('segmap.dat')), dtype=np.int32,
+                           mode='w+', shape=img.shape)
+        accretor = EqualSNAccretor(maps['image'], maps['noise'], 10.,
+                                   segmap=segmap, compiled=compiled)
+        assert accretor.segmap is segmap
+        assert np.all(segmap == expected.segmap)
+        assert np.allclose(accretor.centroids, expected.centroids)
+    # Read-only inputs, as when a mosaic is opened with mode='r'
+    for name in maps:
+        maps[name].flush()
+        maps[name] = np.memmap(str(tmpdir.join(name + '.dat')),
+                               dtype=float, mode='r', shape=img.shape)
+    for compiled in (True, False):
+        accretor = EqualSNAccretor(maps['image'], maps['noise'], 10.,
+                                   compiled=compiled)
+        assert np.all(accretor.segmap == expected.segmap)
+    frozen = img.copy()
+    frozen.setflags(write=False)
+    assert np.all(IsoIntensityAccretor(frozen, 3.).segmap
+                  == IsoIntensityAccretor(img, 3.).segmap)
+    small = IsoIntensityAccretor(img, 3., segmap_dtype=np.int32)
+    assert small.segmap.dtype == np.int32
+    assert np.all(small.segmap == IsoIntensityAccretor(img, 3.).segmap)
+
+
+def test_iso_sn_cleanup():
+    """Failed bins are merged into good bins by nearest centroid (matching
+    a bin-by-bin reassignment) or into their best-touching neighbour."""
+    img = _random_image(shape=(60, 60), seed=8)
+    noise = np.sqrt(np.abs(img)) + 1.
+    accretor = EqualSNAccretor(img, noise, 15.)
+    valid = np.array(accretor._valid_bins)
+    assert not np.all(valid)
+    good_bins = np.flatnonzero(valid)
+    centroids = np.array(accretor._current_bin_centroids)[good_bins]
+    segmap = accretor.segmap.copy()
+    accretor.cleanup(n_jobs=2)
+    kept = np.in1d(segmap, good_bins).reshape(segmap.shape)
+    assert np.all(accretor.segmap[kept] == segmap[kept])
+    for bin_num in np.flatnonzero(~valid):
+        y, x = np.where(segmap == bin_num)
+        d = (y[:, None] - centroids[None, :, 0]) ** 2. \
+            + (x[:, None] - centroids[None, :, 1]) ** 2.
+        assigned = np.searchsorted(good_bins, accretor.segmap[y, x])
+        assert np.allclose(d[np.arange(len(y)), assigned], d.min(axis=1))
+
+    adjacent = EqualSNAccretor(img, noise, 15.)
+    segmap = adjacent.segmap.copy()
+    adjacent.cleanup(merge='adjacent')
+    assert np.all(np.in1d(adjacent.bin_nums, good_bins))
+    for bin_num in np.flatnonzero(~valid):
+        new = np.unique(adjacent.segmap[segmap == bin_num])
+        # each failed bin is merged whole
+        assert len(new) == 1
+
+    blanked = EqualSNAccretor(img, noise, 15.)
+    blanked.blank_bad_bins()
+    assert np.all(blanked.bin_nums == good_bins)
+
+
+def test_connectivity():
+    """With 8-connectivity diagonal pixels are accreted, on both paths."""
+    # A diagonal line of finite pixels only connects through corners
+    img = np.nan * np.ones((6, 6))
+    img[np.arange(6), np.arange(6)] = 1.
+    for compiled in (True, False):
+        four = IsoIntensityAccretor(img, 0.1, compiled=compiled)
+        eight = IsoIntensityAccretor(img, 0.1, connectivity=8,
+                                     compiled=compiled)
+        assert four.segmap.max() == 5
+        assert eight.segmap.max() == 0
+        islands = IsoIntensityAccretor(img, 0.1, connectivity=8,
+                                       seeding='components',
+                                       compiled=compiled)
+        assert np.all(islands.segmap == eight.segmap)
+    img = _random_image(seed=9)
+    noise = np.sqrt(np.abs(img)) + 1.
+    compiled = EqualSNAccretor(img, noise, 10., connectivity=8)
+    python = EqualSNAccretor(img, noise, 10., connectivity=8, compiled=False)
+    assert np.all(compiled.segmap == python.segmap)
+
+
+def test_max_elongation():
+    """Bins of three or more pixels respect the elongation limit on both
+    paths, and the reported elongations match the bins' pixels."""
+    # A long strip accretes into elongated bins unless limited
+    img = 5. * np.ones((4, 64), dtype=float)
+    noise = np.ones((4, 64), dtype=float)
+    free = EqualSNAccretor(img, noise, 40.)
+    assert free.bin_elongation.max() > 2.
+    compiled = EqualSNAccretor(img, noise, 40., max_elongation=1.5)
+    python = EqualSNAccretor(img, noise, 40., max_elongation=1.5,
+                             compiled=False)
+    assert np.all(compiled.segmap == python.segmap)
+    counts = np.bincount(compiled.segmap.ravel())
+    elongation = compiled.bin_elongation
+    assert np.all(elongation[counts[compiled.bin_nums] >= 3] <= 1.5 + 1e-9)
+    # A 2x2 block is round, and a domino is twice as long as it is wide
+    for label, expected in ((0, 1.), (1, 2.)):
+        segmap = -np.ones((4, 4), dtype=int)
+        segmap[:2, :2 - label] = label
+        accretor = IsoIntensityAccretor(np.ones((4, 4)), 0.1)
+        accretor.segmap[:] = segmap
+        accretor._segmap_changed()
+        assert np.allclose(accretor.bin_elongation, expected)
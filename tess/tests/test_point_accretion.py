@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for the point_accretion module
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import tess
+import tess.catalog
+from tess.point_accretion import UnbinnedGrid
+from tess.point_accretion import EqualMassAccretor
+from tess.catalog import open_catalog
+
+
+def test_unbinned_grid_nearest():
+    """The grid finds the same nearest unbinned point as a brute-force
+    search while points are removed, including after it is rebuilt."""
+    rs = np.random.RandomState(0)
+    xy = np.vstack((rs.randn(300, 2), rs.randn(100, 2) * 0.1 + 5.))
+    grid = UnbinnedGrid(xy)
+    live = np.ones(len(xy), dtype=bool)
+    for k in range(len(xy)):
+        q = rs.randn(2) * 3.
+        d = np.sum((xy - q) ** 2., axis=1)
+        d[~live] = np.inf
+        idx = grid.nearest(q[0], q[1])
+        assert idx == np.argmin(d)
+        grid.remove(idx)
+        live[idx] = False
+    assert len(grid) == 0
+    assert grid.nearest(0., 0.) == -1
+
+
+def test_equal_mass_accretion():
+    """Every bin of an equal mass accretion has a finite node."""
+    rs = np.random.RandomState(1)
+    xy = rs.randn(1000, 2)
+    mass = rs.rand(1000)
+    accretor = EqualMassAccretor(xy, mass, 5.)
+    accretor.accrete()
+    node_xy = np.asarray(accretor.nodes())
+    assert len(node_xy) >= 1000 * 0.5 / 5. * 0.8
+    assert np.all(np.isfinite(node_xy))
+    # Bin membership in CSR form agrees with the nodes
+    bin_offsets, point_order = accretor.membership()
+    assert len(bin_offsets) == len(node_xy) + 1
+    assert np.all(np.sort(point_order) == np.arange(1000))
+    for k in range(len(node_xy)):
+        members = point_order[bin_offsets[k]:bin_offsets[k + 1]]
+        assert np.allclose(node_xy[k],
+                           np.average(xy[members], axis=0,
+                                      weights=mass[members]))
+
+
+def test_point_cleanup():
+    """Points of failed bins are moved to the good bin with the nearest
+    node, and the good bins keep their order."""
+    rs = np.random.RandomState(3)
+    xy = rs.randn(2000, 2)
+    mass = rs.rand(2000)
+    accretor = EqualMassAccretor(xy, mass, 20.)
+    accretor.accrete()
+    nodes = np.asarray(accretor.nodes())
+    bin_offsets, point_order = accretor.membership()
+    bins = np.split(point_order, bin_offsets[1:-1])
+    good = np.flatnonzero(np.array([mass[b].sum() >= 20. for b in bins]))
+    assert len(good) < len(bins)
+    accretor.cleanup()
+    new_offsets, new_order = accretor.membership()
+    assert len(new_offsets) == len(good) + 1
+    new_bins = np.split(new_order, new_offsets[1:-1])
+    for k, new_bin in enumerate(new_bins):
+        # Each good bin keeps its points and gains only nearby points
+        old_bin = bins[good[k]]
+        assert np.all(np.in1d(old_bin, new_bin))
+        gained = np.setdiff1d(new_bin, old_bin)
+        d = np.sum((xy[gained, None, :] - nodes[None, good, :]) ** 2.,
+                   axis=2)
+        assert np.all(np.argmin(d, axis=1) == k)
+
+
+def test_domain_decomposition():
+    """Accreting spatial domains in parallel bins every point, does not
+    depend on the number of threads, and makes about as many bins as a
+    serial run."""
+    rs = np.random.RandomState(4)
+    xy = rs.randn(5000, 2)
+    mass = rs.rand(5000)
+    serial = EqualMassAccretor(xy, mass, 10.)
+    serial.accrete()
+    n_serial = len(serial.membership()[0]) - 1
+    results = []
+    for n_threads in (1, 3):
+        accretor = EqualMassAccretor(xy, mass, 10.)
+        accretor.accrete(n_domains=8, n_threads=n_threads)
+        bin_offsets, point_order = accretor.membership()
+        assert np.all(np.sort(point_order) == np.arange(5000))
+        results.append((bin_offsets, point_order))
+    assert np.all(results[0][0] == results[1][0])
+    assert np.all(results[0][1] == results[1][1])
+    bin_offsets, point_order = results[0]
+    assert abs(len(bin_offsets) - 1 - n_serial) < 0.1 * n_serial
+    masses = np.add.reduceat(mass[point_order], bin_offsets[:-1])
+    # Only bins made last, from the leftover boundary points, can fail
+    assert np.sum(masses < 10.) <= 1
+
+
+def test_catalog_accretion(tmpdir):
+    """Accreting memory-mapped catalog columns, with memory-mapped scratch
+    arrays, gives the same bins as in-memory arrays; single precision
+    coordinates give bins of the same quality."""
+    rs = np.random.RandomState(5)
+    xy = rs.randn(3000, 2)
+    mass = rs.rand(3000)
+    table = np.zeros(3000, dtype=[('x', 'f8'), ('y', 'f8'), ('mass', 'f8')])
+    table['x'], table['y'], table['mass'] = xy[:, 0], xy[:, 1], mass
+    np.save(str(tmpdir.join('catalog.npy')), table)
+    column_dir = tmpdir.mkdir('columns')
+    for name in ('x', 'y', 'mass'):
+        np.save(str(column_dir.join(name + '.npy')), table[name])
+    scratch_dir = tmpdir.mkdir('scratch')
+
+    reference = EqualMassAccretor(xy, mass, 10.)
+    reference.accrete()
+    ref_offsets, ref_order = reference.membership()
+    for path in (str(tmpdir.join('catalog.npy')), str(column_dir)):
+        x, y, m = open_catalog(path, columns=('x', 'y', 'mass'))
+        assert isinstance(x, np.memmap)
+        accretor = EqualMassAccretor((x, y), m, 10.,
+                                     scratch_dir=str(scratch_dir))
+        accretor.accrete()
+        bin_offsets, point_order = accretor.membership()
+        assert np.all(bin_offsets == ref_offsets)
+        assert np.all(point_order == ref_order)
+    # Scratch files are removed once unused
+    del accretor
+    assert len(scratch_dir.listdir()) == 0
+
+    accretor = EqualMassAccretor(xy, mass, 10., dtype=np.float32)
+    accretor.accrete()
+    bin_offsets, point_order = accretor.membership()
+    assert np.all(np.sort(point_order) == np.arange(3000))
+    assert abs(len(bin_offsets) - len(ref_offsets)) < 0.05 * len(ref_offsets)
+    masses = np.add.reduceat(mass[point_order], bin_offsets[:-1])
+    assert np.sum(masses < 10.) <= 1
+
+
+def test_accretion_result(capsys):
+    """The accretion result is computed once and agrees with the bin
+    membership, and nothing is printed."""
+    rs = np.random.RandomState(3)
+    xy = rs.randn(2000, 2)
+    mass = rs.rand(2000)
+    accretor = EqualMassAccretor(xy, mass, 20.)
+    accretor.accrete()
+    result = accretor.result()
+    assert accretor.result() is result
+    assert np.all(accretor.nodes() == result.nodes)
+    assert result.n_bins == len(result.bin_offsets) - 1
+    assert np.all(result.bin_ids[result.point_order] ==
+                  np.repeat(np.arange(result.n_bins),
+                            np.diff(result.bin_offsets)))
+    assert np.allclose(result.node_mass,
+                       np.bincount(result.bin_ids, weights=mass))
+    assert np.all(result.good == (result.node_mass >= 20.))
+    assert not result.good.all()
+
+    accretor.cleanup()
+    cleaned = accretor.result()
+    assert cleaned is not result
+    assert cleaned.good.all()
+    assert cleaned.n_bins == np.sum(result.good)
+    out, err = capsys.readouterr()
+    assert out == ''
+
+
+def test_max_elongation():
+    """Point bins of three or more points respect the elongation limit,
+    which agrees with the moments of each bin."""
+    rs = np.random.RandomState(6)
+    # A thin strip of points makes elongated bins unless limited
+    xy = rs.rand(3000, 2) * [50., 1.]
+    mass = rs.rand(3000)
+    free = EqualMassAccretor(xy, mass, 20.)
+    free.accrete()
+    assert free.result().elongation.max() > 3.
+    accretor = EqualMassAccretor(xy, mass, 20., max_elongation=2.)
+    accretor.accrete()
+    result = accretor.result()
+    sizes = np.diff(result.bin_offsets)
+    assert np.all(result.elongation[sizes >= 3] <= 2. + 1e-9)
+    assert np.all(np.sort(result.point_order) == np.arange(3000))
+    for k in np.flatnonzero(sizes >= 3)[:20]:
+        members = result.point_order[result.bin_offsets[k]:
+                                     result.bin_offsets[k + 1]]
+        c = np.cov(xy[members].T, bias=1)
+        cell = np.pi * np.trace(c) / (6. * len(members))
+        lam = np.linalg.eigvalsh(c) + cell
+        assert np.allclose(result.elongation[k], np.sqrt(lam[1] / lam[0]))
+
+
+def test_scratch_reaccretion_and_cleanup(tmpdir, monkeypatch):
+    """Re-accreting failed domain bins and rebuilding the membership after
+    cleanup keep the per-point arrays in scratch files, and agree with
+    in-memory runs."""
+    import tess.point_accretion
+    scratch = []
+
+    def scratch_array(shape, dtype, scratch_dir=None):
+        scratch.append(tess.catalog.scratch_array(shape, dtype, scratch_dir))
+        return scratch[-1]
+
+    def in_scratch(a):
+        return any(isinstance(s, np.memmap) and np.may_share_memory(a, s)
+                   for s in scratch)
+
+    monkeypatch.setattr(tess.point_accretion, 'scratch_array', scratch_array)
+    rs = np.random.RandomState(6)
+    xy = rs.randn(4000, 2)
+    mass = rs.rand(4000)
+    reference = EqualMassAccretor(xy, mass, 10.)
+    accretor = EqualMassAccretor(xy, mass, 10., scratch_dir=str(tmpdir))
+    for a in (reference, accretor):
+        a.accrete(n_domains=8)
+    bin_offsets, point_order = accretor.membership()
+    assert in_scratch(point_order) and in_scratch(bin_offsets)
+    assert np.all(bin_offsets == reference.membership()[0])
+    assert np.all(point_order == reference.membership()[1])
+
+    for a in (reference, accretor):
+        a.cleanup()
+    bin_offsets, point_order = accretor.membership()
+    assert in_scratch(point_order) and in_scratch(bin_offsets)
+    bin_ids = accretor.result().bin_ids
+    assert np.all(point_order == np.argsort(bin_ids, kind='mergesort'))
+    assert np.all(bin_offsets == np.concatenate(
+        ([0], np.cumsum(np.bincount(bin_ids)))))
+    assert np.all(point_order == reference.membership()[1])
+
+CRITERION_PYX = """
+from tess.point_accretion cimport PointAccretor, BinState
+
+
+cdef class EqualCountAccretor(PointAccretor):
+    cdef long target_count
+
+    def __init__(self, xy, w, long target_count):
+        self.target_count = target_count
+        self._init_points(xy, w, None, None)
+
+    cdef bint bin_full(self, BinState *state) nogil:
+        return state.count >= self.target_count
+"""
+
+
+def test_cimported_criterion(tmpdir):
+    """A criterion compiled in another Cython module against
+    point_accretion.pxd overrides the nogil ``bin_full`` hook."""
+    pyximport = pytest.importorskip('pyximport')
+    tmpdir.join('count_criterion.pyx').write(CRITERION_PYX)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(tess.__file__)))
+    importers = pyximport.install(
+        build_dir=str(tmpdir.join('build')), language_level=2,
+        setup_args={'include_dirs': [root, np.get_include()]})
+    sys.path.insert(0, str(tmpdir))
+    try:
+        from count_criterion import EqualCountAccretor
+    finally:
+        sys.path.remove(str(tmpdir))
+        pyximport.uninstall(*importers)
+    rs = np.random.RandomState(5)
+    xy = rs.randn(500, 2)
+    accretor = EqualCountAccretor(xy, np.ones(500), 7)
+    accretor.accrete()
+    bins = accretor.result()
+    counts = np.diff(accretor.membership()[0])
+    assert np.all(counts[bins.good] == 7)
+    assert np.sum(bins.good) >= 500 // 7 - 10
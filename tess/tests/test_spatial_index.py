@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for the spatial_index module
+"""
+import numpy as np
+
+from tess.spatial_index import SpatialIndex
+from tess.point_accretion import EqualMassAccretor
+from tess.voronoi import CVTessellation
+
+
+def test_query_chunks_and_columns():
+    """Chunked, threaded queries of coordinate columns match a brute-force
+    nearest-node search, and the tree is built only once."""
+    rs = np.random.RandomState(1)
+    nodes = rs.rand(50, 2)
+    xy = rs.rand(1000, 2).astype(np.float32)
+    index = SpatialIndex(nodes)
+    d2 = ((xy[:, None, :] - nodes[None, :, :]) ** 2).sum(axis=2)
+    expected = np.argmin(d2, axis=1)
+    assert np.all(index.query(xy) == expected)
+    tree = index.tree
+    indices = index.query((xy[:, 0], xy[:, 1]), chunk_size=77, n_jobs=2)
+    assert np.all(indices == expected)
+    assert index.tree is tree
+    assert np.all(np.asarray(index) == nodes)
+
+
+def test_pipeline_reuses_index():
+    """The node index of point bins seeds a CVT, and a tessellation keeps
+    one index for partitioning and rendering."""
+    rs = np.random.RandomState(2)
+    xy = rs.rand(2000, 2) * 20.
+    mass = rs.rand(2000)
+    accretor = EqualMassAccretor(xy, mass, 50.)
+    accretor.accrete()
+    bins = accretor.result()
+    assert bins.index is bins.index
+    cvt = CVTessellation(xy, mass, node_xy=bins.index, max_iters=5)
+    assert cvt.nodes.shape == bins.nodes.shape
+    index = cvt.index
+    cvt.set_pixel_grid((0, 20), (0, 20))
+    ygrid, xgrid = np.mgrid[0:20, 0:20]
+    pixels = np.column_stack((xgrid.ravel(), ygrid.ravel()))
+    d2 = ((pixels[:, None, :] - cvt.nodes[None, :, :]) ** 2).sum(axis=2)
+    assert np.all(cvt.segmap.ravel() == np.argmin(d2, axis=1))
+    assert np.all(cvt.partition_points(pixels) == cvt.segmap.ravel())
+    assert cvt.index is index
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests for the voronoi module
+"""
+import numpy as np
+import pytest
+
+from tess.voronoi import CVTessellation
+
+
+def test_cvt_columns(tmpdir):
+    """A CVT of memory-mapped coordinate columns matches one of an
+    in-memory array, and single precision coordinates give nearly the same
+    nodes."""
+    rs = np.random.RandomState(0)
+    xy = rs.rand(2000, 2)
+    dens = rs.rand(2000)
+    generators = rs.rand(20, 2)
+    np.save(str(tmpdir.join('x.npy')), xy[:, 0])
+    np.save(str(tmpdir.join('y.npy')), xy[:, 1])
+    x = np.load(str(tmpdir.join('x.npy')), mmap_mode='r')
+    y = np.load(str(tmpdir.join('y.npy')), mmap_mode='r')
+
+    cvt = CVTessellation(xy, dens, node_xy=generators, max_iters=20)
+    cvt_columns = CVTessellation((x, y), dens, node_xy=generators,
+                                 max_iters=20, scratch_dir=str(tmpdir))
+    assert np.all(cvt_columns.nodes == cvt.nodes)
+    assert np.all(cvt_columns.membership == cvt.membership)
+    assert np.allclose(cvt.node_weights.sum(), dens.sum())
+
+    cvt32 = CVTessellation(xy, dens, node_xy=generators, max_iters=20,
+                           dtype=np.float32)
+    assert np.allclose(cvt32.nodes, cvt.nodes, atol=1e-3)
+
+
+def test_lloyd_tolerances(capsys):
+    """Tolerances stop Lloyd's algorithm early, the callback sees every
+    iteration's statistics, and nothing is printed."""
+    rs = np.random.RandomState(1)
+    xy = rs.rand(3000, 2)
+    dens = rs.rand(3000)
+    generators = rs.rand(30, 2)
+    strict = []
+    CVTessellation(xy, dens, node_xy=generators, max_iters=300,
+                   callback=strict.append)
+    assert strict[0]['n_reassigned'] == 3000
+    assert [s['iteration'] for s in strict] == list(range(len(strict)))
+    assert strict[-1]['max_shift'] == 0.
+    for s in strict:
+        assert s['reassigned_frac'] == s['n_reassigned'] / 3000.
+        assert s['assign_time'] >= 0. and s['update_time'] >= 0.
+
+    loose = []
+    CVTessellation(xy, dens, node_xy=generators, max_iters=300, rtol=0.05,
+                   callback=loose.append)
+    assert len(loose) < len(strict)
+    assert loose[-1]['max_shift'] <= 0.05 * loose[0]['max_shift']
+    assert all(s['max_shift'] > 0.05 * loose[0]['max_shift']
+               for s in loose[1:-1])
+
+    few = []
+    CVTessellation(xy, dens, node_xy=generators, max_iters=300,
+                   reassign_tol=0.01, callback=few.append)
+    assert few[-1]['reassigned_frac'] <= 0.01
+    out, err = capsys.readouterr()
+    assert out == ''
+
+
+def test_lloyd_threads():
+    """Threaded Lloyd iterations agree with a single thread to rounding."""
+    from tess.lloyd import lloyd
+    rs = np.random.RandomState(3)
+    xy = rs.rand(20000, 2)
+    w = rs.rand(20000)
+    generators = rs.rand(40, 2)
+    nodes1, idx1, converged1 = lloyd(xy, w, generators, 10, n_jobs=1)
+    nodes4, idx4, converged4 = lloyd(xy, w, generators, 10, n_jobs=4,
+                                     chunk_size=3000)
+    assert np.allclose(nodes1, nodes4, rtol=0., atol=1e-9)
+    assert np.mean(idx1 == idx4) > 0.999
+
+
+def test_lloyd_incremental():
+    """Bounds-based incremental assignment gives the same tessellation as
+    full assignment while skipping most queries in late iterations."""
+    rs = np.random.RandomState(4)
+    y, x = np.mgrid[0:80, 0:80]
+    density = np.exp(-np.hypot(x - 40., y - 40.) / 20.)
+    generators = rs.rand(60, 2) * 80.
+    full, incremental = [], []
+    cvt = CVTessellation.from_image(density, generators, max_iters=50,
+                                    callback=full.append)
+    cvt_inc = CVTessellation.from_image(density, generators, max_iters=50,
+                                        incremental=True,
+                                        callback=incremental.append)
+    assert np.allclose(cvt_inc.nodes, cvt.nodes)
+    assert np.all(cvt_inc.membership == cvt.membership)
+    assert [s['n_reassigned'] for s in incremental] == \
+        [s['n_reassigned'] for s in full]
+    assert all(s['skipped_frac'] == 0. for s in full)
+    assert incremental[0]['skipped_frac'] == 0.
+    assert incremental[-1]['skipped_frac'] > 0.8
+
+
+def test_minibatch_cvt():
+    """Mini-batch CVTs are reproducible for a seed, assign every point to
+    its nearest final node, and balance cell masses about as well as
+    Lloyd's algorithm. Options of full Lloyd iterations raise rather than
+    being ignored."""
+    rs = np.random.RandomState(5)
+    xy = rs.randn(20000, 2)
+    dens = np.ones(20000)
+    generators = xy[:50]
+    cvt = CVTessellation(xy, dens, node_xy=generators, rtol=1e-3)
+    kwargs = dict(node_xy=generators, max_iters=40, method='minibatch',
+                  batch_size=2000, seed=7)
+    minibatch = CVTessellation(xy, dens, **kwargs)
+    again = CVTessellation(xy, dens, **kwargs)
+    assert np.all(again.nodes == minibatch.nodes)
+    assert np.all(minibatch.partition_points(xy) == minibatch.membership)
+    assert minibatch.node_weights.sum() == 20000
+    scatter = np.std(minibatch.node_weights) / np.mean(minibatch.node_weights)
+    lloyd_scatter = np.std(cvt.node_weights) / np.mean(cvt.node_weights)
+    assert scatter < 1.5 * lloyd_scatter
+    # Options of full Lloyd iterations are not silently ignored
+    for option in ({'atol': 0.1}, {'rtol': 0.1}, {'reassign_tol': 0.1},
+                   {'incremental': True}):
+        with pytest.raises(ValueError) as excinfo:
+            CVTessellation(xy, dens, **dict(kwargs, **option))
+        assert repr(list(option)[0]) in str(excinfo.value)
+
+
+def test_pyramid_cvt():
+    """A coarse-to-fine CVT of an image visits the levels coarsest first,
+    assigns every finite pixel to its nearest node, and balances cell masses
+    about as well as a full-resolution CVT."""
+    rs = np.random.RandomState(6)
+    y, x = np.mgrid[0:151, 0:133]
+    density = np.exp(-np.hypot(x - 60., y - 80.) / 30.)
+    density[rs.rand(*density.shape) < 0.05] = np.nan
+    generators = rs.rand(40, 2) * 130.
+    cvt = CVTessellation.from_image(density, generators, rtol=1e-3)
+    stats = []
+    pyramid = CVTessellation.from_image(density, generators, levels=3,
+                                        rtol=1e-3, block_rows=37,
+                                        callback=stats.append)
+    levels = [s['level'] for s in stats]
+    assert levels[0] == 3 and levels[-1] == 0
+    assert levels == sorted(levels, reverse=True)
+    assert sum(1 for level in levels if level == 0) <= 5
+
+    good = np.isfinite(density)
+    pixels = np.column_stack((x[good], y[good]))
+    assert np.all(pyramid.membership == pyramid.partition_points(pixels))
+    assert np.allclose(pyramid.node_weights,
+                       np.bincount(pyramid.membership,
+                                   weights=density[good], minlength=40))
+    assert np.allclose(pyramid.node_weights.sum(), np.nansum(density))
+    scatter = np.std(pyramid.node_weights) / np.mean(pyramid.node_weights)
+    full_scatter = np.std(cvt.node_weights) / np.mean(cvt.node_weights)
+    assert scatter < 1.5 * full_scatter
+
+
+def test_pyramid_cvt_options():
+    """Image tessellations reject the arguments that only apply to point
+    tessellations, and have no per-point densities."""
+    density = np.ones((40, 40))
+    generators = np.random.RandomState(7).rand(5, 2) * 40.
+    for option in ({'incremental': True}, {'reassign_tol': 0.1},
+                   {'dtype': np.float32}, {'method': 'minibatch'},
+                   {'batch_size': 100}):
+        with pytest.raises(ValueError) as excinfo:
+            CVTessellation.from_image(density, generators, levels=2,
+                                      **option)
+        assert repr(list(option)[0]) in str(excinfo.value)
+    cvt = CVTessellation.from_image(density, generators, levels=2)
+    assert cvt.densPoints is None
+    assert cvt.node_weights.sum() == 1600.
+    assert cvt.xlim == (0, 40) and cvt.ylim == (0, 40)
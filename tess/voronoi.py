@@ -5,8 +5,8 @@ Representation of Voronoi Tessellations.
 
 The :class:`VoronoiTessellation` class  provides basic support for Voronoi
 tessellations, partitioning points in Voronoi cells, and rendering Voronoi
-fields. This class uses KD Trees to associate points and pixels to Voronoi
-cells.
+fields. This class uses a :class:`tess.spatial_index.SpatialIndex` of its
+nodes, built once, to associate points and pixels to Voronoi cells.
 
 The :class:`CVTessellation` class is used to build a Voronoi tessellation by
 finding the nodes the partition a data set into cells of equal mass. Once
@@ -19,13 +19,17 @@ in this approach.
 """
 
 import numpy as np
-from scipy.interpolate import griddata
-from scipy.spatial import KDTree
 
 import logging
 log = logging.getLogger(__name__)
 
-from lloyd import lloyd
+from lloyd import lloyd, minibatch_lloyd, pyramid_lloyd
+from catalog import coordinate_columns
+from spatial_index import as_index
+
+# Arguments of CVTessellation that apply to image tessellations
+IMAGE_OPTIONS = ('atol', 'rtol', 'n_jobs', 'scratch_dir', 'callback',
+                 'levels', 'refine_iters', 'block_rows')
 
 
 class VoronoiTessellation(object):
@@ -34,11 +38,14 @@ class VoronoiTessellation(object):
     Parameters
     ----------
     xy : ndarray, (n_nodes, 2)
-        Array of node ``(x,y)`` coordinates.
+        Array of node ``(x,y)`` coordinates, or a
+        :class:`tess.spatial_index.SpatialIndex` of the nodes, whose tree is
+        then reused.
     """
     def __init__(self, xy):
         super(VoronoiTessellation, self).__init__()
-        self._xy = xy
+        self._index = as_index(xy)
+        self._xy = self._index.nodes
         self._segmap = None  #: 2D `ndarray` of `vBinNum` for each pixel
         self._cell_areas = None  #: 1D array of Voronoi cell areas
         self.xlim = None  #: ``(min, max)`` coords of x pixel grid
@@ -49,6 +56,11 @@ class VoronoiTessellation(object):
         """Voronoi tessellation nodes, a ``(n_points, 2)`` array."""
         return self._xy
 
+    @property
+    def index(self):
+        """The :class:`tess.spatial_index.SpatialIndex` of the nodes."""
+        return self._index
+
     def set_pixel_grid(self, xlim, ylim):
         """Set a pixel grid bounding box for the tessellation. This is
         used when rendering Voronoi fields or computing cell areas.
@@ -104,14 +116,13 @@ class VoronoiTessellation(object):
             " node values as nodes!"
 
         # Pixel grid to compute Voronoi field on
-        ygrid, xgrid = np.meshgrid(
-            np.arange(self.ylim[0], self.ylim[1]),
-            np.arange(self.xlim[0], self.xlim[1]))
+        ygrid, xgrid = np.mgrid[self.ylim[0]:self.ylim[1],
+                                self.xlim[0]:self.xlim[1]].astype(float)
 
-        # Nearest neighbour interpolation is equivalent to Voronoi pixel
+        # Nearest node assignment is equivalent to Voronoi pixel
         # tessellation!
-        return griddata(self._xy, nodeValues, (xgrid, ygrid),
-                        method='nearest').T
+        indices = self._index.query((xgrid.ravel(), ygrid.ravel()))
+        return np.asarray(nodeValues)[indices].reshape(xgrid.shape)
 
     def compute_cell_areas(self, flagmap=None):
         """Compute the areas of Voronoi cells; result is stored in the
@@ -151,26 +162,28 @@ class VoronoiTessellation(object):
         self._cell_areas = pixelCounts
         return self._cell_areas
 
-    def partition_points(self, xy):
+    def partition_points(self, xy, n_jobs=1):
         """Partition an arbitrary set of points, defined by `x` and `y`
         coordinates, onto the Voronoi tessellation.
 
-        This method uses :class:`scipy.spatial.cKDTree` to efficiently handle
-        Voronoi assignment.
+        This method queries the :attr:`index` of the nodes, whose KD-tree is
+        built once and reused by later calls.
 
         Parameters
         ----------
         xy : ndarray, ``(n_points, 2)``
-            Array of point ``(x,y)`` coordinates
+            Array of point ``(x,y)`` coordinates, or a pair of x and y
+            coordinate columns.
+        n_jobs : int
+            Number of threads for the tree queries (``-1`` uses all
+            processors).
 
         Returns
         -------
         indices : ndarray
             Array of indices of Voronoi nodes
         """
-        tree = KDTree(self._xy)
-        distances, indices = tree.query(xy, k=1)
-        return indices
+        return self._index.query(xy, n_jobs=n_jobs)
 
     def sum_cell_point_mass(self, xy, mass=None):
         """Given a set of points with masses, computes the mass within
@@ -189,9 +202,9 @@ class VoronoiTessellation(object):
         mass : ndarray
             Sum of masses of points within each Voronoi cell.
         """
-        if mass is None:
-            mass = np.ones(xy.shape[0])
         cellIndices = self.partition_points(xy)
+        if mass is None:
+            mass = np.ones(cellIndices.shape[0])
         cellMass = np.bincount(cellIndices, weights=mass)
         return cellMass
 
@@ -235,7 +248,11 @@ class CVTessellation(VoronoiTessellation):
     Parameters
     ----------
     xy_points : ndarray, ``(n_points, 2)``
-        Array of cartesian ``(x,y)`` coordinates of each data point.
+        Array of cartesian ``(x,y)`` coordinates of each data point, or a
+        pair of ``(n_points,)`` x and y coordinate columns (such as memory
+        maps from :func:`tess.catalog.open_catalog`). ``None`` if
+        ``dens_points`` is a density image, tessellated coarse-to-fine
+        with ``levels``; see :meth:`from_image`.
     dens_points : ndarray
         Density *or weight* of each point. For an equal-S/N generator, this
         should be set to :math:`(S/N)^2`. For an equal number generator this
@@ -244,20 +261,108 @@ class CVTessellation(VoronoiTessellation):
         A ``(n_points, 2)`` array of coordinates of pre-computed generators
         for the tessellation. You can use
         :class:`tess.point_accretion.PointAccretion` and subclasses to build
-        an array of generators accordinate to target mass or S/N.
+        an array of generators accordinate to target mass or S/N (or pass
+        the :attr:`tess.point_accretion.PointBins.index` of their bins).
     max_iters : int
-        Maximum number of iterations of Lloyd's algorithm.
+        Maximum number of iterations of Lloyd's algorithm (or the number of
+        mini-batch iterations).
+    dtype : dtype
+        Precision of the point coordinates, ``numpy.float32`` or
+        ``numpy.float64``. By default single precision is used only if the
+        coordinates are already ``float32``.
+    scratch_dir : str
+        If set, per-point arrays made by Lloyd's algorithm (such as the
+        :attr:`membership`) are memory-mapped temporary files in this
+        directory.
+    n_jobs : int
+        Number of threads for the KD-tree queries of Lloyd's algorithm
+        (``-1`` uses all processors).
+    atol, rtol : float
+        Lloyd's algorithm stops once the largest node displacement of an
+        iteration is at most ``atol + rtol`` times that of the first
+        iteration (see :func:`tess.lloyd.lloyd`).
+    reassign_tol : float
+        Lloyd's algorithm also stops once at most this fraction of the
+        points changed cell in an iteration.
+    incremental : bool
+        If ``True``, Lloyd's algorithm keeps distance bounds for each point
+        and only re-assigns the points that node movements may have moved
+        to another cell (see :func:`tess.lloyd.lloyd`). Late iterations,
+        where nodes move little, then skip most KD-tree queries.
+    callback : callable
+        Called with a dict of statistics after every iteration of Lloyd's
+        algorithm (see :func:`tess.lloyd.lloyd`).
+    method : str
+        ``'lloyd'`` for full Lloyd iterations, or ``'minibatch'`` to move the
+        nodes with ``max_iters`` iterations over random subsamples of
+        ``batch_size`` points, and then assign all points once (see
+        :func:`tess.lloyd.minibatch_lloyd` for the accuracy and speed
+        trade-off). The tolerances and ``incremental`` only apply to
+        ``'lloyd'``, and setting them with ``'minibatch'`` raises a
+        `ValueError`.
+    batch_size : int
+        Number of points per mini-batch iteration.
+    seed : int
+        Seed of the mini-batch subsamples, for reproducible tessellations.
+    levels, refine_iters, block_rows : int
+        Options of image tessellations (``xy_points`` of ``None``); see
+        :meth:`from_image`.
+
+    Attributes
+    ----------
+    densPoints : ndarray
+        The ``dens_points`` of the tessellated points, or ``None`` for image
+        tessellations, whose pixel densities are not copied;
+        :attr:`node_weights` are then summed as the pixels are assigned.
     """
-    def __init__(self, xy_points, dens_points, node_xy=None, max_iters=300):
+    def __init__(self, xy_points, dens_points, node_xy=None, max_iters=300,
+                 dtype=None, scratch_dir=None, n_jobs=1, atol=0., rtol=0.,
+                 reassign_tol=0., incremental=False, callback=None,
+                 method='lloyd', batch_size=10000, seed=None, levels=0,
+                 refine_iters=5, block_rows=256):
+        if xy_points is None:
+            options = {'dtype': dtype is not None,
+                       'reassign_tol': reassign_tol != 0.,
+                       'incremental': incremental,
+                       'method': method != 'lloyd',
+                       'batch_size': batch_size != 10000,
+                       'seed': seed is not None}
+            _check_image_options(name for name in options if options[name])
+            xy, vbin_num = self._tessellate_image(dens_points, node_xy,
+                                                  max_iters, levels,
+                                                  refine_iters, block_rows,
+                                                  scratch_dir=scratch_dir,
+                                                  n_jobs=n_jobs, atol=atol,
+                                                  rtol=rtol,
+                                                  callback=callback)
+            super(CVTessellation, self).__init__(xy)
+            self._vbin_num = vbin_num
+            self.set_pixel_grid((0, dens_points.shape[1]),
+                                (0, dens_points.shape[0]))
+            return
+        if levels:
+            raise ValueError("levels only apply to image tessellations")
         xy, vbin_num = self._tessellate(xy_points,  # CHANGED
                                         dens_points,
                                         node_xy=node_xy,
-                                        max_iters=max_iters)
+                                        max_iters=max_iters,
+                                        dtype=dtype,
+                                        scratch_dir=scratch_dir,
+                                        n_jobs=n_jobs,
+                                        atol=atol,
+                                        rtol=rtol,
+                                        reassign_tol=reassign_tol,
+                                        incremental=incremental,
+                                        callback=callback,
+                                        method=method,
+                                        batch_size=batch_size,
+                                        seed=seed)
         super(CVTessellation, self).__init__(xy)
         self._vbin_num = vbin_num
 
     @classmethod
-    def from_image(cls, density, generators, max_iters=300):
+    def from_image(cls, density, generators, max_iters=300, levels=0,
+                   refine_iters=5, block_rows=256, **kwargs):
         """Convenience constructor for centroidal Voronoi tessellations
         of pixel data sets.
 
@@ -276,8 +381,32 @@ class CVTessellation(VoronoiTessellation):
             Note that coordinates are (x, y), which is the reverse of (y, x)
             image indices.
         max_iters : int
-            Maximum number of iterations of Lloyd's algorithm.
+            Maximum number of iterations of Lloyd's algorithm (on the
+            coarsest level if ``levels`` is set).
+        levels : int
+            If set, run Lloyd's algorithm coarse-to-fine on this many
+            block-summed (by factors of 2) levels above the image, refining
+            the nodes with at most ``refine_iters`` iterations on each finer
+            level, and streaming the image in strips of ``block_rows`` rows
+            (see :func:`tess.lloyd.pyramid_lloyd`). Pixel coordinate arrays
+            are then never made for the whole image, and only the last
+            few iterations visit every pixel.
+        refine_iters : int
+            Maximum number of iterations on each level below the coarsest.
+        block_rows : int
+            Number of image rows per strip with ``levels``.
+        kwargs : dict
+            Further arguments of :class:`CVTessellation`, such as the
+            convergence tolerances. With ``levels``, only ``atol``,
+            ``rtol``, ``n_jobs``, ``scratch_dir`` and ``callback`` apply,
+            and other arguments raise a `ValueError`. The tessellation's
+            :attr:`densPoints` are then ``None``.
         """
+        if levels > 0:
+            _check_image_options(kwargs)
+            return cls(None, density, node_xy=generators, max_iters=max_iters,
+                       levels=levels, refine_iters=refine_iters,
+                       block_rows=block_rows, **kwargs)
         x, y = np.meshgrid(np.arange(density.shape[1], dtype=float),
                            np.arange(density.shape[0], dtype=float))
         xy = np.column_stack((x.flatten(), y.flatten()))
@@ -286,23 +415,65 @@ class CVTessellation(VoronoiTessellation):
         instance = cls(xy[good, :],
                        dens[good],
                        node_xy=generators,
-                       max_iters=max_iters)
+                       max_iters=max_iters,
+                       **kwargs)
         instance.set_pixel_grid((0, density.shape[1]), (0, density.shape[0]))
         return instance
 
-    def _tessellate(self, xy, densPoints, node_xy=None, max_iters=300):
+    def _tessellate(self, xy, densPoints, node_xy=None, max_iters=300,
+                    dtype=None, scratch_dir=None, n_jobs=1, atol=0., rtol=0.,
+                    reassign_tol=0., incremental=False, callback=None,
+                    method='lloyd', batch_size=10000, seed=None):
         """Computes the centroidal voronoi tessellation itself."""
+        if method not in ('lloyd', 'minibatch'):
+            raise ValueError("method must be 'lloyd' or 'minibatch', "
+                             "not {0!r}".format(method))
         self.densPoints = densPoints
 
         # Obtain pre-generator node coordinates
         if node_xy is None:
-            node_xy = xy.copy()
-
+            node_xy = np.column_stack(coordinate_columns(xy))
+
+        if method == 'minibatch':
+            options = {'atol': atol != 0.,
+                       'rtol': rtol != 0.,
+                       'reassign_tol': reassign_tol != 0.,
+                       'incremental': incremental}
+            _reject_options(sorted(name for name in options
+                                   if options[name]),
+                            "method 'minibatch' does not")
+            node_xy, v_bin_numbers = minibatch_lloyd(
+                xy, densPoints, node_xy, max_iters, batch_size=batch_size,
+                seed=seed, dtype=dtype, scratch_dir=scratch_dir,
+                n_jobs=n_jobs, callback=callback)
+            return np.asarray(node_xy), np.asanyarray(v_bin_numbers)
         node_xy, v_bin_numbers, converged = lloyd(xy, densPoints, node_xy,
-                                                  max_iters)
+                                                  max_iters, dtype=dtype,
+                                                  scratch_dir=scratch_dir,
+                                                  n_jobs=n_jobs, atol=atol,
+                                                  rtol=rtol,
+                                                  reassign_tol=reassign_tol,
+                                                  incremental=incremental,
+                                                  callback=callback)
+        if not converged:
+            log.warning("CVT did not converge")
+        return np.asarray(node_xy), np.asanyarray(v_bin_numbers)
+
+    def _tessellate_image(self, density, node_xy, max_iters, levels,
+                          refine_iters, block_rows, **kwargs):
+        """Computes the centroidal voronoi tessellation of the pixels of a
+        density image, coarse-to-fine."""
+        if levels < 1:
+            raise ValueError("image tessellations need levels >= 1, not "
+                             "{0!r}".format(levels))
+        self.densPoints = None
+        node_xy, v_bin_numbers, self._node_weights, converged = \
+            pyramid_lloyd(density, node_xy, levels, max_iters,
+                          refine_iters=refine_iters, block_rows=block_rows,
+                          **kwargs)
         if not converged:
             log.warning("CVT did not converge")
-        return np.asarray(node_xy), np.array(v_bin_numbers)
+        return np.asarray(node_xy), np.asanyarray(v_bin_numbers)
 
     @property
     def membership(self):
@@ -312,10 +483,24 @@ class CVTessellation(VoronoiTessellation):
     @property
     def node_weights(self):
         """Weight of each Voronoi bin (sum of enclosed point masses)."""
+        if self.densPoints is None:
+            # Summed while assigning pixels in an image tessellation
+            return self._node_weights
         nNodes = self._xy.shape[0]
-        nodeWeights = np.zeros(nNodes, dtype=np.float)
-        for i in xrange(nNodes):
-            ind = np.where(self._vbin_num == i)[0]
-            if len(ind) > 0:
-                nodeWeights[i] = np.sum(self.densPoints[ind])
-        return nodeWeights
+        return np.bincount(self._vbin_num, weights=self.densPoints,
+                           minlength=nNodes)
+
+
+def _check_image_options(names):
+    """Raise a `ValueError` naming any argument of ``names`` that does not
+    apply to image tessellations."""
+    _reject_options(sorted(set(names) - set(IMAGE_OPTIONS)),
+                    "image tessellations with levels do not")
+
+
+def _reject_options(unsupported, subject):
+    """Raise a `ValueError` naming the ``unsupported`` arguments, if any,
+    as not supported by ``subject``."""
+    if unsupported:
+        raise ValueError("{0} support {1}".format(
+            subject, ", ".join(repr(name) for name in unsupported)))